@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+from fact_table import dense_keys
+
+# Order-level payment allocation.
+#
+# Joining order_items with payments on order_id gives items x payment rows per
+# order, which repeats payment_value once per item. Instead the payments are
+# summed per order and that total is split over the order's items in proportion
+# to price + freight_value, so each item gets exactly one row and the allocated
+# values add back up to what was paid.
+
+
+def allocate(item_order, item_weight, pay_order, pay_value, n_orders):
+    # item_order/pay_order are dense order keys; returns the amount allocated to each
+    # item (NaN for items whose order has no payment rows)
+    paid = np.bincount(pay_order, weights=pay_value, minlength=n_orders)
+    has_payment = np.bincount(pay_order, minlength=n_orders) > 0
+
+    weight = np.nan_to_num(np.asarray(item_weight, dtype="float64"))
+    order_weight = np.bincount(item_order, weights=weight, minlength=n_orders)
+    order_items = np.bincount(item_order, minlength=n_orders)
+    # orders whose items are all free split the payment evenly
+    even = order_weight[item_order] <= 0
+    share = np.divide(weight, order_weight[item_order], out=np.zeros_like(weight), where=~even)
+    share[even] = 1.0 / order_items[item_order][even]
+
+    return np.where(has_payment[item_order], paid[item_order] * share, np.nan)
+
+
+def item_payments(item_fact, order_fact, payments):
+    # Payment value allocated to each item_fact row (NaN for items of orders without payments)
+    pay_order = dense_keys(order_fact["order_id"], payments["order_id"])
+    known = pay_order >= 0
+    return allocate(
+        item_fact["order_key"].to_numpy(),
+        item_fact["price"].to_numpy() + item_fact["freight_value"].to_numpy(),
+        pay_order[known],
+        payments["payment_value"].to_numpy()[known],
+        len(order_fact),
+    )
+
+
+def allocate_payments(item_fact, order_fact, payments):
+    # One row per order item: order_key, seller_key, customer_key and its share of payment_value.
+    # Items of orders without payment rows are dropped, like the inner join they replace.
+    value = item_payments(item_fact, order_fact, payments)
+    paid = ~np.isnan(value)
+    return pd.DataFrame({
+        "order_key": item_fact["order_key"].to_numpy()[paid],
+        "seller_key": item_fact["seller_key"].to_numpy()[paid],
+        "customer_key": item_fact["customer_key"].to_numpy()[paid],
+        "payment_value": value[paid],
+    })
+
+
+def totals_by(allocated, key, size):
+    # Allocated payments summed per seller_key/customer_key (NaN for keys without any)
+    totals = np.bincount(allocated[key], weights=allocated["payment_value"], minlength=size)
+    present = np.bincount(allocated[key], minlength=size) > 0
+    return np.where(present, totals, np.nan)
+
+
+def add_totals(totals, delta):
+    # totals_by() of the union of two disjoint sets of allocated rows; the dimension may have grown
+    out = np.full(len(delta), np.nan)
+    out[:len(totals)] = totals
+    has = ~np.isnan(delta)
+    out[has] = np.nan_to_num(out[has]) + delta[has]
+    return out
+
+
+def revenue_by(totals, dim, columns):
+    # The dimension's columns and payment_value for every key with allocated payments
+    keys = np.flatnonzero(~np.isnan(totals))
+    out = dim[columns].take(keys).reset_index(drop=True)
+    out["payment_value"] = totals[keys]
+    return out
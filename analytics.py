@@ -0,0 +1,566 @@
+from collections import namedtuple
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+import allocation
+import approximate
+import cohort
+import cube
+import delivery
+import fact_table
+import ids
+import ranking
+import rfm
+import sketches
+import timeseries
+from data_loader import concat_tables
+
+# Dashboard metrics as plain functions over DataFrames, with no Streamlit or
+# plotting imports, so batch jobs and benchmarks can call them directly:
+#
+#     tables = data_loader.load_tables()
+#     model = analytics.prepare(tables)
+#     analytics.category_revenue(model.item_cube)
+#
+# Nothing here mutates its inputs; the dashboard shares these frames across reruns.
+# The model's tables hold int32 codes in place of the hex ids; ids.decode(df, model.ids)
+# turns them back for display.
+
+# Everything derived once per data version. new_customers ... approximate are the
+# running aggregates behind the new-customer, review, payment-type, seller/customer
+# revenue, RFM segment, cohort and delivery performance panels and the approximate
+# mode, kept so that update() can add a batch to them.
+Model = namedtuple("Model", [
+    "tables", "item_fact", "order_fact", "item_cube", "order_cube", "allocated",
+    "new_customers", "review_counts", "payment_counts", "seller_totals", "customer_totals",
+    "rfm", "activity", "delivery", "approximate", "ids",
+])
+
+SEGMENT_BINS = [0, 100, 400, float('inf')]
+SEGMENT_LABELS = ['Low', 'High', 'Top']
+
+def prepare(tables):
+    # Fact tables, cubes and payment allocation for a dict of loaded tables
+    return _build(*ids.encode_tables(tables))
+
+
+def _build(tables, id_dictionaries):
+    # prepare() on tables whose ids are already encoded
+    item_fact, order_fact = fact_table.build_fact_tables(
+        tables["ORDERS"], tables["ORDER_ITEMS"], tables["CUSTOMERS"],
+        tables["PRODUCTS"], tables["SELLERS"], tables["ORDER_REVIEW_RATINGS"],
+    )
+    allocated = allocation.allocate_payments(item_fact, order_fact, tables["ORDER_PAYMENTS"])
+    return Model(
+        tables=tables,
+        item_fact=item_fact,
+        order_fact=order_fact,
+        item_cube=cube.build_item_cube(item_fact),
+        order_cube=cube.build_order_cube(order_fact),
+        allocated=allocated,
+        new_customers=new_customer_counts(tables["ORDERS"]),
+        review_counts=tables["ORDER_REVIEW_RATINGS"]['review_score'].value_counts(),
+        payment_counts=tables["ORDER_PAYMENTS"]['payment_type'].value_counts(),
+        seller_totals=allocation.totals_by(allocated, 'seller_key', len(tables["SELLERS"])),
+        customer_totals=allocation.totals_by(allocated, 'customer_key', len(tables["CUSTOMERS"])),
+        rfm=rfm_totals(order_fact, tables["ORDER_PAYMENTS"], id_dictionaries),
+        activity=cohort.activity(item_fact['customer_unique_id'].to_numpy(), item_fact),
+        delivery=delivery_sketch(item_fact),
+        approximate=approximate_sketches(tables, item_fact, order_fact, tables["ORDER_PAYMENTS"],
+                                         tables["PRODUCTS"], tables["SELLERS"], id_dictionaries),
+        ids=id_dictionaries,
+    )
+
+
+def restrict(model, order_mask, item_mask):
+    # Model of the orders and items passing a global filter (filters.FilterIndex.masks:
+    # boolean masks over model.order_fact and model.item_fact rows, items only of passing
+    # orders); see Restricted
+    return Restricted(model, order_mask, item_mask)
+
+
+class Restricted:
+    # The fields of a Model for the rows passing a global filter, each built from the
+    # unfiltered model the first time it is read, so a filtered view costs only the
+    # aggregates its panels ask for.
+    #
+    # ORDERS, ORDER_PAYMENTS and ORDER_REVIEW_RATINGS keep the rows of the passing
+    # orders; ORDER_ITEMS and the dimension tables stay whole, as the facts index them
+    # by key. When items of passing orders are filtered out, each passing item keeps its
+    # share of its order's payments rather than being allocated the whole of them. New
+    # customers are those whose first order passes. filtered_kpis() gives its overview
+    # KPIs. approximate is the unfiltered model's: the rows passing are a selection of
+    # its cells (filters.cells), which the approximate queries take.
+    def __init__(self, model, order_mask, item_mask):
+        self.base = model
+        self.order_mask = order_mask
+        self.item_mask = item_mask
+        self.approximate = model.approximate
+        self.ids = model.ids
+
+    @cached_property
+    def _order_key(self):
+        # new order key of each order of the base model, -1 for those filtered out
+        order_key = np.full(len(self.order_mask), -1, dtype=np.int32)
+        order_key[self.order_mask] = np.arange(np.count_nonzero(self.order_mask), dtype=np.int32)
+        return order_key
+
+    @cached_property
+    def order_fact(self):
+        order_fact = self.base.order_fact[self.order_mask].reset_index(drop=True)
+        return order_fact.assign(order_key=np.arange(len(order_fact), dtype=np.int32))
+
+    @cached_property
+    def item_fact(self):
+        item_fact = self.base.item_fact[self.item_mask].reset_index(drop=True)
+        return item_fact.assign(order_key=self._order_key[item_fact["order_key"].to_numpy()])
+
+    @cached_property
+    def tables(self):
+        tables = dict(self.base.tables)
+        for name in ["ORDERS", "ORDER_PAYMENTS", "ORDER_REVIEW_RATINGS"]:
+            df = tables[name]
+            tables[name] = df[fact_table.dense_keys(self.order_fact["order_id"], df["order_id"]) >= 0].reset_index(
+                drop=True)
+        return tables
+
+    @cached_property
+    def _payments(self):
+        # order_id / payment_value rows allocated to the items and summed for RFM
+        base = self.base
+        if (self.order_mask[base.item_fact["order_key"].to_numpy()] == self.item_mask).all():
+            return self.tables["ORDER_PAYMENTS"]
+        share = allocation.item_payments(base.item_fact, base.order_fact, base.tables["ORDER_PAYMENTS"])
+        paid = ~np.isnan(share) & self.item_mask
+        order_id = base.order_fact["order_id"].to_numpy()[base.item_fact["order_key"].to_numpy()]
+        return pd.DataFrame({"order_id": order_id[paid], "payment_value": share[paid]})
+
+    @cached_property
+    def item_cube(self):
+        return cube.build_item_cube(self.item_fact)
+
+    @cached_property
+    def order_cube(self):
+        return cube.build_order_cube(self.order_fact)
+
+    @cached_property
+    def allocated(self):
+        return allocation.allocate_payments(self.item_fact, self.order_fact, self._payments)
+
+    @cached_property
+    def new_customers(self):
+        orders = self.base.tables["ORDERS"]
+        first = ~orders["customer_id"].duplicated().to_numpy()
+        passing = fact_table.dense_keys(self.order_fact["order_id"], orders["order_id"]) >= 0
+        return new_customer_counts(orders[first & passing])
+
+    @cached_property
+    def review_counts(self):
+        return self.tables["ORDER_REVIEW_RATINGS"]['review_score'].value_counts()
+
+    @cached_property
+    def payment_counts(self):
+        return self.tables["ORDER_PAYMENTS"]['payment_type'].value_counts()
+
+    @cached_property
+    def seller_totals(self):
+        return allocation.totals_by(self.allocated, 'seller_key', len(self.tables["SELLERS"]))
+
+    @cached_property
+    def customer_totals(self):
+        return allocation.totals_by(self.allocated, 'customer_key', len(self.tables["CUSTOMERS"]))
+
+    @cached_property
+    def rfm(self):
+        return rfm_totals(self.order_fact, self._payments, self.ids)
+
+    @cached_property
+    def activity(self):
+        return cohort.activity(self.item_fact['customer_unique_id'].to_numpy(), self.item_fact)
+
+    @cached_property
+    def delivery(self):
+        return delivery_sketch(self.item_fact)
+
+
+def update(model, delta):
+    # Model for the tables plus a batch of new rows ({table name: rows}, see
+    # data_loader.APPEND_TABLES). Only the batch is joined and aggregated; the result
+    # is merged into the existing cubes, allocation and running aggregates. Late
+    # reviews of orders already in the model are folded into their review totals;
+    # items or payments of such orders (or a repeated order id) change allocations
+    # and distinct counts already made, so those batches fall back to prepare().
+    delta, id_dictionaries = ids.encode_tables(delta, model.ids)
+    tables = {name: concat_tables([df, delta[name]]) if name in delta else df
+              for name, df in model.tables.items()}
+    empty = {name: df.iloc[:0] for name, df in model.tables.items()}
+    orders, items, payments, reviews = (
+        delta.get(name, empty[name]) for name in ["ORDERS", "ORDER_ITEMS", "ORDER_PAYMENTS", "ORDER_REVIEW_RATINGS"])
+
+    # one lookup of the batch's order ids against the orders already loaded
+    sizes = np.cumsum([0, len(orders), len(items), len(payments)])
+    known = fact_table.dense_keys(model.order_fact["order_id"], pd.concat(
+        [orders["order_id"], items["order_id"], payments["order_id"], reviews["order_id"]], ignore_index=True))
+    if (known[:sizes[3]] >= 0).any():
+        return _build(tables, id_dictionaries)
+    late_review = known[sizes[3]:]
+
+    order_fact = fact_table.build_order_fact(orders, tables["CUSTOMERS"], reviews)
+    item_fact = fact_table.build_item_fact(order_fact, items, tables["PRODUCTS"], tables["SELLERS"])
+    allocated = allocation.allocate_payments(item_fact, order_fact, payments)
+    item_cube = model.item_cube.merge(cube.build_item_cube(item_fact))
+    order_cube = model.order_cube.merge(cube.build_order_cube(order_fact))
+    approx = approximate.merge(model.approximate, approximate_sketches(
+        delta, item_fact, order_fact, payments, tables["PRODUCTS"], tables["SELLERS"], id_dictionaries))
+    # the batch's order keys continue after the existing ones
+    offset = len(model.order_fact)
+    order_fact["order_key"] += offset
+    item_fact["order_key"] += offset
+    allocated["order_key"] += offset
+    old_order_fact, old_item_fact = model.order_fact, model.item_fact
+
+    if (late_review >= 0).any():
+        has_order = late_review >= 0
+        score_sum = np.bincount(late_review[has_order], weights=reviews["review_score"].to_numpy()[has_order],
+                                minlength=offset)
+        count = np.bincount(late_review[has_order], minlength=offset).astype(np.int32)
+        old_order_fact = old_order_fact.assign(
+            review_score_sum=old_order_fact["review_score_sum"] + score_sum,
+            review_count=old_order_fact["review_count"] + count)
+        item_order = old_item_fact["order_key"].to_numpy()
+        old_item_fact = old_item_fact.assign(
+            review_score_sum=old_item_fact["review_score_sum"] + score_sum[item_order],
+            review_count=old_item_fact["review_count"] + count[item_order])
+        # the items of those orders carry the added review totals into their cube cells
+        reviewed = old_item_fact[count[item_order] > 0]
+        reviewed_order = reviewed["order_key"].to_numpy()
+        item_cube = item_cube.merge(cube.Cube.build(
+            reviewed[["product_category_name", "seller_state", "customer_state"]].assign(
+                month=cube.month_code(reviewed["order_purchase_timestamp"]),
+                review_score_sum=score_sum[reviewed_order],
+                review_count=count[reviewed_order]),
+            cube.ITEM_DIMS,
+            {"review_score_sum": ("review_score_sum", "sum"), "review_count": ("review_count", "sum")}))
+
+    return Model(
+        tables=tables,
+        item_fact=concat_tables([old_item_fact, item_fact]),
+        order_fact=concat_tables([old_order_fact, order_fact]),
+        item_cube=item_cube,
+        order_cube=order_cube,
+        allocated=concat_tables([model.allocated, allocated]),
+        new_customers=add_counts(model.new_customers, new_customer_counts(
+            orders[~orders['customer_id'].isin(model.tables["ORDERS"]['customer_id'])])),
+        review_counts=add_counts(model.review_counts, reviews['review_score'].value_counts()),
+        payment_counts=add_counts(model.payment_counts, payments['payment_type'].value_counts()),
+        seller_totals=allocation.add_totals(model.seller_totals, allocation.totals_by(
+            allocated, 'seller_key', len(tables["SELLERS"]))),
+        customer_totals=allocation.add_totals(model.customer_totals, allocation.totals_by(
+            allocated, 'customer_key', len(tables["CUSTOMERS"]))),
+        rfm=rfm.add(model.rfm, rfm_totals(order_fact, payments, id_dictionaries)),
+        activity=cohort.add_activity(model.activity, cohort.activity(item_fact['customer_unique_id'].to_numpy(),
+                                                                     item_fact)),
+        delivery=model.delivery.merge(delivery_sketch(item_fact)),
+        approximate=approx,
+        ids=id_dictionaries,
+    )
+
+
+def add_counts(counts, delta):
+    # Two value_counts() Series added up (for the counts of disjoint sets of rows)
+    return counts.add(delta, fill_value=0).astype(counts.dtype)
+
+
+# --- Overview ---
+
+def overview_kpis(tables):
+    return {
+        "total_products": tables["PRODUCTS"]['product_id'].nunique(),
+        "total_revenue": tables["ORDER_ITEMS"]['price'].sum(),
+        "total_sellers": tables["SELLERS"]['seller_id'].nunique(),
+        "total_customers": tables["CUSTOMERS"]['customer_id'].nunique(),
+        "total_orders": tables["ORDERS"]['order_id'].nunique(),
+    }
+
+
+def filtered_kpis(model):
+    # overview_kpis of a restrict()ed Model: the products, revenue and sellers of its
+    # items, the customers and orders of its orders
+    item_fact, order_fact = model.item_fact, model.order_fact
+    return {
+        "total_products": item_fact['product_key'].nunique(),
+        "total_revenue": item_fact['price'].sum(),
+        "total_sellers": item_fact['seller_key'].nunique(),
+        "total_customers": order_fact['customer_id'].nunique(),
+        "total_orders": order_fact['order_id'].nunique(),
+    }
+
+
+def region_options(sellers):
+    return sellers['seller_state'].unique()
+
+
+def category_options(item_fact):
+    return item_fact["product_category_name"].dropna().unique()
+
+
+# --- Product Analysis ---
+
+def category_revenue(item_cube):
+    # Revenue per product category, highest first
+    product_revenue = item_cube.query(['product_category_name'])[['product_category_name', 'revenue']]
+    product_revenue = product_revenue.rename(columns={'revenue': 'price'})
+    return product_revenue.sort_values(by='price', ascending=False)
+
+
+def region_category_revenue(item_cube, seller_state):
+    # Revenue per product category for sellers in one state (alphabetical), and its total
+    region_product_revenue = item_cube.query(['product_category_name'], where={'seller_state': seller_state})
+    region_product_revenue = region_product_revenue[['product_category_name', 'revenue']].rename(columns={'revenue': 'price'})
+    region_product_revenue = region_product_revenue.sort_values(by='product_category_name', ascending=True)
+    return region_product_revenue, region_product_revenue['price'].sum()
+
+
+# --- New customers and reviews ---
+
+def new_customer_counts(orders):
+    # Customers per day code (timeseries.period_codes) of their first order row
+    first = orders[['customer_id', 'order_purchase_timestamp']].drop_duplicates(subset=['customer_id'])
+    day = pd.Series(timeseries.period_codes(first['order_purchase_timestamp'], "day"))
+    return day[day >= 0].value_counts().sort_index()
+
+
+def new_customers_by_period(new_customers, granularity="month", start=None, end=None):
+    # new_customers: Model.new_customers. One row per period of the range, 0 where nobody joined
+    counts = timeseries.resample(new_customers, granularity, start=start, end=end)
+    return pd.DataFrame({"period": counts.index, "customer_id": counts.to_numpy()})
+
+
+def review_histogram(review_counts):
+    # review_counts: Model.review_counts
+    return review_counts.sort_index()
+
+
+# --- Pie charts ---
+
+def count_frame(counts, label):
+    # A Series of counts as a [label, 'Count'] frame, largest first
+    counts = counts.sort_values(ascending=False, kind="stable").reset_index()
+    counts.columns = [label, 'Count']
+    return counts
+
+
+def payment_mix(payment_counts):
+    # payment_counts: Model.payment_counts
+    return count_frame(payment_counts, 'Payment_Type')
+
+
+def delivery_accuracy(orders):
+    return delivery_accuracy_frame(delivery_accuracy_counts(orders))
+
+
+def delivery_accuracy_counts(orders):
+    # Orders per Before / On Time / After the estimated delivery date
+    accuracy = pd.cut(
+        (orders['order_delivered_customer_date'] - orders['order_estimated_delivery_date']).dt.days,
+        bins=[-float('inf'), -1, 0, float('inf')],
+        labels=['Before', 'On Time', 'After']
+    )
+    return accuracy.value_counts()
+
+
+def delivery_accuracy_frame(counts):
+    # Orders delivered before / after the estimate ("On Time" is left out of the chart)
+    counts = count_frame(counts, 'Delivery Accuracy')
+    return counts[counts['Delivery Accuracy'].isin(['Before', 'After'])]
+
+
+def seller_revenue(seller_totals, sellers):
+    return allocation.revenue_by(seller_totals, sellers, ['seller_id', 'seller_city', 'seller_state'])
+
+
+def customer_revenue(customer_totals, customers):
+    return allocation.revenue_by(customer_totals, customers, ['customer_id', 'customer_city', 'customer_state'])
+
+
+def segment_counts(revenue, label):
+    # Number of sellers/customers per revenue band, as a [label, 'Count'] frame
+    revenue = revenue[revenue['payment_value'] >= 0]
+    groups = pd.cut(revenue['payment_value'], bins=SEGMENT_BINS, labels=SEGMENT_LABELS, right=False)
+    return count_frame(groups.value_counts(), label)
+
+
+def rfm_totals(order_fact, payments, id_dictionaries):
+    # rfm.Totals of an encoded order fact, per customer_unique_id code
+    return rfm.order_totals(order_fact, payments, order_fact['customer_unique_id'].to_numpy(),
+                            len(id_dictionaries['customer_unique_id']))
+
+
+def rfm_segments(assigned):
+    # Customers per RFM segment (assigned: rfm.assign), as a ['Segment', 'Count'] frame
+    return count_frame(rfm.segment_counts(assigned), 'Segment')
+
+
+# --- Cohorts ---
+
+def cohorts(activity, category=None, customer_state=None):
+    # activity: Model.activity; see cohort.matrix
+    return cohort.matrix(activity, category, customer_state)
+
+
+# --- Delivery performance ---
+
+def delivery_sketch(item_fact):
+    # Latency sketches of an item fact's shipments (delivery.py)
+    return delivery.build(*delivery.item_shipments(item_fact))
+
+
+def delivery_percentiles(sketch, sellers, metric, by=None, seller_state=None, customer_state=None):
+    # sketch: Model.delivery; see delivery.percentiles. Per seller, the seller_key
+    # column is replaced by the seller_id of that SELLERS row.
+    frame = delivery.percentiles(sketch, metric, by, seller_state, customer_state)
+    if by == "seller":
+        keys = frame["seller_key"].to_numpy()
+        frame = frame.rename(columns={"seller_key": "seller_id"}).assign(seller_id=sellers["seller_id"].to_numpy()[keys])
+    return frame
+
+
+def delivery_compliance(sketch, seller_state=None, customer_state=None):
+    return delivery.compliance(sketch, seller_state, customer_state)
+
+
+# --- Approximate mode ---
+
+def approximate_sketches(counted, item_fact, order_fact, payments, products, sellers, id_dictionaries=None):
+    # approximate.Sketches of an item and order fact (orders and items not in an earlier
+    # set of sketches), the counted rows of the TABLE_KPIS tables in `counted` ({table
+    # name: rows}) and the payments of those orders. Ids are hashed as hex strings: the
+    # frames of a Model hold codes, turned back through id_dictionaries.
+    order_key = item_fact["order_key"].to_numpy()
+    order_id, customer_id = order_fact["order_id"].to_numpy(), order_fact["customer_id"].to_numpy()
+    ids_of = {
+        "order_id": [order_id, order_id[order_key]],
+        "customer_id": [customer_id, customer_id[order_key]],
+        "seller_id": [sellers["seller_id"].to_numpy()[item_fact["seller_key"].to_numpy()]],
+        "product_id": [products["product_id"].to_numpy()[item_fact["product_key"].to_numpy()]],
+    }
+    for name, column in approximate.TABLE_KPIS.values():
+        if name in counted:
+            ids_of[column].append(counted[name][column].to_numpy())
+    # each distinct id is hashed once however many of the arrays hold it
+    hashes = {}
+    for column, arrays in ids_of.items():
+        values = np.concatenate(arrays)
+        if id_dictionaries is None:
+            inverse, uniques = pd.factorize(values, use_na_sentinel=False)
+        else:
+            codes, inverse = np.unique(values, return_inverse=True)
+            uniques = id_dictionaries[column].decode(codes)
+        hashes[column] = np.split(sketches.hash_values(uniques)[inverse], np.cumsum([len(a) for a in arrays])[:-1])
+
+    orders = order_fact[["customer_state", "order_status"]].assign(
+        day=timeseries.period_codes(order_fact["order_purchase_timestamp"], "day"),
+        order_id=hashes["order_id"][0], customer_id=hashes["customer_id"][0])
+    items = item_fact[["customer_state", "order_status", "seller_state", "product_category_name"]].assign(
+        day=timeseries.period_codes(item_fact["order_purchase_timestamp"], "day"),
+        order_id=hashes["order_id"][1], customer_id=hashes["customer_id"][1],
+        **{column: hashes[column][0] for column in ["seller_id", "product_id"]},
+        price=item_fact["price"].to_numpy(),
+        payment=allocation.item_payments(item_fact, order_fact, payments))
+    table_hashes = {kpi: hashes[column][-1]
+                    for kpi, (name, column) in approximate.TABLE_KPIS.items() if name in counted}
+    return approximate.build(table_hashes, orders, items)
+
+
+def approximate_kpis(sketch, total_revenue, where=None, days=None):
+    # overview_kpis with the distinct counts estimated from sketch (Model.approximate), of
+    # all rows or of those passing a global filter (where, days: filters.cells)
+    counts = approximate.overview_kpis(sketch, where, days)
+    return {
+        "total_products": counts["total_products"],
+        "total_revenue": total_revenue,
+        "total_sellers": counts["total_sellers"],
+        "total_customers": counts["total_customers"],
+        "total_orders": counts["total_orders"],
+    }
+
+
+def approximate_counts(sketch, customer_state=None, category=None, where=None, days=None):
+    # sketch: Model.approximate; see approximate.distinct_counts
+    return approximate.distinct_counts(sketch, customer_state, category, where, days)
+
+
+def value_percentiles(sketch, customer_state=None, category=None, where=None, days=None):
+    return approximate.value_percentiles(sketch, customer_state, category, where, days)
+
+
+def approximate_state_year_orders(sketch, top=10, where=None, days=None):
+    # state_year_orders with the orders per state and year estimated from sketch
+    return year_pivot(approximate.state_year_orders(sketch, top, where, days))
+
+
+# --- Selected product category ---
+
+def top_regions(rankings, category, k=3):
+    # Customer states with the highest revenue for one product category
+    top = ranking.query(rankings, "customer_state", k, within="category", group=category)
+    return top.rename(columns={"customer_state": "Region"})[["Region", "Revenue"]]
+
+
+def product_metrics(item_cube, category):
+    return metrics_from_totals(item_cube.total(where={"product_category_name": category}))
+
+
+def metrics_from_totals(totals):
+    # totals: revenue, item_count, review_score_sum and review_count of a category
+    return {
+        # each item carries its order's review totals, so the mean over (review, item) pairs is a ratio of sums
+        "average_rating": totals["review_score_sum"] / totals["review_count"] if totals["review_count"] else np.nan,
+        "average_price": totals["revenue"] / totals["item_count"] if totals["item_count"] else np.nan,
+        "total_revenue": totals["revenue"],
+    }
+
+
+def top_k(rankings, dimension, k=3):
+    # The k sellers/customers with the highest allocated payment value
+    top = ranking.query(rankings, dimension, k)
+    return top.drop(columns="Rank").rename(columns={"Revenue": "payment_value"})
+
+
+def ranking_groups(item_cube, within):
+    # Values of a dimension a ranking can be restricted to, in sorted order
+    column = ranking.key_column(within)
+    return item_cube.query([column])[column].to_numpy()
+
+
+# --- Rankings ---
+
+def rankings(item_cube, seller_totals, sellers, customer_totals, customers):
+    # Revenue rankings of every dimension (ranking.py), built once per data version
+    return ranking.build_rankings(
+        item_cube, seller_revenue(seller_totals, sellers), customer_revenue(customer_totals, customers))
+
+
+# --- Heatmap ---
+
+def state_year_orders(order_cube, top=10):
+    # Orders per year for the `top` customer states by order count (states x years)
+    ordered_state = order_cube.query(['customer_state']).rename(columns={'order_count': 'order_id'})
+    ordered_state = ordered_state.sort_values(by='order_id', ascending=False).head(top)
+
+    filtered_data = order_cube.slice({'customer_state': ordered_state['customer_state']})
+    filtered_data = filtered_data[filtered_data['month'] >= 0]
+    yearly_state_orders = (
+        filtered_data.assign(Purchased_Year=cube.month_year(filtered_data['month']))
+        .groupby(['customer_state', 'Purchased_Year'], observed=True)['order_count'].sum()
+        .reset_index()
+        .rename(columns={'order_count': 'order_id'})
+    )
+    return year_pivot(yearly_state_orders)
+
+
+def year_pivot(yearly_state_orders):
+    # customer_state / Purchased_Year / order_id rows as the states x years table
+    return yearly_state_orders.pivot(index='customer_state', columns='Purchased_Year', values='order_id').fillna(0)
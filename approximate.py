@@ -0,0 +1,204 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import cube
+import sketches
+import timeseries
+from data_loader import concat_tables
+
+# Approximate answers from sketches (sketches.py), for the opt-in approximate mode.
+#
+# Built once per data version next to the exact aggregates, and merged batch by
+# batch (merge()) like them:
+#
+#   tables  HyperLogLog registers of the ids of the PRODUCTS, SELLERS, CUSTOMERS
+#           and ORDERS rows, for the headline distinct counts (TABLE_KPIS)
+#   orders  HyperLogLog cells of the order and customer ids of the orders per
+#           ORDER_DIMS, for orders per state and year and the filtered headline counts
+#   items   HyperLogLog cells of the order, customer, seller and product ids of the
+#           order items per CELL_DIMS, for distinct counts of any slice of those dimensions
+#   values  quantile sketch cells of item price and allocated payment per CELL_DIMS
+#
+# The cells are kept per value of every global filter dimension (filters.py) and per
+# purchase day, so the rows passing a global filter are a selection of whole cells
+# (filters.cells): the answers under a filter fold the selected cells of the one set
+# of sketches rather than sketching the filtered rows again. Under an item filter
+# (seller state, category) the orders passing are those of the items passing, and
+# are counted from the item cells.
+#
+# HyperLogLog cells keep the highest rank per register, so they merge by maximum
+# and a selection is folded into one set of registers per group at query time; the
+# quantile cells merge by adding counts (Cube.merge). Distinct counts are within
+# sketches.HLL_ERROR (one standard error) of the exact ones and percentiles within
+# sketches.ACCURACY; ERRORS carries both for display. Ids are hashed as their hex
+# strings, so every backend builds the same registers from the same rows.
+
+# headline KPI: (table, id column)
+TABLE_KPIS = {
+    "total_products": ("PRODUCTS", "product_id"),
+    "total_sellers": ("SELLERS", "seller_id"),
+    "total_customers": ("CUSTOMERS", "customer_id"),
+    "total_orders": ("ORDERS", "order_id"),
+}
+ITEM_IDS = ["order_id", "customer_id", "seller_id", "product_id"]
+ORDER_IDS = ["order_id", "customer_id"]
+# day: timeseries.period_codes(order_purchase_timestamp, "day")
+CELL_DIMS = ["customer_state", "order_status", "seller_state", "product_category_name", "day"]
+ORDER_DIMS = ["customer_state", "order_status", "day"]
+VALUES = ["price", "payment"]
+QUANTILES = [0.5, 0.95, 0.99]
+QUANTILE_COLUMNS = [f"p{round(q * 100)}" for q in QUANTILES]
+ERRORS = {"distinct": sketches.HLL_ERROR, "percentile": sketches.ACCURACY}
+
+Sketches = namedtuple("Sketches", ["tables", "orders", "items", "values"])
+
+
+def registers(hashes):
+    # Dense HyperLogLog registers of a set of hashes
+    register, rank = sketches.hll_cells(hashes)
+    dense = np.zeros(sketches.REGISTERS, dtype=np.int8)
+    np.maximum.at(dense, register, rank)
+    return dense
+
+
+def _distinct_cube(rows, dims, columns):
+    # HyperLogLog cells (dims, measure, register) -> highest rank of the hashes in
+    # `columns` of each row, measure telling which column
+    keys = rows[dims].reset_index(drop=True)
+    cells = keys.iloc[np.tile(np.arange(len(rows)), len(columns))].reset_index(drop=True)
+    register, rank = sketches.hll_cells(np.concatenate([rows[column].to_numpy() for column in columns]))
+    cells = cells.assign(measure=np.repeat(np.arange(len(columns), dtype=np.int8), len(rows)),
+                         register=register, rank=rank)
+    return cube.Cube.build(cells, [*dims, "measure", "register"], {"rank": ("rank", "max")})
+
+
+def build(table_hashes, orders, items):
+    # Sketches of a set of rows. table_hashes: {TABLE_KPIS entry: hashes of the ids of
+    # the rows counted} for the tables present; orders: ORDER_DIMS and the ORDER_IDS
+    # hashes of each order; items: CELL_DIMS, the ITEM_IDS hashes and the VALUES of each
+    # order item (payment NaN when unpaid)
+    keys = items[CELL_DIMS].reset_index(drop=True)
+    # one row per item and value, the measure telling which
+    values = np.concatenate([items[value].to_numpy(dtype="float64") for value in VALUES])
+    measure = np.repeat(np.arange(len(VALUES), dtype=np.int8), len(items))
+    known = np.flatnonzero(~np.isnan(values))
+    value_cells = keys.iloc[known % len(items)].reset_index(drop=True).assign(
+        measure=measure[known], bucket=sketches.bucket_codes(values[known]))
+    return Sketches(
+        tables={kpi: registers(hashes) for kpi, hashes in table_hashes.items()},
+        orders=_distinct_cube(orders, ORDER_DIMS, ORDER_IDS),
+        items=_distinct_cube(items, CELL_DIMS, ITEM_IDS),
+        values=cube.Cube.build(value_cells, [*CELL_DIMS, "measure", "bucket"], {"count": ("bucket", "count")}),
+    )
+
+
+def _merge_distinct(a, b):
+    if not len(b.cells) or not len(a.cells):
+        return a if len(a.cells) else b
+    cells = (concat_tables([a.cells, b.cells])
+             .groupby(a.dims, observed=True, dropna=False, sort=True)["rank"].max().reset_index())
+    return cube.Cube(cells, a.dims, a.measures)
+
+
+def merge(a, b):
+    # Sketches of the rows of both; b may count rows of only some TABLE_KPIS tables, and
+    # a set of cells empty on one side is taken from the other as it is
+    tables = dict(a.tables)
+    for kpi, dense in b.tables.items():
+        tables[kpi] = np.maximum(tables[kpi], dense) if kpi in tables else dense
+    values = a.values.merge(b.values) if len(a.values.cells) and len(b.values.cells) else (
+        a.values if len(a.values.cells) else b.values)
+    return Sketches(tables, _merge_distinct(a.orders, b.orders), _merge_distinct(a.items, b.items), values)
+
+
+def _mask(cells, days=None, *wheres):
+    # Cells with a day within days (first, last day code; None for all) and, for every
+    # {dim: values} of wheres, one of the values (None for any)
+    mask = np.ones(len(cells), dtype=bool)
+    if days is not None:
+        day = cells["day"].to_numpy()
+        mask &= (day >= days[0]) & (day <= days[1])
+    for where in wheres:
+        for dim, values in (where or {}).items():
+            if values is not None:
+                mask &= cells[dim].isin(values if pd.api.types.is_list_like(values) else [values]).to_numpy()
+    return mask
+
+
+def _order_cells(approx, where=None, days=None):
+    # (cells, the ids they count) of the orders passing a selection: the order cells, or
+    # under an item dimension the cells of the items passing
+    if any(dim not in ORDER_DIMS for dim in where or {}):
+        cells, ids = approx.items.cells, ITEM_IDS
+    else:
+        cells, ids = approx.orders.cells, ORDER_IDS
+    return cells[_mask(cells, days, where)], ids
+
+
+def _estimates(cells, n_measures):
+    return sketches.distinct(cells["register"].to_numpy(), cells["rank"].to_numpy(), cells["measure"].to_numpy(),
+                             n_measures)
+
+
+# --- Queries ---
+#
+# where: {cell dimension: values} and days: (first, last) day code select the rows
+# passing a global filter (filters.cells); None for all rows.
+
+def overview_kpis(approx, where=None, days=None):
+    # Estimated TABLE_KPIS counts: of the tables' rows, or under a selection of the
+    # products and sellers of the items and the customers and orders passing it
+    if not where and days is None:
+        return {kpi: int(np.round(sketches.hll_estimate(dense))) for kpi, dense in approx.tables.items()}
+    items = dict(zip(ITEM_IDS, _estimates(approx.items.cells[_mask(approx.items.cells, days, where)],
+                                          len(ITEM_IDS))))
+    cells, ids = _order_cells(approx, where, days)
+    orders = dict(zip(ids, _estimates(cells, len(ids))))
+    counts = {"total_products": items["product_id"], "total_sellers": items["seller_id"],
+              "total_customers": orders["customer_id"], "total_orders": orders["order_id"]}
+    return {kpi: int(np.round(counts[kpi])) for kpi in TABLE_KPIS}
+
+
+def distinct_counts(approx, customer_state=None, category=None, where=None, days=None):
+    # Estimated distinct ITEM_IDS among the items of one customer state and/or category
+    cells = approx.items.cells
+    cells = cells[_mask(cells, days, where, {"customer_state": customer_state, "product_category_name": category})]
+    return {column: int(round(estimate)) for column, estimate in zip(ITEM_IDS, _estimates(cells, len(ITEM_IDS)))}
+
+
+def value_percentiles(approx, customer_state=None, category=None, where=None, days=None):
+    # Items and QUANTILES of each of VALUES (one row per value) in one customer state and/or category
+    cells = approx.values.cells
+    cells = cells[_mask(cells, days, where, {"customer_state": customer_state, "product_category_name": category})]
+    quantiles, total = sketches.quantiles(cells["bucket"].to_numpy(), cells["count"].to_numpy(),
+                                          cells["measure"].to_numpy(), len(VALUES), QUANTILES)
+    return pd.DataFrame({"value": VALUES, "items": total, **dict(zip(QUANTILE_COLUMNS, quantiles.T))})
+
+
+def state_year_orders(approx, top=10, where=None, days=None):
+    # Estimated orders per year of the `top` customer states with the most orders, as
+    # (customer_state, Purchased_Year, order_id) rows; ties go to the first state by name
+    cells, ids = _order_cells(approx, where, days)
+    cells = cells[cells["measure"].to_numpy() == ids.index("order_id")]
+    states, names = pd.factorize(cells["customer_state"].astype(object), sort=True)
+    register, rank = cells["register"].to_numpy(), cells["rank"].to_numpy()
+    has_state = states >= 0
+    per_state = sketches.distinct(register[has_state], rank[has_state], states[has_state], len(names))
+    chosen = np.argsort(-np.round(per_state), kind="stable")[:top]
+
+    day = cells["day"].to_numpy()
+    days, day_index = np.unique(day, return_inverse=True)
+    year = np.where(days >= 0, timeseries.period_start(np.maximum(days, 0), "day").year, -1)[day_index]
+    keep = np.isin(states, chosen) & (year >= 0)
+    first_year = year[keep].min() if keep.any() else 0
+    years = year[keep].max() - first_year + 1 if keep.any() else 1
+    groups = states[keep] * years + (year[keep] - first_year)
+    estimates = sketches.distinct(register[keep], rank[keep], groups, len(names) * years)
+    present = np.unique(groups)
+    return pd.DataFrame({
+        "customer_state": np.asarray(names)[present // years],
+        "Purchased_Year": (present % years + first_year).astype(np.int64),
+        "order_id": np.round(estimates[present]).astype(np.int64),
+    })
@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import analytics
+import data_loader
+import fact_table
+import filters
+import rfm
+import synthetic_data
+
+# Times and peak memory for loading, building the fact tables and every panel's
+# computation, over synthetic data at several scale factors.
+#
+#     python benchmark.py --scales 1 10 100 --out bench_results.json
+#     python benchmark.py --scales 1 10 --compare bench_results.json
+#
+# Peak memory is the tracemalloc high-water mark of each step (numpy/pandas buffers
+# included, Arrow-backed string buffers are not) plus the process max RSS at the end.
+
+
+def _panels(model, rankings):
+    tables = model.tables
+    region = analytics.region_options(tables["SELLERS"])[0]
+    category = analytics.category_options(model.item_fact)[0]
+    return {
+        "overview_kpis": lambda: analytics.overview_kpis(tables),
+        "category_revenue": lambda: analytics.category_revenue(model.item_cube),
+        "region_category_revenue": lambda: analytics.region_category_revenue(model.item_cube, region),
+        "new_customers_by_period": lambda: analytics.new_customers_by_period(model.new_customers),
+        "review_histogram": lambda: analytics.review_histogram(model.review_counts),
+        "payment_mix": lambda: analytics.payment_mix(model.payment_counts),
+        "delivery_accuracy": lambda: analytics.delivery_accuracy(tables["ORDERS"]),
+        "seller_segmentation": lambda: analytics.segment_counts(
+            analytics.seller_revenue(model.seller_totals, tables["SELLERS"]), "Payment Value Group"),
+        "customer_segmentation": lambda: analytics.segment_counts(
+            analytics.customer_revenue(model.customer_totals, tables["CUSTOMERS"]), "Payment Group"),
+        "rfm_segments": lambda: analytics.rfm_segments(rfm.assign(model.rfm)),
+        "top_regions": lambda: analytics.top_regions(rankings, category),
+        "product_metrics": lambda: analytics.product_metrics(model.item_cube, category),
+        "top_sellers": lambda: analytics.top_k(rankings, "seller"),
+        "top_customers": lambda: analytics.top_k(rankings, "customer"),
+        "state_year_orders": lambda: analytics.state_year_orders(model.order_cube),
+        "cohorts": lambda: analytics.cohorts(model.activity),
+        "cohorts_category": lambda: analytics.cohorts(model.activity, category),
+        "delivery_percentiles": lambda: analytics.delivery_percentiles(
+            model.delivery, tables["SELLERS"], "lateness", "month"),
+        "delivery_percentiles_seller": lambda: analytics.delivery_percentiles(
+            model.delivery, tables["SELLERS"], "shipping", "seller", seller_state=region),
+        "delivery_compliance": lambda: analytics.delivery_compliance(model.delivery),
+        "approximate_kpis": lambda: analytics.approximate_kpis(model.approximate, 0.0),
+        "approximate_counts": lambda: analytics.approximate_counts(model.approximate, category=category),
+        "value_percentiles": lambda: analytics.value_percentiles(model.approximate, category=category),
+        "approximate_state_year_orders": lambda: analytics.approximate_state_year_orders(model.approximate),
+    }
+
+
+def measure(fn, repeat=3):
+    # (result of the last call, {"seconds": median wall time, "min_seconds", "peak_mb"}).
+    # tracemalloc slows allocation-heavy code down a lot, so the timed runs are
+    # untraced and the memory peak comes from one extra traced run.
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {
+        "seconds": round(statistics.median(times), 6),
+        "min_seconds": round(min(times), 6),
+        "peak_mb": round(peak / 2**20, 3),
+    }
+
+
+def run_scale(scale, seed=0, repeat=3):
+    report = {"scale": scale, "steps": {}, "panels": {}}
+    with tempfile.TemporaryDirectory() as data_dir:
+        tables = synthetic_data.generate(scale, seed)
+        synthetic_data.write_csvs(tables, data_dir)
+        report["rows"] = {name: len(df) for name, df in tables.items()}
+        del tables
+        snapshot_dir = os.path.join(data_dir, data_loader.SNAPSHOT_DIR)
+
+        steps = report["steps"]
+        _, steps["load_csv"] = measure(lambda: {
+            name: data_loader.read_table(name, os.path.join(data_dir, f"{name}.csv"))
+            for name in data_loader.TABLE_ORDER}, repeat)
+        # cold: parse and write a fresh snapshot every call
+        _, steps["load_data_cold"] = measure(
+            lambda: data_loader.load_tables(data_dir, tempfile.mkdtemp(dir=data_dir)), 1)
+        data_loader.load_tables(data_dir, snapshot_dir)
+        tables, steps["load_data_snapshot"] = measure(lambda: data_loader.load_tables(data_dir, snapshot_dir), repeat)
+
+        _, steps["merged_df"] = measure(lambda: fact_table.build_fact_tables(
+            tables["ORDERS"], tables["ORDER_ITEMS"], tables["CUSTOMERS"],
+            tables["PRODUCTS"], tables["SELLERS"], tables["ORDER_REVIEW_RATINGS"]), repeat)
+        model, steps["prepare"] = measure(lambda: analytics.prepare(tables), repeat)
+        _, steps["delivery_sketch"] = measure(lambda: analytics.delivery_sketch(model.item_fact), repeat)
+        _, steps["approximate_sketches"] = measure(lambda: analytics.approximate_sketches(
+            model.tables, model.item_fact, model.order_fact, model.tables["ORDER_PAYMENTS"], model.tables["PRODUCTS"],
+            model.tables["SELLERS"], model.ids), repeat)
+        index, steps["filter_index"] = measure(lambda: filters.FilterIndex.build(model.item_fact, model.order_fact), repeat)
+        state = index.options("seller_state")[0]
+        masks, steps["filter_masks"] = measure(lambda: index.masks(filters.Filters(seller_state=(state,))), repeat)
+        # the restricted Model is built as panels read it: time its item fact and cube
+        _, steps["filter_restrict"] = measure(lambda: analytics.restrict(model, *masks).item_cube, repeat)
+        _, steps["filter_approximate_kpis"] = measure(lambda: analytics.approximate_kpis(
+            model.approximate, 0.0, *filters.cells(filters.Filters(seller_state=(state,)))), repeat)
+        rankings, steps["rankings"] = measure(lambda: analytics.rankings(
+            model.item_cube, model.seller_totals, tables["SELLERS"], model.customer_totals, tables["CUSTOMERS"]), repeat)
+
+        for name, fn in _panels(model, rankings).items():
+            _, report["panels"][name] = measure(fn, repeat)
+    return report
+
+
+def compare(current, baseline, threshold):
+    # Steps/panels whose median time grew by more than `threshold` (a fraction) against the baseline
+    regressions = []
+    old_runs = {run["scale"]: run for run in baseline["runs"]}
+    for run in current["runs"]:
+        old = old_runs.get(run["scale"])
+        if old is None:
+            continue
+        for section in ("steps", "panels"):
+            for name, stats in run[section].items():
+                before = old[section].get(name)
+                if before and stats["seconds"] > before["seconds"] * (1 + threshold):
+                    regressions.append({
+                        "scale": run["scale"], "name": name,
+                        "before": before["seconds"], "after": stats["seconds"],
+                    })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard computations on synthetic data")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="previous report to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown fraction that counts as a regression (default 0.2)")
+    args = parser.parse_args()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "runs": [],
+    }
+    for scale in args.scales:
+        run = run_scale(scale, args.seed, args.repeat)
+        report["runs"].append(run)
+        print(f"scale {scale:g}: {run['rows']['ORDER_ITEMS']:,} order items")
+        for section in ("steps", "panels"):
+            for name, stats in run[section].items():
+                print(f"  {name:<28} {stats['seconds'] * 1000:10.2f} ms {stats['peak_mb']:10.2f} MB")
+    report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            report["regressions"] = compare(report, json.load(f), args.threshold)
+        for reg in report["regressions"]:
+            print(f"REGRESSION scale {reg['scale']:g} {reg['name']}: "
+                  f"{reg['before'] * 1000:.2f} ms -> {reg['after'] * 1000:.2f} ms")
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"wrote {args.out}")
+    if report.get("regressions"):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
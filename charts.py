@@ -0,0 +1,347 @@
+import os
+
+import numpy as np
+
+import cohort
+import delivery
+
+# Plotly figures for the dashboard panels. plotly.express is imported on first
+# use rather than at module import, so loading the analytics (or this module)
+# from a batch job does not pay for it until a figure is actually built.
+#
+# Each function takes a panel's result (backends) and the filter values it shows,
+# so the dashboard can cache the figure per (data version, panel, filters). Line
+# traces over time are capped at MARKET_MAX_POINTS points (downsample) to keep the
+# chart payload small however long the series gets; series over categories are
+# drawn whole, as dropping a point would drop a category.
+#
+# A panel can come back with no rows (a global filter or slice that selects
+# nothing); its chart is then a placeholder figure with a message (no_data) rather
+# than a plotly.express call, which rejects empty data for some traces.
+
+MAX_POINTS = int(os.environ.get("MARKET_MAX_POINTS", "500"))
+NO_DATA = "No data for these filters"
+
+
+def _px():
+    import plotly.express as px
+    return px
+
+
+def is_empty(data):
+    # Whether a panel result has no rows to draw (a (frame, total) pair by its frame)
+    if isinstance(data, tuple):
+        data = data[0]
+    return data is None or len(data) == 0
+
+
+def no_data(message=NO_DATA, height=250):
+    # Placeholder figure: the message in place of a chart, no axes
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    fig.add_annotation(text=message, x=0.5, y=0.5, xref="paper", yref="paper", showarrow=False,
+                       font=dict(size=14, color="grey"))
+    fig.update_layout(xaxis=dict(visible=False), yaxis=dict(visible=False), height=height,
+                      margin=dict(l=0, r=0, t=20, b=0))
+    return fig
+
+
+def downsample(frame, y, max_points=MAX_POINTS):
+    # At most max_points rows of frame, picked by largest-triangle-three-buckets over
+    # (row position, frame[y]) so peaks and dips survive; the first and last rows are kept
+    n = len(frame)
+    if not max_points or max_points < 3 or n <= max_points:
+        return frame
+    values = np.nan_to_num(frame[y].to_numpy(dtype="float64"))
+    # max_points - 2 buckets over the rows between the first and the last
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    keep = [0]
+    for b in range(max_points - 2):
+        start, end = edges[b], edges[b + 1]
+        next_start, next_end = (edges[b + 1], edges[b + 2]) if b + 2 < len(edges) else (n - 1, n)
+        next_x, next_y = (next_start + next_end - 1) / 2, values[next_start:next_end].mean()
+        a = keep[-1]
+        x = np.arange(start, end)
+        area = np.abs((a - next_x) * (values[start:end] - values[a]) - (a - x) * (next_y - values[a]))
+        keep.append(int(start + np.argmax(area)))
+    keep.append(n - 1)
+    return frame.iloc[keep]
+
+
+def category_revenue_bar(product_revenue, top_n):
+    if is_empty(product_revenue):
+        return no_data(height=250)
+    # Filter for top N products if selected, with the title set dynamically
+    filtered_product_revenue = product_revenue.head(top_n)
+    title = f"Top {top_n} Product Categories by Revenue" if top_n < len(product_revenue) else "All Product Categories by Revenue"
+    fig = _px().bar(
+        filtered_product_revenue,
+        x='product_category_name',
+        y='price',
+        labels={'product_category_name': 'Product Category', 'price': 'Revenue'},
+        title=title,
+        color='price',
+        color_continuous_scale='Viridis'
+    )
+
+    # Update layout for compact display and remove text labels
+    fig.update_layout(
+        xaxis=dict(
+            showticklabels=False  # Hide x-axis labels
+        ),
+        xaxis_title="Product Category",
+        yaxis_title="Revenue",
+        xaxis_tickangle=-45,
+        height=250,  # Further reduced height
+        width=500,   # Reduced width for compactness
+        margin=dict(t=20, b=20, l=30, r=30),  # Tight margins
+        title=dict(font=dict(size=12)),  # Reduced title font size
+
+    )
+
+    # Remove text labels on the bars
+    fig.update_traces(texttemplate=None)
+    return fig
+
+
+def region_revenue_line(region_revenue, selected_region):
+    # region_revenue: the categories' revenue and its total (region_category_revenue)
+    if is_empty(region_revenue):
+        return no_data(height=400)
+    region_product_revenue, total_revenue_region = region_revenue
+    fig = _px().line(
+        region_product_revenue,
+        x='product_category_name',
+        y='price',
+        title=f'Product Categories and Revenue in {selected_region}',
+        labels={'product_category_name': 'Product Category', 'price': 'Revenue'},
+        markers=True
+    )
+    # Add annotation for total revenue along the x-axis
+    fig.add_annotation(
+        text=f"Total Revenue in {selected_region}: ${total_revenue_region:,.2f}",
+        x=0.5,  # Centered along the x-axis
+        y=1.3,  # Below the x-axis
+        xref="paper", yref="paper",  # Position relative to the paper space
+        showarrow=False,
+        font=dict(size=12, color="black"),  # Adjust font size and color
+        align="center",
+        bgcolor="rgba(255, 255, 255, 0.8)",  # Semi-transparent background for readability
+        borderwidth=1,
+
+    )
+    # Update layout to hide x-axis labels by default and show them on hover
+    fig.update_layout(
+        xaxis=dict(
+            showticklabels=False,  # Hide x-axis labels by default
+        ),
+        hovermode='x unified',  # Show product names when hovering over the line
+        xaxis_tickangle=-45,
+        height=400,
+        margin=dict(t=120, b=120),  # Increase bottom margin for better label visibility
+    )
+    return fig
+
+
+def new_customers_line(n_cust_in_every_period, granularity="month"):
+    if is_empty(n_cust_in_every_period):
+        return no_data(height=200)
+    fig = _px().line(downsample(n_cust_in_every_period, 'customer_id'), x='period', y='customer_id',
+                     labels={'period': granularity.title(), 'customer_id': 'New Customers'},
+                     markers=True)
+
+    # Customize hover information
+    date_format = '%Y-%m' if granularity in ('month', 'quarter') else '%Y' if granularity == 'year' else '%Y-%m-%d'
+    fig.update_traces(mode='lines+markers', hovertemplate='%{x|' + date_format + '}: %{y} new customers')
+
+    # Adjust size for ultra-compact display
+    fig.update_layout(width=200, height=200, margin=dict(l=5, r=5, t=0, b=5))
+    return fig
+
+
+def review_scores_bar(item_counts):
+    if is_empty(item_counts):
+        return no_data(height=200)
+    fig = _px().bar(
+        x=item_counts.index,
+        y=item_counts.values,
+        labels={"x": "Review", "y": "Freq"},
+        text=item_counts.values,
+        color=item_counts.values,
+        color_continuous_scale="Blues",
+    )
+
+    # Customize layout for ultra-compact display
+    fig.update_traces(texttemplate='%{text}', textposition='outside', marker_line_width=0.5)
+    fig.update_layout(
+        xaxis_title="Score",
+        yaxis_title="Freq",
+        coloraxis_showscale=False,
+        width=200,  # Further reduced width
+        height=200,  # Further reduced height
+        margin=dict(l=5, r=5, t=0, b=5),
+    )
+    return fig
+
+
+def pie(counts, names, title, hole=None):
+    # Payment types, delivery accuracy and the two segmentation doughnuts
+    # counts with no rows or all zero (nothing to split) get the placeholder
+    if is_empty(counts) or not counts['Count'].sum():
+        return no_data(height=300)
+    px = _px()
+    fig = px.pie(counts,
+                 names=names,
+                 values='Count',
+                 title=title,
+                 color=names,
+                 color_discrete_sequence=px.colors.sequential.Plasma)
+    if hole:
+        # Add the hole parameter to convert it into a doughnut chart
+        fig.update_traces(hole=hole)
+    fig.update_layout(height=300, width=300)
+    return fig
+
+
+def top_regions_bar(top_regions, selected_product):
+    if is_empty(top_regions):
+        return no_data(height=350)
+    fig = _px().bar(
+        top_regions,
+        x="Region",
+        y="Revenue",
+        title=f"Top 3 Regions by Revenue for Product Category: {selected_product}",
+        labels={"Revenue": "Revenue ($)", "Region": "Region"},
+        color="Region",
+        height=350  # Adjusted height
+    )
+    fig.update_layout(
+        margin=dict(l=0, r=0, t=30, b=0)
+    )
+    return fig
+
+
+def top_revenue_bar(top, id_column, state_column, title):
+    # Horizontal bars for the Top 3 Sellers / Customers by Revenue
+    if is_empty(top):
+        return no_data(height=180)
+    fig = _px().bar(
+        top,
+        x="payment_value",
+        y=id_column,
+        orientation="h",
+        color=state_column,
+        text="payment_value",  # Show the revenue inside the bar
+        labels={"payment_value": "Revenue", state_column: "State"},
+        title=title,
+    )
+    fig.update_traces(texttemplate='%{text:.2s}', textposition='inside')
+    fig.update_layout(
+        yaxis=dict(title="", showticklabels=False),  # Remove y-axis title to save space
+        xaxis=dict(title="Revenue"),
+        height=180,  # Reduced height
+        margin=dict(l=50, r=50, t=30, b=30),  # Adjusted margins
+        showlegend=False,  # Hide legend if not necessary
+    )
+    return fig
+
+
+def ranking_bar(ranked, key, title):
+    # Horizontal bars of a revenue ranking (backends ranking()), in rank order from the top
+    if is_empty(ranked):
+        return no_data(height=250)
+    fig = _px().bar(
+        ranked,
+        x="Revenue",
+        y=ranked[key].astype(str),
+        orientation="h",
+        text="Rank",
+        hover_data=[col for col in ranked.columns if col not in (key, "Revenue", "Rank")],
+        labels={"y": "", "Revenue": "Revenue ($)"},
+        title=title,
+    )
+    fig.update_traces(texttemplate='#%{text}', textposition='inside')
+    fig.update_layout(
+        yaxis=dict(autorange="reversed", type="category"),
+        height=max(250, 40 + 22 * len(ranked)),
+        margin=dict(l=0, r=0, t=40, b=0),
+        title=dict(font=dict(size=12)),
+    )
+    return fig
+
+
+def cohort_heatmap(cohorts, measure, title):
+    # Cohorts (rows) x months since first purchase (columns), coloured by retention or revenue
+    if is_empty(cohorts):
+        return no_data(height=400)
+    table = cohort.pivot(cohorts, measure)
+    if measure == "retention":
+        table = table * 100
+    fig = _px().imshow(
+        table.to_numpy(),
+        x=[str(age) for age in table.columns],
+        y=table.index.strftime("%Y-%m"),
+        labels={"x": "Months Since First Purchase", "y": "Cohort",
+                "color": "Retention %" if measure == "retention" else "Revenue"},
+        color_continuous_scale="Blues",
+        aspect="auto",
+        title=title,
+    )
+    fig.update_layout(height=400, margin=dict(l=0, r=0, t=40, b=0), title=dict(font=dict(size=12)))
+    return fig
+
+
+def delivery_percentiles_chart(percentiles, title, max_groups=20):
+    # p50/p95/p99 of a delivery metric (backends delivery_percentiles()): lines over
+    # the purchase months, or grouped bars of the max_groups groups with the highest p95
+    if is_empty(percentiles):
+        return no_data("No delivered shipments", height=350)
+    px = _px()
+    key, quantiles = percentiles.columns[0], delivery.QUANTILE_COLUMNS
+    labels = {"value": "Days", "variable": "Percentile", key: ""}
+    if key == "month":
+        fig = px.line(percentiles, x=key, y=quantiles, markers=True, labels=labels, title=title,
+                      hover_data={"shipments": True})
+    else:
+        top = percentiles.head(max_groups)
+        fig = px.bar(top, x=top[key].astype(str), y=quantiles, barmode="group", labels={**labels, "x": ""},
+                     title=title, hover_data={"shipments": True})
+        fig.update_layout(xaxis=dict(type="category"))
+    fig.update_layout(height=350, margin=dict(l=0, r=0, t=40, b=0), title=dict(font=dict(size=12)))
+    return fig
+
+
+def distance_bands_bar(bands):
+    # Average freight per seller-customer distance band, coloured by average delivery time
+    if is_empty(bands):
+        return no_data(height=350)
+    fig = _px().bar(
+        bands,
+        x="Distance",
+        y="Avg Freight",
+        color="Avg Delivery Days",
+        hover_data={"Items": True, "Avg Distance (km)": ":.0f", "Late %": ":.1f"},
+        color_continuous_scale="Viridis",
+        title="Freight and Delivery Time by Seller-Customer Distance",
+    )
+    fig.update_layout(height=350, margin=dict(l=0, r=0, t=40, b=0), title=dict(font=dict(size=12)))
+    return fig
+
+
+def cells_map(cells, title):
+    # One marker per map cell (geo.map_cells), sized by items and coloured by revenue
+    if is_empty(cells):
+        return no_data(height=350)
+    fig = _px().scatter_geo(
+        cells,
+        lat="lat",
+        lon="lng",
+        size="items",
+        color="revenue",
+        hover_data={"lat": ":.2f", "lng": ":.2f", "items": True, "revenue": ":,.0f"},
+        color_continuous_scale="Plasma",
+        title=title,
+    )
+    fig.update_geos(fitbounds="locations", showcountries=True)
+    fig.update_layout(height=350, margin=dict(l=0, r=0, t=40, b=0), title=dict(font=dict(size=12)))
+    return fig
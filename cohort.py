@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+import cube
+import timeseries
+
+# Cohort retention and revenue by months since first purchase.
+#
+# Every customer_unique_id belongs to the cohort of the month of its first purchase
+# among the selected items (all of them, or one category and/or customer state), and
+# each later month it buys again in adds to the cell (cohort, months since first
+# purchase). The panels work from an activity frame built once per data version:
+# order items summed per (customer, month, category, customer state), with customers
+# as integer codes and months as month codes (timeseries.py). A filter is then a
+# boolean mask over those rows, and the matrix one pass of array operations: the
+# first month per customer with minimum.at, the distinct (cell, customer) pairs with
+# np.unique and the cell sums with bincount, with no loop over cohorts.
+#
+# Orders without items (and items without a purchase date) are not part of any cohort.
+
+ACTIVITY_KEYS = ["customer", "month", "product_category_name", "customer_state"]
+MEASURES = ["retention", "revenue"]
+
+
+def activity(customer, item_fact):
+    # Items summed per ACTIVITY_KEYS; customer: the unique customer code of each item row
+    frame = pd.DataFrame({
+        "customer": customer,
+        "month": cube.month_code(item_fact["order_purchase_timestamp"]),
+        "product_category_name": item_fact["product_category_name"],
+        "customer_state": item_fact["customer_state"],
+        "revenue": item_fact["price"],
+    })
+    frame = frame[frame["month"] >= 0]
+    return frame.groupby(ACTIVITY_KEYS, observed=True, sort=False)["revenue"].sum().reset_index()
+
+
+def add_activity(activity_rows, delta):
+    # Activity frames of two sets of items; rows for the same keys are summed when the
+    # matrix is built, so they can simply be stacked
+    if activity_rows is None:
+        return delta
+    return pd.concat([activity_rows, delta], ignore_index=True)
+
+
+def matrix(activity_rows, category=None, customer_state=None):
+    # One row per (cohort, months_since_first) cell: cohort (month start), customers
+    # buying in that month, their revenue and the share of the cohort they are
+    mask = np.ones(len(activity_rows), dtype=bool)
+    if category is not None:
+        mask &= (activity_rows["product_category_name"] == category).to_numpy()
+    if customer_state is not None:
+        mask &= (activity_rows["customer_state"] == customer_state).to_numpy()
+    customer = activity_rows["customer"].to_numpy()[mask].astype(np.int64)
+    month = activity_rows["month"].to_numpy()[mask].astype(np.int64)
+    revenue = np.nan_to_num(activity_rows["revenue"].to_numpy(dtype="float64")[mask])
+    if not len(customer):
+        return pd.DataFrame({"cohort": pd.DatetimeIndex([]), "months_since_first": np.array([], dtype=np.int64),
+                             "customers": np.array([], dtype=np.int64), "revenue": np.array([]),
+                             "retention": np.array([])})
+
+    first = np.full(customer.max() + 1, month.max(), dtype=np.int64)
+    np.minimum.at(first, customer, month)
+    base, span = month.min(), month.max() - month.min() + 1
+    # cell code: (cohort - base) * span + months since first purchase
+    cell = (first[customer] - base) * span + (month - first[customer])
+    cells = span * span
+    distinct = np.unique(cell * (customer.max() + 1) + customer) // (customer.max() + 1)
+    customers = np.bincount(distinct, minlength=cells)
+    revenue = np.bincount(cell, weights=revenue, minlength=cells)
+
+    present = np.flatnonzero(customers)
+    cohort, age = present // span, present % span
+    size = customers[cohort * span]
+    return pd.DataFrame({
+        "cohort": timeseries.period_start(cohort + base, "month"),
+        "months_since_first": age,
+        "customers": customers[present],
+        "revenue": revenue[present],
+        "retention": customers[present] / size,
+    })
+
+
+def pivot(cohorts, measure="retention"):
+    # The cohorts x months-since-first-purchase table of one measure
+    return cohorts.pivot(index="cohort", columns="months_since_first", values=measure)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+import timeseries
+from data_loader import concat_tables
+
+# Small pre-aggregated cube: the fact rows are summed once per data version into
+# cells over a few categorical dimensions, and every dashboard query is then a
+# slice + roll-up over those cells instead of a scan of the order items.
+
+ITEM_DIMS = ["product_category_name", "seller_state", "customer_state", "month"]
+ORDER_DIMS = ["customer_state", "month"]
+
+
+def month_code(timestamps):
+    # Months since year 0 (year * 12 + month - 1); -1 where the timestamp is missing
+    return timeseries.period_codes(timestamps, "month")
+
+
+def month_year(code):
+    return np.asarray(code) // 12
+
+
+class Cube:
+    def __init__(self, cells, dims, measures):
+        self.cells = cells
+        self.dims = dims
+        self.measures = measures
+
+    @classmethod
+    def build(cls, df, dims, measures):
+        # measures: {output name: (column, "sum" | "count" | "nunique")}
+        cells = (
+            df.groupby(dims, observed=True, dropna=False, sort=True)
+            .agg(**{name: spec for name, spec in measures.items()})
+            .reset_index()
+        )
+        return cls(cells, dims, list(measures))
+
+    def slice(self, where=None):
+        # Cells matching every {dim: value} (a value may also be a list of values)
+        cells = self.cells
+        if not where:
+            return cells
+        mask = np.ones(len(cells), dtype=bool)
+        for dim, value in where.items():
+            if pd.api.types.is_list_like(value):
+                mask &= cells[dim].isin(value).to_numpy()
+            else:
+                mask &= (cells[dim] == value).to_numpy()
+        return cells[mask]
+
+    def query(self, by, where=None):
+        # Roll the (sliced) cube up to the given dimensions
+        cells = self.slice(where)
+        return cells.groupby(by, observed=True, sort=True)[self.measures].sum().reset_index()
+
+    def total(self, where=None):
+        return self.slice(where)[self.measures].sum()
+
+    def merge(self, other):
+        # Cube with the cells of both added up; `other` may carry a subset of the
+        # measures. Only valid for measures that add up across the two, e.g. distinct
+        # order counts when the cubes cover disjoint sets of orders.
+        cells = concat_tables([self.cells, other.cells.reindex(columns=self.cells.columns)])
+        cells = (
+            cells.fillna({name: 0 for name in self.measures})
+            .groupby(self.dims, observed=True, dropna=False, sort=True)[self.measures].sum()
+            .astype(self.cells[self.measures].dtypes)
+            .reset_index()
+        )
+        return Cube(cells, self.dims, self.measures)
+
+
+def build_item_cube(item_fact):
+    # revenue, item count, distinct orders and review totals per
+    # (category, seller_state, customer_state, month). order_count is exact per cell
+    # and when rolling up over customer_state/month (order attributes); summed over
+    # categories or seller states an order with several of them is counted once each.
+    df = item_fact[["product_category_name", "seller_state", "customer_state",
+                    "order_key", "price", "review_score_sum", "review_count"]].assign(
+        month=month_code(item_fact["order_purchase_timestamp"]))
+    return Cube.build(df, ITEM_DIMS, {
+        "revenue": ("price", "sum"),
+        "item_count": ("price", "count"),
+        "order_count": ("order_key", "nunique"),
+        "review_score_sum": ("review_score_sum", "sum"),
+        "review_count": ("review_count", "sum"),
+    })
+
+
+def build_order_cube(order_fact):
+    # Orders per (customer_state, month), including orders without items
+    df = order_fact[["customer_state", "order_key"]].assign(
+        month=month_code(order_fact["order_purchase_timestamp"]))
+    return Cube.build(df, ORDER_DIMS, {"order_count": ("order_key", "nunique")})
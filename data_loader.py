@@ -0,0 +1,469 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Table schemas (see details.txt). Ids stay strings, timestamps are parsed to
+# datetime64 and low-cardinality text (states, cities, categories) is categorical.
+# GEO_LOCATION also carries lat/lng in the export even though details.txt omits them.
+SCHEMA = {
+    "ORDERS": {
+        "order_id": "str",
+        "customer_id": "str",
+        "order_status": "category",
+        "order_purchase_timestamp": "datetime",
+        "order_approved_at": "datetime",
+        "order_delivered_carrier_date": "datetime",
+        "order_delivered_customer_date": "datetime",
+        "order_estimated_delivery_date": "datetime",
+    },
+    "ORDER_ITEMS": {
+        "order_id": "str",
+        "order_item_id": "int16",
+        "product_id": "str",
+        "seller_id": "str",
+        "shipping_limit_date": "datetime",
+        "price": "float64",
+        "freight_value": "float64",
+    },
+    "CUSTOMERS": {
+        "customer_id": "str",
+        "customer_unique_id": "str",
+        "customer_zip_code_prefix": "int32",
+        "customer_city": "category",
+        "customer_state": "category",
+    },
+    "PRODUCTS": {
+        "product_id": "str",
+        "product_category_name": "category",
+        "product_name_lenght": "float32",
+        "product_description_lenght": "float32",
+        "product_photos_qty": "float32",
+        "product_weight_g": "float32",
+        "product_length_cm": "float32",
+        "product_height_cm": "float32",
+        "product_width_cm": "float32",
+    },
+    "SELLERS": {
+        "seller_id": "str",
+        "seller_zip_code_prefix": "int32",
+        "seller_city": "category",
+        "seller_state": "category",
+    },
+    "ORDER_PAYMENTS": {
+        "order_id": "str",
+        "payment_sequential": "int16",
+        "payment_type": "category",
+        "payment_installments": "int16",
+        "payment_value": "float64",
+    },
+    "ORDER_REVIEW_RATINGS": {
+        "review_id": "str",
+        "order_id": "str",
+        "review_score": "int8",
+        "review_creation_date": "datetime",
+        "review_answer_timestamp": "datetime",
+    },
+    "GEO_LOCATION": {
+        "geolocation_zip_code_prefix": "int32",
+        "geolocation_lat": "float64",
+        "geolocation_lng": "float64",
+        "geolocation_city": "category",
+        "geolocation_state": "category",
+    },
+}
+
+# Order in which the tables are loaded and fingerprinted; the data version combines their hashes in this order
+TABLE_ORDER = [
+    "ORDERS", "ORDER_ITEMS", "CUSTOMERS", "PRODUCTS",
+    "SELLERS", "ORDER_PAYMENTS", "ORDER_REVIEW_RATINGS", "GEO_LOCATION",
+]
+
+# Tables that take appended batches (append_batch); the others only change by replacing the CSV
+APPEND_TABLES = ["ORDERS", "ORDER_ITEMS", "CUSTOMERS", "ORDER_PAYMENTS", "ORDER_REVIEW_RATINGS"]
+
+SNAPSHOT_DIR = os.environ.get("MARKET_SNAPSHOT_DIR", ".snapshot")
+MANIFEST = "manifest.json"
+# Appended batches are kept as separate Parquet parts until a table has this many,
+# then load_tables folds them into the table's snapshot
+MAX_PARTS = int(os.environ.get("MARKET_MAX_PARTS", "16"))
+
+# Parallel loading (load_tables): the pool the tables, snapshot parts and CSV chunks
+# are read in ("thread" or "process") and its size. CSVs larger than CHUNK_BYTES are
+# split into line-aligned byte ranges of about that size and parsed concurrently;
+# the exports have no quoted newlines, so a line is always a row.
+LOAD_WORKERS = int(os.environ.get("MARKET_LOAD_WORKERS", "0")) or min(8, os.cpu_count() or 1)
+LOAD_POOL = os.environ.get("MARKET_LOAD_POOL", "thread")
+CHUNK_BYTES = int(os.environ.get("MARKET_CHUNK_BYTES", str(32 << 20)))
+
+
+def read_table(name, path=None, chunksize=None, columns=None):
+    # Parse one CSV against its declared schema, optionally only `columns`; with
+    # chunksize, an iterator of DataFrames of that many rows (categories are then per chunk)
+    path = path or f"{name}.csv"
+    dtypes, dates = _csv_types(name, columns)
+    reader = pd.read_csv(path, dtype=dtypes, usecols=columns, chunksize=chunksize)
+    if chunksize is None:
+        return _parse_dates(reader, dates)
+    return (_parse_dates(chunk, dates) for chunk in reader)
+
+
+def _csv_types(name, columns=None):
+    # (read_csv dtypes, datetime columns) for the given columns of a table
+    schema = {col: kind for col, kind in SCHEMA[name].items() if columns is None or col in columns}
+    dates = [col for col, kind in schema.items() if kind == "datetime"]
+    return {col: "str" if kind == "datetime" else kind for col, kind in schema.items()}, dates
+
+
+def _parse_dates(df, dates):
+    for col in dates:
+        df[col] = pd.to_datetime(df[col], format="ISO8601", errors="coerce")
+    return df
+
+
+def csv_ranges(path, chunk_bytes=CHUNK_BYTES):
+    # (start, end) byte offsets of the rows of a CSV (after its header) in pieces of
+    # about chunk_bytes, each starting at the beginning of a line
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        starts = [len(f.readline())]
+        while starts[-1] + chunk_bytes < size:
+            f.seek(starts[-1] + chunk_bytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            starts.append(f.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def read_range(name, path, start, end, columns=None):
+    # Parse the rows in bytes [start, end) of a CSV (see csv_ranges)
+    with open(path, "rb") as f:
+        header = f.readline()
+        f.seek(start)
+        data = f.read(end - start)
+    dtypes, dates = _csv_types(name, columns)
+    df = pd.read_csv(io.BytesIO(header + data), dtype=dtypes, usecols=columns)
+    return _parse_dates(df, dates)
+
+
+def read_chunks(name, path=None, columns=None, workers=LOAD_WORKERS, pool=LOAD_POOL, progress=None,
+                chunk_bytes=None):
+    # Iterator over a CSV's csv_ranges() parsed in a pool, in file order, with at most
+    # `workers` chunks read ahead (categories are per chunk, as with read_table's chunksize)
+    path = path or f"{name}.csv"
+    ranges = csv_ranges(path, chunk_bytes or CHUNK_BYTES)
+    executor = ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor
+    with executor(max_workers=max(1, workers)) as ex:
+        pending = []
+        rows, seconds = 0, 0.0
+        for i in range(len(ranges)):
+            while len(pending) < max(1, workers) and i + len(pending) < len(ranges):
+                start, end = ranges[i + len(pending)]
+                pending.append(ex.submit(_timed, read_range, name, path, start, end, columns))
+            df, took = pending.pop(0).result()
+            rows, seconds = rows + len(df), seconds + took
+            if progress is not None:
+                progress(name, i + 1, len(ranges), rows, seconds)
+            yield df
+
+
+def _read_parquet(path, columns=None):
+    return pd.read_parquet(path, columns=columns)
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    df = fn(*args)
+    return df, time.perf_counter() - start
+
+
+def _sort_categories(df):
+    # Categories in sorted order, as a single read_csv gives them, after a concat of CSV chunks
+    categorical = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    return df.assign(**{col: df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+                        for col in categorical}) if categorical else df
+
+
+def concat_tables(frames):
+    # Row-wise concat that keeps categorical columns categorical (union of the categories)
+    frames = [df for df in frames if len(df)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+    out = pd.concat(frames, ignore_index=True)
+    for col in frames[0].columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            out[col] = union_categoricals([df[col] for df in frames], ignore_order=True)
+    return out
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_manifest(snapshot_dir):
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(snapshot_dir, manifest):
+    tmp = os.path.join(snapshot_dir, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(snapshot_dir, MANIFEST))
+
+
+def source_fingerprints(data_dir=".", snapshot_dir=None):
+    # (mtime, size, hash) per source CSV. The hash is only recomputed when the
+    # mtime or size moved since the last snapshot, so a warm start is just a stat().
+    snapshot_dir = snapshot_dir or os.path.join(data_dir, SNAPSHOT_DIR)
+    manifest = _read_manifest(snapshot_dir)
+    prints = {}
+    for name in TABLE_ORDER:
+        stat = os.stat(os.path.join(data_dir, f"{name}.csv"))
+        entry = manifest.get(name, {})
+        if entry.get("mtime_ns") == stat.st_mtime_ns and entry.get("size") == stat.st_size:
+            digest = entry["hash"]
+        else:
+            digest = file_hash(os.path.join(data_dir, f"{name}.csv"))
+        prints[name] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "hash": digest}
+    return prints
+
+
+def data_version(data_dir=".", snapshot_dir=None):
+    # Short id for the current set of source files, used to key derived caches
+    return _version(source_fingerprints(data_dir, snapshot_dir))
+
+
+def _version(prints):
+    combined = "".join(prints[name]["hash"] for name in TABLE_ORDER)
+    return hashlib.blake2b(combined.encode(), digest_size=8).hexdigest()
+
+
+def load_tables(data_dir=".", snapshot_dir=None, columns=None, workers=LOAD_WORKERS, pool=LOAD_POOL,
+                progress=None):
+    # Load every table, preferring the Parquet snapshot when the source CSV's
+    # hash matches the one it was built from. Falls back to plain CSV parsing
+    # when pyarrow is not available.
+    #
+    # Snapshot files and CSV chunks of all tables are read concurrently in a pool of
+    # `workers` threads or processes. columns ({table: [column, ...]}) limits what is
+    # read of the listed tables; snapshots are still written with every column.
+    # progress(name, done, total, rows, seconds) is called from the calling thread
+    # each time a piece of table `name` is read: `done` of `total` pieces so far,
+    # with the rows and summed read time of those pieces.
+    snapshot_dir = snapshot_dir or os.path.join(data_dir, SNAPSHOT_DIR)
+    columns = columns or {}
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        # no snapshot to keep complete, so the CSVs can be projected directly
+        return _read_pieces({name: [(read_table, name, os.path.join(data_dir, f"{name}.csv"), None,
+                                     columns.get(name))] for name in TABLE_ORDER}, workers, pool, progress)
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    manifest = _read_manifest(snapshot_dir)
+    prints = source_fingerprints(data_dir, snapshot_dir)
+    pieces, rewrite, parsed = {}, {}, []
+    for name in TABLE_ORDER:
+        parquet_path = os.path.join(snapshot_dir, f"{name}.parquet")
+        entry = manifest.get(name, {})
+        parts = entry.get("parts", [])
+        if entry.get("hash") == prints[name]["hash"] and os.path.exists(parquet_path):
+            compact = len(parts) >= MAX_PARTS
+            # a table about to be rewritten is read whole and projected afterwards
+            read_columns = None if compact else columns.get(name)
+            pieces[name] = [(_read_parquet, path, read_columns) for path in
+                            [parquet_path] + [os.path.join(snapshot_dir, part) for part in parts]]
+            if not compact:
+                prints[name]["parts"] = parts
+                manifest[name] = prints[name]
+                continue
+        else:
+            source = os.path.join(data_dir, f"{name}.csv")
+            pieces[name] = [(read_range, name, source, start, end) for start, end in csv_ranges(source)]
+            parsed.append(name)
+            # the source was replaced, so the batch log no longer leads to it
+            manifest.pop("batches", None)
+        rewrite[name] = parts
+
+    tables = _read_pieces(pieces, workers, pool, progress)
+    for name in parsed:
+        tables[name] = _sort_categories(tables[name])
+    for name, parts in rewrite.items():
+        parquet_path = os.path.join(snapshot_dir, f"{name}.parquet")
+        _write_parquet(tables[name], parquet_path)
+        for part in parts:
+            _remove(os.path.join(snapshot_dir, part))
+        manifest[name] = prints[name]
+        if columns.get(name) is not None:
+            tables[name] = tables[name][columns[name]]
+    _write_manifest(snapshot_dir, manifest)
+    return tables
+
+
+def _read_pieces(pieces, workers, pool, progress):
+    # {name: [(function, *args), ...]} -> {name: the pieces' frames concatenated}, in TABLE_ORDER
+    executor = ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor
+    with executor(max_workers=max(1, workers)) as ex:
+        futures = {ex.submit(_timed, fn, *args): (name, i)
+                   for name, calls in pieces.items() for i, (fn, *args) in enumerate(calls)}
+        frames = {name: [None] * len(calls) for name, calls in pieces.items()}
+        stats = {name: [0, 0, 0.0] for name in pieces}
+        for future in as_completed(futures):
+            name, i = futures[future]
+            frames[name][i], seconds = future.result()
+            stats[name][0] += 1
+            stats[name][1] += len(frames[name][i])
+            stats[name][2] += seconds
+            if progress is not None:
+                progress(name, stats[name][0], len(frames[name]), *stats[name][1:])
+    return {name: concat_tables(frames[name]) for name in TABLE_ORDER if name in frames}
+
+
+def _write_parquet(df, path):
+    df.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# --- Appended batches ---
+#
+# A batch is a directory holding delta CSVs (same name and header as the table) for
+# any of APPEND_TABLES. append_batch appends their rows to the source CSVs, so a
+# plain reload sees them, and stores each delta as a Parquet part next to the table's
+# snapshot instead of rewriting it. The table's content hash is chained over the
+# appended bytes (blake2b(previous hash + batch hash)) rather than rehashing the
+# whole file, and the manifest logs each batch with the data versions before and
+# after it so a consumer holding the older version can apply just the delta
+# (see ingest.py).
+#
+# Appending must not run at the same time as a cold load_tables on the same
+# directory; both rewrite the manifest.
+
+def append_batch(batch_dir, data_dir=".", snapshot_dir=None):
+    # Append the delta CSVs in batch_dir; returns the batch record (None if it held no rows)
+    snapshot_dir = snapshot_dir or os.path.join(data_dir, SNAPSHOT_DIR)
+    prints = source_fingerprints(data_dir, snapshot_dir)
+    manifest = _read_manifest(snapshot_dir)
+    if any(manifest.get(name, {}).get("hash") != prints[name]["hash"] for name in TABLE_ORDER):
+        # parts are only added on top of a current snapshot
+        load_tables(data_dir, snapshot_dir)
+        manifest = _read_manifest(snapshot_dir)
+    batch_id = manifest.get("next_batch", 1)
+
+    deltas = {}
+    for name in APPEND_TABLES:
+        path = os.path.join(batch_dir, f"{name}.csv")
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            header = f.readline()
+        with open(os.path.join(data_dir, f"{name}.csv"), "rb") as f:
+            expected = f.readline()
+        if header.strip() != expected.strip():
+            raise ValueError(f"{path}: header does not match {name}.csv")
+        df = read_table(name, path)
+        if len(df):
+            deltas[name] = (path, df)
+    if not deltas:
+        return None
+
+    parts = {}
+    for name, (path, df) in deltas.items():
+        parts[name] = f"{name}.{batch_id}.parquet"
+        _write_parquet(df, os.path.join(snapshot_dir, parts[name]))
+    for name, (path, df) in deltas.items():
+        source = os.path.join(data_dir, f"{name}.csv")
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as src, open(source, "r+b") as dst:
+            src.readline()
+            dst.seek(0, os.SEEK_END)
+            if dst.tell():
+                dst.seek(-1, os.SEEK_END)
+                if dst.read(1) != b"\n":
+                    dst.write(b"\n")
+            for block in iter(lambda: src.read(1 << 20), b""):
+                digest.update(block)
+                dst.write(block)
+        stat = os.stat(source)
+        entry = manifest[name]
+        manifest[name] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": hashlib.blake2b((entry["hash"] + digest.hexdigest()).encode(), digest_size=16).hexdigest(),
+            "parts": entry.get("parts", []) + [parts[name]],
+        }
+
+    batch = {"id": batch_id, "from": _version(prints), "to": _version(manifest), "parts": parts,
+             "rows": {name: len(df) for name, (path, df) in deltas.items()}}
+    manifest["next_batch"] = batch_id + 1
+    manifest["batches"] = manifest.get("batches", []) + [batch]
+    _write_manifest(snapshot_dir, manifest)
+    return batch
+
+
+def batches_between(start, end, data_dir=".", snapshot_dir=None):
+    # The logged batches leading from data version `start` to `end`, in order, or None
+    # when there is no such chain (or a part was already folded into its snapshot)
+    snapshot_dir = snapshot_dir or os.path.join(data_dir, SNAPSHOT_DIR)
+    manifest = _read_manifest(snapshot_dir)
+    chain, version = [], start
+    for batch in manifest.get("batches", []):
+        if version == end:
+            break
+        if batch["from"] == version:
+            chain.append(batch)
+            version = batch["to"]
+    if version != end:
+        return None
+    for batch in chain:
+        for part in batch["parts"].values():
+            if not os.path.exists(os.path.join(snapshot_dir, part)):
+                return None
+    return chain
+
+
+def load_batch(batch, data_dir=".", snapshot_dir=None):
+    # {table name: the rows a batch appended}
+    snapshot_dir = snapshot_dir or os.path.join(data_dir, SNAPSHOT_DIR)
+    return {name: pd.read_parquet(os.path.join(snapshot_dir, part)) for name, part in batch["parts"].items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the dashboard tables, reporting per-table progress and timings")
+    parser.add_argument("--data-dir", default=".")
+    parser.add_argument("--workers", type=int, default=LOAD_WORKERS)
+    parser.add_argument("--pool", choices=["thread", "process"], default=LOAD_POOL)
+    args = parser.parse_args()
+
+    def report(name, done, total, rows, seconds):
+        print(f"{name:<22} {done:>3}/{total:<3} {rows:>10} rows {seconds:8.3f} s", flush=True)
+
+    start = time.perf_counter()
+    tables = load_tables(args.data_dir, workers=args.workers, pool=args.pool, progress=report)
+    print(f"{sum(map(len, tables.values()))} rows in {len(tables)} tables, "
+          f"{time.perf_counter() - start:.3f} s with {args.workers} {args.pool} workers")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import hashlib
+import importlib
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import analytics
+import cube
+import ids
+
+# Read-only, memory-mapped copy of the analytics Model shared by every process on a host.
+#
+# The Model of a data version is written once to <snapshot>/plane/<version>/: every
+# numeric, datetime and categorical column and every array as an uncompressed .npy
+# file, string columns (the id dictionaries) as Arrow IPC files, and the few small
+# aggregates (value counts) pickled. attach() rebuilds the Model on top of
+# np.load(mmap_mode="r") and pyarrow memory maps without copying a buffer, so any
+# number of server processes, and every session in them, read the same pages of
+# the OS page cache: memory per host stays at one copy of the data however many
+# processes serve it.
+#
+# The mapped arrays are read-only, so a shared frame cannot be modified by accident
+# (numpy raises "assignment destination is read-only"); every derived column is
+# computed when the Model is built (fact_table, analytics.prepare/update) and new
+# frames are made rather than columns added to shared ones.
+#
+# A version is written to a private directory and renamed into place, so processes
+# that build the same version at once each end up attaching the one that got there
+# first. Only the KEEP most recent versions are kept; a process still mapping an
+# older one keeps its pages until it moves on (the files are unlinked, not truncated).
+# Frames are stored without their row labels, which are positions in every Model frame.
+# The directory of a version also carries SCHEMA and the Model's field names, so code
+# with a different Model never attaches a plane written by another.
+
+PLANE_DIR = "plane"
+SCHEMA = "2"  # bump when what a Model field holds changes
+ENABLED = os.environ.get("MARKET_DATA_PLANE", "1") != "0"
+KEEP = int(os.environ.get("MARKET_DATA_PLANE_KEEP", "2"))
+META = "meta.json"
+
+
+def available():
+    # Enabled and pyarrow installed (the id dictionaries are mapped through Arrow)
+    if not ENABLED:
+        return False
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def publish(model, snapshot_dir, version):
+    # Write the model for `version` unless a process already did; returns its directory
+    root = os.path.join(snapshot_dir, PLANE_DIR)
+    final = _directory(snapshot_dir, version)
+    if os.path.exists(os.path.join(final, META)):
+        return final
+    tmp = f"{final}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    meta = _write(model, tmp, "model")
+    with open(os.path.join(tmp, META), "w") as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp, final)
+    except OSError:
+        # another process published this version first
+        shutil.rmtree(tmp, ignore_errors=True)
+    _prune(root, keep=os.path.basename(final))
+    return final
+
+
+def attach(snapshot_dir, version):
+    # The model of `version` mapped from the plane, or None when it was not published
+    path = _directory(snapshot_dir, version)
+    try:
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return _read(meta, path)
+
+
+def _directory(snapshot_dir, version):
+    fields = hashlib.sha1(" ".join(analytics.Model._fields).encode()).hexdigest()[:8]
+    return os.path.join(snapshot_dir, PLANE_DIR, f"{version}-{SCHEMA}-{fields}")
+
+
+def _prune(root, keep):
+    # Remove all but the KEEP most recently published versions (never `keep` itself)
+    versions = sorted((entry for entry in os.scandir(root) if entry.is_dir() and not entry.name.endswith(".tmp")),
+                      key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+    for entry in versions[max(KEEP, 1):]:
+        if entry.name != keep:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+# --- Writing ---
+
+def _write(value, directory, name):
+    # Store value under directory/name*; returns the description _read() rebuilds it from
+    path = os.path.join(directory, name)
+    if isinstance(value, pd.DataFrame):
+        return _write_frame(value, path)
+    if isinstance(value, cube.Cube):
+        return {"type": "cube", "dims": value.dims, "measures": value.measures,
+                "cells": _write_frame(value.cells, path)}
+    if isinstance(value, ids.IdDictionary):
+        _write_strings(pd.Series(value.ids), path + ".arrow")
+        return {"type": "ids"}
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        np.save(path + ".npy", value, allow_pickle=False)
+        return {"type": "array"}
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        os.makedirs(path)
+        return {"type": "dict", "items": {key: _write(item, path, key) for key, item in value.items()}}
+    if isinstance(value, tuple) and hasattr(value, "_fields"):
+        os.makedirs(path)
+        return {"type": "namedtuple", "class": [type(value).__module__, type(value).__qualname__],
+                "items": {field: _write(getattr(value, field), path, field) for field in value._fields}}
+    with open(path + ".pkl", "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return {"type": "pickle"}
+
+
+def _write_frame(df, path):
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        raise ValueError(f"{path}: only frames indexed by row position can be mapped")
+    os.makedirs(path)
+    columns = []
+    for i, col in enumerate(df.columns):
+        series, file = df[col], os.path.join(path, str(i))
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            np.save(file + ".npy", series.cat.codes.to_numpy(), allow_pickle=False)
+            categories = series.cat.categories
+            columns.append({"name": col, "kind": "categorical", "categories": categories.tolist(),
+                            "categories_dtype": str(categories.dtype), "ordered": bool(series.cat.ordered)})
+        elif isinstance(series.dtype, np.dtype) and series.dtype != object:
+            np.save(file + ".npy", series.to_numpy(), allow_pickle=False)
+            columns.append({"name": col, "kind": "array"})
+        elif pd.api.types.is_string_dtype(series.dtype):
+            _write_strings(series, file + ".arrow")
+            columns.append({"name": col, "kind": "strings"})
+        else:
+            raise TypeError(f"{path}: column {col!r} of dtype {series.dtype} cannot be mapped")
+    return {"type": "frame", "rows": len(df), "columns": columns}
+
+
+def _write_strings(series, path):
+    import pyarrow as pa
+    table = pa.table({"values": pa.array(series.astype("str"), type=pa.large_string())})
+    with pa.OSFile(path, "wb") as f, pa.ipc.new_file(f, table.schema) as writer:
+        writer.write_table(table)
+
+
+# --- Attaching ---
+
+def _read(meta, directory, name="model"):
+    path = os.path.join(directory, name)
+    kind = meta["type"]
+    if kind == "frame":
+        return _read_frame(meta, path)
+    if kind == "cube":
+        return cube.Cube(_read_frame(meta["cells"], path), meta["dims"], meta["measures"])
+    if kind == "ids":
+        dictionary = ids.IdDictionary()
+        dictionary.ids = pd.Index(_read_strings(path + ".arrow"), copy=False)
+        return dictionary
+    if kind == "array":
+        return _load(path + ".npy")
+    if kind == "dict":
+        return {key: _read(item, path, key) for key, item in meta["items"].items()}
+    if kind == "namedtuple":
+        module, qualname = meta["class"]
+        cls = getattr(importlib.import_module(module), qualname)
+        return cls(**{field: _read(item, path, field) for field, item in meta["items"].items()})
+    with open(path + ".pkl", "rb") as f:
+        return pickle.load(f)
+
+
+def _read_frame(meta, path):
+    columns = {}
+    for i, column in enumerate(meta["columns"]):
+        file = os.path.join(path, str(i))
+        if column["kind"] == "categorical":
+            dtype = pd.CategoricalDtype(pd.Index(column["categories"], dtype=column["categories_dtype"]),
+                                        ordered=column["ordered"])
+            columns[column["name"]] = pd.Categorical.from_codes(
+                _load(file + ".npy"), dtype=dtype, validate=False)
+        elif column["kind"] == "array":
+            columns[column["name"]] = _load(file + ".npy")
+        else:
+            columns[column["name"]] = _read_strings(file + ".arrow")
+    return pd.DataFrame(columns, index=pd.RangeIndex(meta["rows"]), copy=False)
+
+
+def _load(path):
+    # A plain read-only ndarray over the mapped file (np.memmap results would otherwise
+    # stay memmap subclasses through every pandas and numpy operation)
+    return np.load(path, mmap_mode="r").view(np.ndarray)
+
+
+def _read_strings(path):
+    import pyarrow as pa
+    values = pa.ipc.open_file(pa.memory_map(path)).read_all()["values"]
+    return pd.array(values, dtype=pd.StringDtype("pyarrow", na_value=np.nan))
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+
+import cube
+import sketches
+import timeseries
+
+# Delivery performance: latency and lateness distributions per shipment.
+#
+# A shipment is what one seller sends for one order, i.e. the (order, seller) pairs
+# of the order items; it carries the order's timestamps and the earliest
+# shipping_limit_date of its items. Every METRICS value is a difference of two of
+# those timestamps in days, all computed in one array operation over a shipments x
+# timestamps matrix of epoch seconds, and counted into a quantile sketch
+# (sketches.py) per (metric, seller, seller_state, customer_state, purchase month).
+# The sketches are the cells of a cube.Cube, so batches and partitions are merged
+# with Cube.merge, and p50/p95/p99 of any slice (a seller state, a customer state,
+# both, ...) or per group of a dimension are read from the cells with no pass over
+# the orders. Percentiles are within sketches.ACCURACY of the exact ones (and within
+# sketches.MIN_VALUE days of 0).
+#
+# An order shipped by two sellers counts once in each seller's shipments; orders
+# without items have no shipment. Negative lateness is early: "lateness" below 0 is
+# a delivery before the estimate, "shipping" below 0 a handoff to the carrier before
+# the shipping limit.
+
+# metric: (label, end timestamp, start timestamp)
+METRICS = {
+    "approval": ("Purchase to approval", "order_approved_at", "order_purchase_timestamp"),
+    "handoff": ("Approval to carrier", "order_delivered_carrier_date", "order_approved_at"),
+    "transit": ("Carrier to customer", "order_delivered_customer_date", "order_delivered_carrier_date"),
+    "delivery": ("Purchase to delivery", "order_delivered_customer_date", "order_purchase_timestamp"),
+    "lateness": ("Delivery vs estimate", "order_delivered_customer_date", "order_estimated_delivery_date"),
+    "shipping": ("Carrier handoff vs shipping limit", "order_delivered_carrier_date", "shipping_limit_date"),
+}
+METRIC_NAMES = list(METRICS)
+TIMESTAMPS = list(dict.fromkeys(column for _, end, start in METRICS.values() for column in (end, start)))
+# dimension a panel can group by: (label, sketch column)
+DIMENSIONS = {
+    "month": ("Purchase month", "month"),
+    "seller_state": ("Seller state", "seller_state"),
+    "customer_state": ("Customer state", "customer_state"),
+    "seller": ("Seller", "seller_key"),
+}
+SKETCH_DIMS = ["metric", "seller_key", "seller_state", "customer_state", "month", "bucket"]
+QUANTILES = [0.5, 0.95, 0.99]
+QUANTILE_COLUMNS = [f"p{round(q * 100)}" for q in QUANTILES]
+SECONDS_PER_DAY = 86400
+
+
+def epoch_seconds(timestamps):
+    # Whole seconds since 1970 as float64, NaN where the timestamp is missing
+    values = pd.DatetimeIndex(timestamps).as_unit("ns").to_numpy()
+    seconds = values.astype(np.int64) // 10**9
+    return np.where(np.isnat(values), np.nan, seconds.astype("float64"))
+
+
+def item_shipments(item_fact):
+    # (shipment keys, {timestamp: epoch seconds}) of a fact_table item fact: keys holds
+    # seller_key, seller_state, customer_state and month per (order, seller)
+    order = item_fact["order_key"].to_numpy().astype(np.int64)
+    seller = item_fact["seller_key"].to_numpy().astype(np.int64)
+    pair = order * (seller.max(initial=0) + 1) + seller
+    _, first, shipment = np.unique(pair, return_index=True, return_inverse=True)
+    limit = np.full(len(first), np.nan)
+    np.fmin.at(limit, shipment, epoch_seconds(item_fact["shipping_limit_date"]))
+    rows = item_fact.iloc[first]
+    keys = pd.DataFrame({
+        "seller_key": seller[first].astype(np.int32),
+        "seller_state": rows["seller_state"].reset_index(drop=True),
+        "customer_state": rows["customer_state"].reset_index(drop=True),
+        "month": cube.month_code(rows["order_purchase_timestamp"]),
+    })
+    seconds = {column: epoch_seconds(rows[column]) for column in TIMESTAMPS if column != "shipping_limit_date"}
+    return keys, {**seconds, "shipping_limit_date": limit}
+
+
+def build(keys, seconds):
+    # Sketch cube of shipments: keys as item_shipments() returns them, seconds the
+    # epoch seconds of every TIMESTAMPS column (NaN when missing)
+    stamps = np.column_stack([np.asarray(seconds[column], dtype="float64") for column in TIMESTAMPS])
+    end = [TIMESTAMPS.index(end) for _, end, _ in METRICS.values()]
+    start = [TIMESTAMPS.index(start) for _, _, start in METRICS.values()]
+    days = (stamps[:, end] - stamps[:, start]) / SECONDS_PER_DAY  # shipments x metrics
+    row, metric = np.nonzero(~np.isnan(days))
+    cells = keys.iloc[row].reset_index(drop=True).assign(
+        metric=metric.astype(np.int8), bucket=sketches.bucket_codes(days[row, metric]))
+    return cube.Cube.build(cells, SKETCH_DIMS, {"count": ("bucket", "count")})
+
+
+def _where(seller_state=None, customer_state=None):
+    return {dim: value for dim, value in [("seller_state", seller_state), ("customer_state", customer_state)]
+            if value is not None}
+
+
+def percentiles(sketch, metric, by=None, seller_state=None, customer_state=None):
+    # Shipments and QUANTILES of a metric (in days), overall (one row) or per value of
+    # a DIMENSIONS entry: months in order, other groups highest p95 first
+    if metric not in METRICS:
+        raise ValueError(f"unknown delivery metric {metric!r} (one of {', '.join(METRIC_NAMES)})")
+    cells = sketch.slice({"metric": METRIC_NAMES.index(metric), **_where(seller_state, customer_state)})
+    column = DIMENSIONS[by][1] if by else None
+    if column:
+        values = cells[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # by value rather than category order, which merged cells do not keep sorted
+            values = values.astype(object)
+        groups, uniques = pd.factorize(values, sort=True)
+        keep = groups >= 0
+    else:
+        groups, uniques, keep = np.zeros(len(cells), dtype=np.int64), [None], slice(None)
+    values, total = sketches.quantiles(cells["bucket"].to_numpy()[keep], cells["count"].to_numpy()[keep],
+                                       groups[keep], len(uniques), QUANTILES)
+    frame = pd.DataFrame({"shipments": total, **dict(zip(QUANTILE_COLUMNS, values.T))})
+    if not column:
+        return frame
+    frame.insert(0, column, timeseries.period_start(uniques, "month") if by == "month" else np.asarray(uniques))
+    if by == "month":
+        return frame[frame["month"].notna()].reset_index(drop=True)
+    return frame.sort_values("p95", ascending=False, kind="stable").reset_index(drop=True)
+
+
+def compliance(sketch, seller_state=None, customer_state=None):
+    # Delivered shipments, and the shares of shipments handed to the carrier by the
+    # shipping limit and delivered by the estimated date (of those with both dates)
+    cells = sketch.slice(_where(seller_state, customer_state))
+    metric, bucket, count = (cells[col].to_numpy() for col in ["metric", "bucket", "count"])
+    out = {"delivered": int(count[metric == METRIC_NAMES.index("delivery")].sum())}
+    for name, key in [("within_shipping_limit", "shipping"), ("delivered_by_estimate", "lateness")]:
+        mask = metric == METRIC_NAMES.index(key)
+        n = count[mask].sum()
+        out[name] = count[mask & (bucket <= 0)].sum() / n if n else np.nan
+    return out
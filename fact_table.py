@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+import timeseries
+
+# Denormalized fact tables for the dashboard, built once per data version.
+#
+# Joins are done by position instead of by hashing 32-char ids on every merge:
+# each dimension's id column is turned into an index once, the fact rows look up
+# the row number of their dimension (a dense int32 key) and the wanted columns are
+# gathered with take(). Rows whose key is missing are dropped, matching the inner
+# merges the dashboard used before. With the ids encoded as int32 codes (ids.py)
+# the lookup itself is an array index rather than a hash of the strings.
+#
+# No panel joins tables itself, so there is no join cache in front of these. The
+# merges the panels used to repeat are each read from what is built here once per
+# version: items with their product category and review totals from the item fact,
+# revenue per category/state/month from its cube (cube.py), and payments per item
+# from one allocation pass over it (allocation.py) instead of the items x payments join.
+
+ORDER_COLUMNS = [
+    "order_status", "order_purchase_timestamp", "order_approved_at",
+    "order_delivered_carrier_date", "order_delivered_customer_date",
+    "order_estimated_delivery_date",
+]
+CUSTOMER_COLUMNS = ["customer_unique_id", "customer_zip_code_prefix", "customer_city", "customer_state"]
+PRODUCT_COLUMNS = ["product_category_name"]
+SELLER_COLUMNS = ["seller_zip_code_prefix", "seller_city", "seller_state"]
+
+
+def dense_keys(dim_ids, ids):
+    # Row number of each id in dim_ids (-1 when absent)
+    if pd.api.types.is_integer_dtype(dim_ids) and pd.api.types.is_integer_dtype(ids):
+        dim_ids, ids = np.asarray(dim_ids), np.asarray(ids)
+        # integer id codes (see ids.py): a position table indexed by code instead of a hash lookup
+        size = max(dim_ids.max(initial=0), ids.max(initial=0)) + 1
+        position = np.full(size, -1, dtype=np.int32)
+        rows = np.flatnonzero(dim_ids >= 0)[::-1]
+        position[dim_ids[rows]] = rows  # reversed, so the first row of a repeated id is written last
+        return np.where(ids >= 0, position[np.maximum(ids, 0)], -1).astype(np.int32)
+    index = pd.Index(dim_ids)
+    if not index.is_unique:
+        index = index.drop_duplicates()
+    return index.get_indexer(ids).astype(np.int32)
+
+
+def _gather(dim, keys, columns):
+    return {col: dim[col].take(keys).reset_index(drop=True) for col in columns}
+
+
+def build_order_fact(orders, customers, reviews):
+    # orders ⋈ customers, one row per order, with the order's review totals
+    customer_key = dense_keys(customers["customer_id"], orders["customer_id"])
+    keep = customer_key >= 0
+    orders = orders[keep].reset_index(drop=True)
+    customer_key = customer_key[keep]
+
+    order_key = np.arange(len(orders), dtype=np.int32)
+    review_key = dense_keys(orders["order_id"], reviews["order_id"])
+    has_order = review_key >= 0
+    review_sum = np.bincount(review_key[has_order], weights=reviews["review_score"].to_numpy()[has_order],
+                             minlength=len(orders))
+    review_count = np.bincount(review_key[has_order], minlength=len(orders))
+
+    fact = pd.DataFrame({
+        "order_key": order_key,
+        "order_id": orders["order_id"],
+        "customer_key": customer_key,
+        "customer_id": orders["customer_id"],
+        **{col: orders[col] for col in ORDER_COLUMNS},
+        **_gather(customers, customer_key, CUSTOMER_COLUMNS),
+        "review_score_sum": review_sum,
+        "review_count": review_count.astype(np.int32),
+    })
+    fact["Purchased_Year"] = timeseries.period_codes(fact["order_purchase_timestamp"], "year")
+    return fact
+
+
+def build_item_fact(order_fact, order_items, products, sellers):
+    # order_items ⋈ orders ⋈ products ⋈ customers ⋈ sellers, one row per order item
+    order_key = dense_keys(order_fact["order_id"], order_items["order_id"])
+    product_key = dense_keys(products["product_id"], order_items["product_id"])
+    seller_key = dense_keys(sellers["seller_id"], order_items["seller_id"])
+    keep = (order_key >= 0) & (product_key >= 0) & (seller_key >= 0)
+    items = order_items[keep].reset_index(drop=True)
+    order_key, product_key, seller_key = order_key[keep], product_key[keep], seller_key[keep]
+
+    return pd.DataFrame({
+        "order_key": order_key,
+        "order_item_id": items["order_item_id"],
+        "product_key": product_key,
+        "seller_key": seller_key,
+        "shipping_limit_date": items["shipping_limit_date"],
+        "price": items["price"],
+        "freight_value": items["freight_value"],
+        **_gather(order_fact, order_key, ["customer_key", *ORDER_COLUMNS, *CUSTOMER_COLUMNS,
+                                          "review_score_sum", "review_count"]),
+        **_gather(products, product_key, PRODUCT_COLUMNS),
+        **_gather(sellers, seller_key, SELLER_COLUMNS),
+    })
+
+
+def build_fact_tables(orders, order_items, customers, products, sellers, reviews):
+    order_fact = build_order_fact(orders, customers, reviews)
+    item_fact = build_item_fact(order_fact, order_items, products, sellers)
+    return item_fact, order_fact
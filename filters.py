@@ -0,0 +1,155 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import timeseries
+
+# Global filter context: one set of filters every panel is computed under.
+#
+# Filters selects orders by purchase date range and customer_state and order_status
+# (order attributes), and their items by seller_state and product category (item
+# attributes). Each dimension takes any number of values (None or empty for all);
+# dimensions combine with AND, values of one dimension with OR. An order passes
+# when its own attributes do and, once an item attribute is filtered on, when one of
+# its items passes too; an item passes when it and its order do.
+#
+# FilterIndex is built once per data version over the order and item fact rows
+# (analytics.Model): a bitmap (np.packbits of a boolean column) per value of every
+# dimension, and the orders sorted by purchase day so a date range is a
+# searchsorted() slice. masks() of any filter combination is then a few ORs and ANDs
+# of bitmaps, one pass over the packed bytes per dimension filtered on, rather than
+# joins or isin() over the rows; analytics.restrict builds the panels' Model of the
+# rows that pass.
+#
+# Filters is a namedtuple of hashables (dates as datetime.date, values as tuples) so
+# it can key the dashboard's caches.
+
+Filters = namedtuple("Filters", ["start", "end", "seller_state", "customer_state", "category", "order_status"],
+                     defaults=[None] * 6)
+NONE = Filters()
+
+# filter field: (label, fact column)
+ORDER_DIMS = {
+    "customer_state": ("Customer state", "customer_state"),
+    "order_status": ("Order status", "order_status"),
+}
+ITEM_DIMS = {
+    "seller_state": ("Seller state", "seller_state"),
+    "category": ("Product category", "product_category_name"),
+}
+
+
+def active(filters):
+    # Whether filters selects anything less than all rows
+    return filters is not None and any(value is not None and value != () for value in filters)
+
+
+def describe(filters):
+    # Short text of the active filters, e.g. for chart titles and report names
+    parts = []
+    if filters.start is not None or filters.end is not None:
+        parts.append(f"{filters.start or '…'} to {filters.end or '…'}")
+    for field, (label, _) in {**ORDER_DIMS, **ITEM_DIMS}.items():
+        values = getattr(filters, field)
+        if values:
+            parts.append(f"{label}: {', '.join(map(str, values))}")
+    return "; ".join(parts)
+
+
+def day_range(start, end):
+    # (first, last) timeseries day code of the purchase dates from start through end
+    # (datetime.date; None leaves that side open)
+    first = 0 if start is None else timeseries.period_codes(pd.DatetimeIndex([start]), "day")[0]
+    last = np.iinfo(np.int32).max if end is None else timeseries.period_codes(pd.DatetimeIndex([end]), "day")[0]
+    return first, last
+
+
+def cells(filters):
+    # filters as a selection of per-day cells (approximate.py): ({fact column: values}
+    # of the dimensions set, (first, last) day code or None)
+    where = {column: tuple(getattr(filters, field)) for field, (_, column) in {**ORDER_DIMS, **ITEM_DIMS}.items()
+             if getattr(filters, field)}
+    days = None if filters.start is None and filters.end is None else day_range(filters.start, filters.end)
+    return where, days
+
+
+def _bitmaps(values):
+    # {value: packed bitmap of its rows}, missing values left out
+    codes, uniques = pd.factorize(values)
+    return {value: np.packbits(codes == i) for i, value in enumerate(uniques)}
+
+
+class FilterIndex:
+    def __init__(self, n_orders, order_key, order_bitmaps, item_bitmaps, by_day, sorted_day):
+        self.n_orders = n_orders
+        self.order_key = order_key
+        self.order_bitmaps = order_bitmaps
+        self.item_bitmaps = item_bitmaps
+        self.by_day = by_day
+        self.sorted_day = sorted_day
+
+    @classmethod
+    def build(cls, item_fact, order_fact):
+        day = timeseries.period_codes(order_fact["order_purchase_timestamp"], "day")
+        by_day = np.argsort(day, kind="stable").astype(np.int32)
+        return cls(
+            n_orders=len(order_fact),
+            order_key=item_fact["order_key"].to_numpy(),
+            order_bitmaps={field: _bitmaps(order_fact[column]) for field, (_, column) in ORDER_DIMS.items()},
+            item_bitmaps={field: _bitmaps(item_fact[column]) for field, (_, column) in ITEM_DIMS.items()},
+            by_day=by_day,
+            sorted_day=day[by_day],
+        )
+
+    def options(self, field):
+        # Values of a dimension, sorted
+        bitmaps = self.order_bitmaps[field] if field in ORDER_DIMS else self.item_bitmaps[field]
+        return sorted(bitmaps)
+
+    def date_range(self):
+        # (first, last) purchase date as datetime.date, None when no order has one
+        days = self.sorted_day[self.sorted_day >= 0]
+        if not len(days):
+            return None
+        first, last = timeseries.period_start(days[[0, -1]], "day")
+        return first.date(), last.date()
+
+    def masks(self, filters):
+        # (order mask over the order fact rows, item mask over the item fact rows) of the
+        # rows passing filters
+        n_items = len(self.order_key)
+        orders = self._select(self.order_bitmaps, filters, (self.n_orders + 7) // 8)
+        if filters.start is not None or filters.end is not None:
+            orders = np.bitwise_and(orders, np.packbits(self._days(filters.start, filters.end)))
+        orders = np.unpackbits(orders, count=self.n_orders).astype(bool)
+        items = orders[self.order_key]
+        filtered_items = any(getattr(filters, field) for field in ITEM_DIMS)
+        if filtered_items:
+            items &= np.unpackbits(self._select(self.item_bitmaps, filters, (n_items + 7) // 8),
+                                   count=n_items).astype(bool)
+            orders &= np.bincount(self.order_key[items], minlength=self.n_orders) > 0
+        return orders, items
+
+    def _select(self, bitmaps, filters, size):
+        # Packed rows matching every dimension of bitmaps that filters sets
+        selected = np.full(size, 0xFF, dtype=np.uint8)
+        for field, by_value in bitmaps.items():
+            values = getattr(filters, field)
+            if not values:
+                continue
+            either = np.zeros(size, dtype=np.uint8)
+            for value in values:
+                if value in by_value:
+                    either |= by_value[value]
+            selected &= either
+        return selected
+
+    def _days(self, start, end):
+        # Orders purchased from start through end (datetime.date; None leaves that side open)
+        first, last = day_range(start, end)
+        lo = np.searchsorted(self.sorted_day, first, side="left")
+        hi = np.searchsorted(self.sorted_day, last, side="right")
+        mask = np.zeros(self.n_orders, dtype=bool)
+        mask[self.by_day[lo:hi]] = True
+        return mask
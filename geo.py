@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Seller-customer distances and map aggregates from GEO_LOCATION.
+#
+# GeoIndex is a direct-address table over zip code prefixes: the mean lat/lng of
+# each prefix's GEO_LOCATION rows stored at position `prefix` of two arrays, so
+# locating a column of prefixes is one array index (NaN where a prefix has no
+# location). Distances are great-circle (haversine) distances between those points.
+#
+# Every geo panel is computed from zip pairs: order items summed per
+# (seller_zip_code_prefix, customer_zip_code_prefix), see item_pairs(). The backends
+# produce the same pair frame (the SQL one with a GROUP BY, the streaming one per
+# partition), which is at most sellers' zips x customers' zips rows however many
+# items there are. Maps are aggregated into hexagonal cells on the server, so the
+# browser gets one marker per cell rather than one per customer or seller.
+
+EARTH_RADIUS_KM = 6371.0088
+DISTANCE_BANDS_KM = [0, 50, 200, 500, 1000, 2000, float("inf")]
+DISTANCE_LABELS = ["< 50 km", "50-200 km", "200-500 km", "500-1000 km", "1000-2000 km", "2000+ km"]
+# circumradius of a map cell in degrees of lng/lat
+HEX_SIZE_DEG = float(os.environ.get("MARKET_HEX_SIZE_DEG", "0.75"))
+
+# summed measures of a pair frame; delivery_days over the `delivered` items only
+PAIR_MEASURES = ["items", "revenue", "freight_value", "delivery_days", "delivered", "late"]
+PAIR_KEYS = ["seller_zip_code_prefix", "customer_zip_code_prefix"]
+
+
+class GeoIndex:
+    def __init__(self, zips, lat, lng):
+        zips = np.asarray(zips, dtype=np.int64)
+        size = int(zips.max(initial=-1)) + 1
+        self.lat = np.full(size, np.nan)
+        self.lng = np.full(size, np.nan)
+        self.lat[zips] = lat
+        self.lng[zips] = lng
+
+    @classmethod
+    def build(cls, geolocation):
+        # From GEO_LOCATION rows; a prefix with several rows is placed at their mean
+        means = (geolocation.groupby("geolocation_zip_code_prefix")[["geolocation_lat", "geolocation_lng"]]
+                 .mean().dropna())
+        return cls(means.index, means["geolocation_lat"], means["geolocation_lng"])
+
+    def locate(self, zips):
+        # (lat, lng) arrays for zip prefixes, NaN where unknown
+        zips = np.asarray(pd.to_numeric(pd.Series(zips), errors="coerce").fillna(-1), dtype=np.int64)
+        known = (zips >= 0) & (zips < len(self.lat))
+        lat, lng = np.full(len(zips), np.nan), np.full(len(zips), np.nan)
+        lat[known], lng[known] = self.lat[zips[known]], self.lng[zips[known]]
+        return lat, lng
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype="float64")) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def item_pairs(item_fact):
+    # Order items summed per (seller zip, customer zip)
+    delivered_at = item_fact["order_delivered_customer_date"]
+    days = (delivered_at - item_fact["order_purchase_timestamp"]).dt.total_seconds() / 86400
+    delay = (delivered_at - item_fact["order_estimated_delivery_date"]).dt.days
+    pairs = pd.DataFrame({
+        "seller_zip_code_prefix": item_fact["seller_zip_code_prefix"],
+        "customer_zip_code_prefix": item_fact["customer_zip_code_prefix"],
+        "items": 1,
+        "revenue": item_fact["price"],
+        "freight_value": item_fact["freight_value"],
+        "delivery_days": days,
+        "delivered": days.notna().astype("int64"),
+        "late": (delay > 0).astype("int64"),
+    })
+    return pairs.groupby(PAIR_KEYS, sort=False)[PAIR_MEASURES].sum().reset_index()
+
+
+def add_pairs(pairs, delta):
+    # Pair frames of disjoint sets of items added up
+    if pairs is None:
+        return delta
+    return pd.concat([pairs, delta]).groupby(PAIR_KEYS, sort=False)[PAIR_MEASURES].sum().reset_index()
+
+
+def distance_bands(pairs, index):
+    # Items, freight, delivery time and late share per seller-customer distance band;
+    # items whose seller or customer zip has no location are left out
+    seller_lat, seller_lng = index.locate(pairs["seller_zip_code_prefix"])
+    customer_lat, customer_lng = index.locate(pairs["customer_zip_code_prefix"])
+    km = haversine_km(seller_lat, seller_lng, customer_lat, customer_lng)
+    band = pd.cut(km, bins=DISTANCE_BANDS_KM, labels=DISTANCE_LABELS, right=False)
+    sums = pairs[PAIR_MEASURES].assign(km=km * pairs["items"]).groupby(band, observed=False).sum()
+    items, delivered = sums["items"].to_numpy(), sums["delivered"].to_numpy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pd.DataFrame({
+            "Distance": DISTANCE_LABELS,
+            "Items": items,
+            "Avg Distance (km)": sums["km"].to_numpy() / items,
+            "Avg Freight": sums["freight_value"].to_numpy() / items,
+            "Avg Delivery Days": sums["delivery_days"].to_numpy() / delivered,
+            "Late %": 100 * sums["late"].to_numpy() / delivered,
+        })
+
+
+def hex_cells(lat, lng, size=HEX_SIZE_DEG):
+    # Axial (q, r) coordinates of the pointy-top hexagon containing each point
+    q = (np.sqrt(3) / 3 * lng - lat / 3) / size
+    r = (2 / 3 * lat) / size
+    # cube rounding: round all three coordinates, then fix the one that moved most
+    x, z = q, r
+    y = -x - z
+    rx, ry, rz = np.round(x), np.round(y), np.round(z)
+    dx, dy, dz = np.abs(rx - x), np.abs(ry - y), np.abs(rz - z)
+    fix_x = (dx > dy) & (dx > dz)
+    fix_z = ~fix_x & (dz >= dy)
+    rx = np.where(fix_x, -ry - rz, rx)
+    rz = np.where(fix_z, -rx - ry, rz)
+    return rx.astype(np.int64), rz.astype(np.int64)
+
+
+def hex_center(q, r, size=HEX_SIZE_DEG):
+    # (lat, lng) of cell centres
+    return size * 1.5 * np.asarray(r), size * np.sqrt(3) * (np.asarray(q) + np.asarray(r) / 2)
+
+
+def map_cells(pairs, index, side="customer", size=HEX_SIZE_DEG):
+    # Items and revenue per hexagonal cell of customer or seller locations
+    zips = pairs.groupby(f"{side}_zip_code_prefix")[["items", "revenue"]].sum()
+    lat, lng = index.locate(zips.index)
+    located = ~np.isnan(lat)
+    q, r = hex_cells(lat[located], lng[located], size)
+    cells = zips[located].groupby([q, r]).sum()
+    cell_lat, cell_lng = hex_center(cells.index.get_level_values(0), cells.index.get_level_values(1), size)
+    return pd.DataFrame({
+        "lat": cell_lat,
+        "lng": cell_lng,
+        "items": cells["items"].to_numpy(),
+        "revenue": cells["revenue"].to_numpy(),
+    })
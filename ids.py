@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+# Dense int32 codes for the 32-character hex ids.
+#
+# Each id column gets a dictionary (code -> hex id) built from the table that owns
+# the id, so on a table with unique ids the code of a row is its row number; ids
+# only seen in referencing tables (an item's seller missing from SELLERS, say) are
+# appended after those. analytics.prepare encodes the loaded tables once, and every
+# join, filter and distinct count afterwards runs on the codes. Hex ids come back
+# through decode() only where they are displayed.
+#
+# Dictionaries are append-only and never modified in place: encode_tables() with
+# earlier dictionaries returns new ones that extend them, so codes handed out
+# earlier stay valid for models built on them.
+
+# id column -> the table it identifies rows of
+ID_TABLES = {
+    "order_id": "ORDERS",
+    "customer_id": "CUSTOMERS",
+    "customer_unique_id": "CUSTOMERS",
+    "product_id": "PRODUCTS",
+    "seller_id": "SELLERS",
+    "review_id": "ORDER_REVIEW_RATINGS",
+}
+
+
+class IdDictionary:
+    def __init__(self, ids=None):
+        self.ids = pd.Index([] if ids is None else ids, dtype="str")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, values):
+        # int32 codes (-1 for values not in the dictionary)
+        return self.ids.get_indexer(pd.Index(values, dtype="str")).astype(np.int32)
+
+    def decode(self, codes):
+        codes = np.asarray(codes)
+        out = self.ids.take(np.where(codes >= 0, codes, 0)).to_numpy(dtype=object)
+        out[codes < 0] = None
+        return out
+
+
+def encode_tables(tables, dictionaries=None):
+    # (tables with their id columns replaced by codes, {id column: IdDictionary}).
+    # Pass the dictionaries of an earlier call to encode new rows consistently with it.
+    dictionaries = dict(dictionaries or {})
+    codes = {name: {} for name in tables}
+    for column, owner in ID_TABLES.items():
+        holders = list(dict.fromkeys(
+            name for name in [owner, *tables] if name in tables and column in tables[name].columns))
+        known = dictionaries.get(column, IdDictionary()).ids
+        # one factorize over the known ids followed by every column holding this id:
+        # known ids keep their codes and new ones are numbered in first-seen order
+        values, uniques = pd.factorize(pd.concat(
+            [pd.Series(known, dtype="str")] + [tables[name][column].astype("str") for name in holders],
+            ignore_index=True))
+        dictionaries[column] = IdDictionary(uniques)
+        start = len(known)
+        for name in holders:
+            codes[name][column] = values[start:start + len(tables[name])].astype(np.int32)
+            start += len(tables[name])
+    encoded = {name: df.assign(**codes[name]) if codes[name] else df for name, df in tables.items()}
+    return encoded, dictionaries
+
+
+def decode(df, dictionaries):
+    # Copy of df with its id columns turned back into hex strings, for display
+    columns = [col for col in df.columns if col in dictionaries]
+    return df.assign(**{col: dictionaries[col].decode(df[col]) for col in columns})
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import threading
+
+import analytics
+import data_loader
+import dataplane
+
+# Incremental ingestion of new order batches.
+#
+#     python ingest.py path/to/batch        # ORDERS.csv, ORDER_ITEMS.csv, ... with new rows
+#
+# appends the batch to the source CSVs and the snapshot (data_loader.append_batch).
+# A ModelStore that already holds the model for the data version the batch was
+# appended to then advances it with analytics.update() instead of reloading and
+# rebuilding everything; any other change to the files (a replaced CSV, a batch
+# whose parts were already compacted) still goes through a full load.
+#
+# With the shared data plane (dataplane.py) the store first attaches the model of the
+# new version if another process already published it; otherwise it builds the model,
+# publishes it and attaches the published copy too, so the private one is dropped and
+# every process serves the same mapped pages.
+
+
+class ModelStore:
+    # The current (data version, analytics.Model) for one data directory
+    def __init__(self, data_dir=".", snapshot_dir=None):
+        self.data_dir = data_dir
+        self.snapshot_dir = snapshot_dir
+        self.version = None
+        self.model = None
+        self._lock = threading.Lock()
+
+    def current(self, progress=None):
+        # progress: see data_loader.load_tables (only called when the tables are reloaded)
+        version = data_loader.data_version(self.data_dir, self.snapshot_dir)
+        with self._lock:
+            if version != self.version:
+                plane = dataplane.available() and (
+                    self.snapshot_dir or os.path.join(self.data_dir, data_loader.SNAPSHOT_DIR))
+                model = plane and dataplane.attach(plane, version)
+                if not model:
+                    model = self._build(version, progress)
+                    if plane:
+                        dataplane.publish(model, plane, version)
+                        model = dataplane.attach(plane, version)
+                self.version, self.model = version, model
+            return self.version, self.model
+
+    def _build(self, version, progress):
+        chain = self.model is not None and data_loader.batches_between(
+            self.version, version, self.data_dir, self.snapshot_dir)
+        if not chain:
+            return analytics.prepare(data_loader.load_tables(self.data_dir, self.snapshot_dir, progress=progress))
+        model = self.model
+        for batch in chain:
+            model = analytics.update(model, data_loader.load_batch(batch, self.data_dir, self.snapshot_dir))
+        return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Append a batch of delta CSVs to the dashboard data")
+    parser.add_argument("batch_dir", help=f"directory with any of {', '.join(data_loader.APPEND_TABLES)} as CSV")
+    parser.add_argument("--data-dir", default=".")
+    args = parser.parse_args()
+    batch = data_loader.append_batch(args.batch_dir, args.data_dir)
+    print(json.dumps(batch, indent=1) if batch else "nothing to append")
+
+
+if __name__ == "__main__":
+    main()
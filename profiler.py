@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Hot-path instrumentation for the dashboard.
+#
+# Each panel's computation and figure build runs inside a named span that records
+# wall time, rows processed and the change in process RSS. A Profiler keeps the
+# spans of the last `history` reruns, and optionally appends every rerun to a
+# JSON-lines log (MARKET_PROFILE_LOG) that `python profiler.py LOG` summarizes into
+# p50/p95 per panel across sessions.
+#
+# A fragment that reruns on its own (st.fragment) records its spans as a separate
+# run, labelled with the fragment's name; see Profiler.run().
+#
+# RSS is process-wide, so with several concurrent sessions the memory delta of a
+# span also includes whatever the other sessions allocated meanwhile.
+
+LOG_PATH = os.environ.get("MARKET_PROFILE_LOG")
+HISTORY = int(os.environ.get("MARKET_PROFILE_HISTORY", "20"))
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_mb():
+    # Current resident set size in MB (None where /proc is not available)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Span:
+    __slots__ = ("name", "seconds", "rows", "rss_delta_mb")
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.seconds = None
+        self.rss_delta_mb = None
+
+    def as_dict(self):
+        return {"panel": self.name, "seconds": self.seconds, "rows": self.rows, "rss_delta_mb": self.rss_delta_mb}
+
+
+class Profiler:
+    def __init__(self, history=HISTORY, log_path=LOG_PATH, session=None):
+        self.runs = deque(maxlen=history)
+        self.log_path = log_path
+        self.session = session or uuid.uuid4().hex[:8]
+        self.run_count = 0
+        self._current = None
+        self._run_start = None
+        self._scope = None
+
+    def start_run(self, scope="app"):
+        self.run_count += 1
+        self._scope = scope
+        self._current = []
+        self._run_start = time.perf_counter()
+
+    @contextmanager
+    def run(self, scope):
+        # Spans of a fragment: part of the app run when it is in progress, else a run of their own
+        if self._current is not None:
+            yield
+            return
+        self.start_run(scope)
+        try:
+            yield
+        finally:
+            self.finish_run()
+
+    @contextmanager
+    def span(self, name, rows=None):
+        # Time a block; set span.rows inside the block if the count is only known there
+        span = Span(name, rows)
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.seconds = time.perf_counter() - start
+            rss_after = rss_mb()
+            if rss_before is not None and rss_after is not None:
+                span.rss_delta_mb = round(rss_after - rss_before, 3)
+            if self._current is not None:
+                self._current.append(span)
+
+    def finish_run(self):
+        if self._current is None:
+            return
+        run = {
+            "ts": time.time(),
+            "session": self.session,
+            "run": self.run_count,
+            "scope": self._scope,
+            "total_seconds": time.perf_counter() - self._run_start,
+            "spans": [span.as_dict() for span in self._current],
+        }
+        self.runs.append(run)
+        self._current = None
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                for span in run["spans"]:
+                    f.write(json.dumps({"ts": run["ts"], "session": run["session"], "run": run["run"],
+                                        "scope": run["scope"], **span}) + "\n")
+
+    def last_run_frame(self):
+        # Spans of the most recent rerun, slowest first
+        if not self.runs:
+            return pd.DataFrame(columns=["panel", "ms", "rows", "rss_delta_mb"])
+        df = pd.DataFrame(self.runs[-1]["spans"])
+        df["ms"] = (df.pop("seconds") * 1000).round(2)
+        return df[["panel", "ms", "rows", "rss_delta_mb"]].sort_values("ms", ascending=False)
+
+    def history_frame(self):
+        # Milliseconds per panel (rows) for each of the kept reruns (columns)
+        data = {
+            _run_label(run): {span["panel"]: round(span["seconds"] * 1000, 2) for span in run["spans"]}
+            for run in self.runs
+        }
+        df = pd.DataFrame(data)
+        if self.runs:
+            df.loc["total"] = [round(run["total_seconds"] * 1000, 2) for run in self.runs]
+        return df
+
+
+def _run_label(run):
+    return f"#{run['run']}" if run["scope"] == "app" else f"#{run['run']} {run['scope']}"
+
+
+def summarize(log_path):
+    # p50/p95 milliseconds, mean rows and mean RSS delta per panel over a JSON-lines log
+    df = pd.read_json(log_path, lines=True)
+    df["ms"] = df["seconds"] * 1000
+    grouped = df.groupby("panel")
+    return pd.DataFrame({
+        "count": grouped.size(),
+        "p50_ms": grouped["ms"].quantile(0.5),
+        "p95_ms": grouped["ms"].quantile(0.95),
+        "max_ms": grouped["ms"].max(),
+        "rows": grouped["rows"].mean(),
+        "rss_delta_mb": grouped["rss_delta_mb"].mean(),
+        "sessions": grouped["session"].nunique(),
+    }).sort_values("p95_ms", ascending=False).round(2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a dashboard profile log (MARKET_PROFILE_LOG)")
+    parser.add_argument("log")
+    args = parser.parse_args()
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(summarize(args.log))
+
+
+if __name__ == "__main__":
+    main()
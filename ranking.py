@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+# Top-K / bottom-K revenue rankings, built once per data version.
+#
+# A Ranking sorts a dimension's rows by revenue once, within each value of an
+# optional second dimension (categories within a seller state, sellers within
+# theirs, ...), and keeps where each group starts and ends. A top-K or bottom-K
+# query is then a slice of at most K rows of the sorted frame, whatever K and
+# however many rows the dimension has, so the sidebar can ask for any K without
+# another group-by or sort.
+#
+# Ties are broken by the order of the rows handed in: the key's sort order for the
+# cube roll-ups, the dimension table's row order for sellers and customers.
+
+# dimension: (label, key column, columns shown next to the key, dimensions it can be ranked within)
+DIMENSIONS = {
+    "category": ("Product Category", "product_category_name", [], ["seller_state", "customer_state"]),
+    "seller_state": ("Seller State", "seller_state", [], ["category"]),
+    "customer_state": ("Customer State", "customer_state", [], ["category"]),
+    "seller": ("Seller", "seller_id", ["seller_city", "seller_state"], ["seller_state"]),
+    "customer": ("Customer", "customer_id", ["customer_city", "customer_state"], ["customer_state"]),
+}
+
+
+def key_column(dimension):
+    return DIMENSIONS[dimension][1]
+
+
+def columns(dimension):
+    # Columns of a ranking's rows, in order
+    _, key, shown, _ = DIMENSIONS[dimension]
+    return [key, *shown, "Revenue", "Rank"]
+
+
+class Ranking:
+    def __init__(self, frame, within=None):
+        # frame: one row per entity (per (within, entity) pair when ranked within a
+        # dimension) with a "Revenue" column; rows without revenue or group are left out
+        frame = frame.dropna(subset=["Revenue"] if within is None else ["Revenue", within])
+        if within is None:
+            rows = frame.sort_values("Revenue", ascending=False, kind="stable")
+            codes, groups = np.zeros(len(rows), dtype=np.int64), pd.Index([None])
+        else:
+            rows = frame.sort_values([within, "Revenue"], ascending=[True, False], kind="stable")
+            codes, groups = pd.factorize(rows[within], sort=True)
+        # group i holds rows starts[i]:starts[i + 1]
+        starts = np.searchsorted(codes, np.arange(len(groups) + 1))
+        self.rows = rows.reset_index(drop=True).assign(Rank=np.arange(len(rows)) - starts[codes] + 1)
+        self.bounds = {group: (starts[i], starts[i + 1]) for i, group in enumerate(groups)}
+
+    def top(self, k, group=None):
+        # The k highest rows (of one group), highest first
+        start, end = self.bounds.get(group, (0, 0))
+        return self.rows.iloc[start:min(start + k, end)]
+
+    def bottom(self, k, group=None):
+        # The k lowest rows (of one group), lowest first
+        start, end = self.bounds.get(group, (0, 0))
+        return self.rows.iloc[max(end - k, start):end].iloc[::-1]
+
+    def groups(self):
+        return list(self.bounds)
+
+
+def build_rankings(item_cube, seller_revenue, customer_revenue):
+    # {(dimension, within): Ranking} for every dimension, overall (within None) and
+    # within each dimension it can be ranked within. seller_revenue/customer_revenue
+    # as analytics.seller_revenue/customer_revenue.
+    def rollup(dimension, within=None):
+        by = [key_column(d) for d in ([within] if within else []) + [dimension]]
+        return item_cube.query(by)[[*by, "revenue"]].rename(columns={"revenue": "Revenue"})
+
+    sources = {
+        "seller": seller_revenue.rename(columns={"payment_value": "Revenue"}),
+        "customer": customer_revenue.rename(columns={"payment_value": "Revenue"}),
+    }
+    rankings = {}
+    for dimension, (_, _, _, withins) in DIMENSIONS.items():
+        for within in [None, *withins]:
+            if dimension in sources:
+                frame = sources[dimension]
+            else:
+                frame = rollup(dimension, within)
+            rankings[dimension, within] = Ranking(frame, within and key_column(within))
+    return rankings
+
+
+def query(rankings, dimension, k, within=None, group=None, bottom=False):
+    # The top (or bottom) k rows of a dimension, overall or within one group, with
+    # their rank counted from the top
+    if within is None:
+        group = None
+    ranking = rankings[dimension, within]
+    rows = ranking.bottom(k, group) if bottom else ranking.top(k, group)
+    return rows[columns(dimension)].reset_index(drop=True)
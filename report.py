@@ -0,0 +1,232 @@
+import argparse
+import html
+import importlib.util
+import json
+import math
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import backends
+import charts
+import cohort
+import data_loader
+import dataplane
+import delivery
+import filters
+import ranking
+
+# Static reports of the dashboard, one per seller_state and per product category,
+# rendered without a browser session.
+#
+#     python report.py --data-dir . --out reports [--by seller_state category] [--workers 8] [--png]
+#
+# writes to --out, per report, <name>.html (the panels' Plotly figures and tables,
+# sharing one plotly.min.js in the directory) and <name>.json (the numbers behind
+# them), and with --png a <name>.<panel>.png per figure (needs kaleido); index.json
+# lists the reports with their filters and how long each took.
+#
+# A report is the dashboard under a global filter (filters.Filters) of one seller state
+# or one category, plus one of all the data, with every widget at its default (PANELS),
+# answered by the pandas backend's filtered views like the dashboard's, so the numbers
+# are the ones it shows for the same filter.
+#
+# What every report shares runs once, in this process: loading the tables, the joins
+# and the per-version aggregates (the analytics.Model, through ingest.ModelStore) and
+# the FilterIndex. The pool's workers attach the Model this process published to the
+# shared data plane (dataplane.py) rather than rebuilding it (or are handed it once
+# each when the plane is not in use) and get the FilterIndex with it, so a report
+# costs its masks, its restricted Model and its panels. The largest reports are
+# submitted first, so a long one does not run on its own at the end.
+
+# (key, title, backend panel, panel args, charts function or None for a table, chart args)
+PANELS = [
+    ("overview_kpis", "Overview", "overview_kpis", (), None, ()),
+    ("category_revenue", "Product Analysis", "category_revenue", (), "category_revenue_bar", (10,)),
+    ("new_customers", "New Customers", "new_customers_by_period", ("month",), "new_customers_line", ("month",)),
+    ("review_scores", "Review Scores", "review_histogram", (), "review_scores_bar", ()),
+    ("customer_segments", "Customer Segmentation", "rfm_segments", ("quantile",), "pie",
+     ("Segment", "Customer Segmentation", 0.4)),
+    ("payment_types", "Payment Types", "payment_mix", (), "pie", ("Payment_Type", "Payment Types")),
+    ("delivery_accuracy", "Delivery Accuracy", "delivery_accuracy", (), "pie",
+     ("Delivery Accuracy", "Delivery Accuracy")),
+    ("seller_segments", "Seller Segmentation", "seller_segments", (), "pie",
+     ("Payment Value Group", "Seller Segmentation", 0.4)),
+    ("top_sellers", "Top 3 Sellers", "top_sellers", (3,), "top_revenue_bar",
+     ("seller_id", "seller_state", "Top 3 Sellers by Revenue")),
+    ("top_customers", "Top 3 Customers", "top_customers", (3,), "top_revenue_bar",
+     ("customer_id", "customer_state", "Top 3 Customers by Revenue")),
+    ("state_year_orders", "Yearly Orders per Top 10 States", "state_year_orders", (10,), None, ()),
+    ("ranking", "Revenue Ranking", "ranking", ("category", 10, None, None, False), "ranking_bar",
+     (ranking.DIMENSIONS["category"][1], f"Top 10 by Revenue: {ranking.DIMENSIONS['category'][0]}")),
+    ("cohorts", "Cohorts", "cohorts", (None, None), "cohort_heatmap",
+     (cohort.MEASURES[0], f"Customer {cohort.MEASURES[0].title()} by Cohort")),
+    ("delivery_compliance", "Delivery Performance", "delivery_compliance", (None, None), None, ()),
+    ("delivery_percentiles", "Delivery Percentiles", "delivery_percentiles", ("lateness", "month", None, None),
+     "delivery_percentiles_chart",
+     (f"{delivery.METRICS['lateness'][0]} (days) by {delivery.DIMENSIONS['month'][0]}",)),
+    ("map_cells", "Locations Map", "map_cells", ("customer",), "cells_map", ("Items and Revenue by Customer Location",)),
+    ("distance_bands", "Distance Bands", "distance_bands", (), "distance_bands_bar", ()),
+]
+# --by choice: Filters field the reports are split by
+SPLITS = {"seller_state": "seller_state", "category": "category"}
+
+_backend = None  # PandasBackend of this worker (_start_worker)
+
+
+def panels(field=None, value=None):
+    # PANELS, plus the panels the dashboard has for one selected region or category
+    if field == "seller_state":
+        return [*PANELS, ("region_category_revenue", f"Revenue by Category in {value}", "region_category_revenue",
+                          (value,), "region_revenue_line", (value,))]
+    if field == "category":
+        return [*PANELS,
+                ("top_regions", f"Top 3 Regions for {value}", "top_regions", (value, 3), "top_regions_bar", (value,)),
+                ("product_metrics", f"Metrics of {value}", "product_metrics", (value,), None, ())]
+    return PANELS
+
+
+def variants(index, by):
+    # (report name, Filters field, value) of every report, largest (most items) first
+    out = [("all", None, None, math.inf)]
+    for split in by:
+        field = SPLITS[split]
+        for value, bitmap in index.item_bitmaps[field].items():
+            out.append((f"{split}-{value}", field, value, int(np.bitwise_count(bitmap).sum())))
+    out.sort(key=lambda variant: -variant[3])
+    return [(_file_name(name), field, value) for name, field, value, _ in out]
+
+
+def _file_name(name):
+    return re.sub(r"[^\w.-]+", "_", str(name)).strip("_")
+
+
+def _plane(data_dir, snapshot_dir):
+    # Directory of the data plane ingest.ModelStore publishes to, None when it is not in use
+    return (snapshot_dir or os.path.join(data_dir, data_loader.SNAPSHOT_DIR)) if dataplane.available() else None
+
+
+def _start_worker(data_dir, snapshot_dir, version, model, index):
+    # Pool initializer: serve the parent's Model (attached from the data plane when model is None)
+    global _backend
+    if model is None:
+        model = dataplane.attach(_plane(data_dir, snapshot_dir), version)
+        if model is None:
+            raise RuntimeError(f"data version {version} is no longer on the data plane")
+    _backend = backends.PandasBackend(data_dir, snapshot_dir)
+    _backend.use(version, model, index)
+
+
+def _jsonable(value):
+    # Panel output as JSON values: frames and series in their "split" form, NaN as null
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return json.loads(value.to_json(orient="split", date_format="iso"))
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value if value is None or isinstance(value, (bool, int, float, str)) else str(value)
+
+
+def _table(value):
+    if isinstance(value, dict):
+        value = pd.Series(value, name="value").to_frame()
+    return value.to_html(border=0, na_rep="–", float_format=lambda x: f"{x:,.2f}")
+
+
+def render(name, field, value, out_dir, png=False):
+    # Write name.html and name.json (and the PNGs) of one report; returns its index.json entry
+    import plotly.io as pio
+
+    start = time.perf_counter()
+    context = filters.Filters(**{field: (value,)}) if field else filters.NONE
+    # not kept in the backend's view cache: each report's filter is used once
+    view = (backends.FilteredPandasBackend(_backend, _backend.model, context, _backend.filter_index().masks(context))
+            if field else _backend)
+    numbers, sections, figures = {}, [], 0
+    for key, title, panel, panel_args, chart, chart_args in panels(field, value):
+        data = getattr(view, panel)(*panel_args)
+        numbers[key] = _jsonable(data)
+        if chart is None:
+            sections.append(f"<h2>{html.escape(title)}</h2>\n{_table(data)}")
+            continue
+        fig = getattr(charts, chart)(data, *chart_args)
+        # the first figure loads plotly.min.js from the report's directory
+        sections.append(pio.to_html(fig, full_html=False, include_plotlyjs="directory" if not figures else False))
+        figures += 1
+        if png:
+            fig.write_image(os.path.join(out_dir, f"{name}.{key}.png"))
+
+    heading = filters.describe(context) or "All data"
+    with open(os.path.join(out_dir, f"{name}.html"), "w") as f:
+        f.write(f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Marketing Analysis: "
+                f"{html.escape(heading)}</title></head>\n<body>\n<h1>{html.escape(heading)}</h1>\n"
+                f"<p>Data version {html.escape(str(_backend.version))}</p>\n" + "\n".join(sections) + "\n</body></html>\n")
+    entry = {"name": name, "filters": heading, "field": field, "value": value,
+             "orders": len(view.model.order_fact), "items": len(view.model.item_fact)}
+    with open(os.path.join(out_dir, f"{name}.json"), "w") as f:
+        json.dump({**entry, "version": _backend.version, "panels": numbers}, f)
+    return {**entry, "seconds": round(time.perf_counter() - start, 3)}
+
+
+def run(data_dir=".", out_dir="reports", by=tuple(SPLITS), workers=None, png=False, snapshot_dir=None, log=print):
+    # Render every report into out_dir; returns the index.json entries
+    from plotly.offline import get_plotlyjs
+
+    start = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    backend = backends.PandasBackend(data_dir, snapshot_dir)
+    version = backend.refresh()
+    index = backend.filter_index()
+    plane = _plane(data_dir, snapshot_dir)
+    log(f"model of {version} ready in {time.perf_counter() - start:.1f} s")
+    with open(os.path.join(out_dir, "plotly.min.js"), "w") as f:
+        f.write(get_plotlyjs())
+
+    todo = variants(index, by)
+    workers = min(workers or os.cpu_count() or 1, len(todo))
+    entries = []
+    if workers == 1:
+        _start_worker(data_dir, snapshot_dir, version, backend.model, index)
+        for variant in todo:
+            entries.append(render(*variant, out_dir, png))
+            log(f"{len(entries)}/{len(todo)} {entries[-1]['name']} {entries[-1]['seconds']:.1f} s")
+    else:
+        initargs = (data_dir, snapshot_dir, version, None if plane else backend.model, index)
+        with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=initargs) as pool:
+            for future in as_completed([pool.submit(render, *variant, out_dir, png) for variant in todo]):
+                entries.append(future.result())
+                log(f"{len(entries)}/{len(todo)} {entries[-1]['name']} {entries[-1]['seconds']:.1f} s")
+
+    entries.sort(key=lambda entry: entry["name"])
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump({"version": version, "seconds": round(time.perf_counter() - start, 3), "reports": entries}, f,
+                  indent=1)
+    log(f"{len(entries)} reports in {time.perf_counter() - start:.1f} s with {workers} worker(s)")
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the dashboard as static reports per region and category")
+    parser.add_argument("--data-dir", default=".")
+    parser.add_argument("--out", default="reports")
+    parser.add_argument("--by", nargs="+", choices=list(SPLITS), default=list(SPLITS),
+                        help="split the reports by seller state and/or product category (default: both)")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--png", action="store_true", help="also write every figure as PNG (needs kaleido)")
+    args = parser.parse_args()
+    if args.png and importlib.util.find_spec("kaleido") is None:
+        parser.error("--png needs kaleido (pip install kaleido)")
+    run(args.data_dir, args.out, args.by, args.workers, args.png)
+
+
+if __name__ == "__main__":
+    main()
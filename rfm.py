@@ -0,0 +1,126 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import fact_table
+import timeseries
+
+# Recency / frequency / monetary (RFM) segmentation per customer_unique_id.
+#
+# CUSTOMERS has one customer_id per order, so a repeat buyer only shows up when the
+# orders are grouped by customer_unique_id. Per unique customer three running
+# totals are kept (Totals): the day code of the last purchase, the number of orders
+# and what those orders paid. They are built in one bincount / maximum.at pass over
+# the orders and, like the other running aggregates, added up batch by batch
+# (add()), so new orders never mean a rescan of the history.
+#
+# Scoring turns each measure into a 1-5 score, either
+#
+#   "quantile"  by rank among all customers with an order: score = 1 + (rank - 1) * 5 // n,
+#               with tied customers sharing the lowest rank (so the 1-order majority
+#               all scores 1 on frequency instead of being spread over several scores)
+#   "fixed"     by the fixed EDGES below (recency in days before the latest purchase)
+#
+# and the (R, average of F and M) pair is mapped to a named segment by the first
+# matching rule in SEGMENTS. assign() gives every customer code its segment, which the
+# backends keep per data version and scoring. Monetary values are rounded to cents
+# before ranking so sums taken in a different order rank the same.
+
+SCORINGS = ["quantile", "fixed"]
+SCORES = 5
+# 4 edges per measure give scores 1-5; recency scores 5 below the first edge
+EDGES = {
+    "recency": [30, 90, 180, 365],
+    "frequency": [2, 3, 4, 5],
+    "monetary": [50, 100, 200, 500],
+}
+# (segment, (lowest, highest) R score, (lowest, highest) mean of F and M scores), first match wins
+SEGMENTS = [
+    ("Champions", (4, 5), (4, 5)),
+    ("Loyal", (3, 5), (3, 5)),
+    ("Promising", (4, 5), (1, 5)),
+    ("At Risk", (1, 2), (3, 5)),
+    ("Hibernating", (1, 2), (1, 5)),
+    ("Need Attention", (1, 5), (1, 5)),
+]
+SEGMENT_NAMES = [name for name, _, _ in SEGMENTS]
+
+# per unique customer code: last purchase day code (-1 when unknown), orders, amount paid
+Totals = namedtuple("Totals", ["last_day", "orders", "monetary"])
+
+
+def totals(customer, purchase_day, paid, size):
+    # Totals of orders given as parallel arrays: unique customer code, purchase day
+    # code (timeseries.period_codes) and amount paid; size: number of customer codes
+    customer = np.asarray(customer)
+    last_day = np.full(size, -1, dtype=np.int64)
+    np.maximum.at(last_day, customer, np.asarray(purchase_day, dtype=np.int64))
+    return Totals(
+        last_day=last_day,
+        orders=np.bincount(customer, minlength=size),
+        monetary=np.bincount(customer, weights=np.asarray(paid, dtype="float64"), minlength=size),
+    )
+
+
+def order_totals(order_fact, payments, customer_key, size):
+    # Totals of the orders of an order fact (fact_table.build_order_fact) and their
+    # payments; customer_key: unique customer code of each order row
+    order_key = fact_table.dense_keys(order_fact["order_id"], payments["order_id"])
+    known = order_key >= 0
+    value = np.nan_to_num(payments["payment_value"].to_numpy(dtype="float64"))
+    paid = np.bincount(order_key[known], weights=value[known], minlength=len(order_fact))
+    return totals(customer_key, timeseries.period_codes(order_fact["order_purchase_timestamp"], "day"), paid, size)
+
+
+def add(a, b):
+    # Totals of two disjoint sets of orders; b may cover more customer codes than a
+    size = max(len(a.last_day), len(b.last_day))
+
+    def grow(values, fill):
+        return np.concatenate([values, np.full(size - len(values), fill, dtype=values.dtype)])
+
+    a, b = (Totals(*(grow(values, fill) for values, fill in zip(t, (-1, 0, 0)))) for t in (a, b))
+    return Totals(np.maximum(a.last_day, b.last_day), a.orders + b.orders, a.monetary + b.monetary)
+
+
+def _quantile_scores(values):
+    # 1 + (lowest rank of the value - 1) * SCORES // n
+    rank = pd.Series(values).rank(method="min").to_numpy(dtype=np.int64)
+    return 1 + (rank - 1) * SCORES // max(len(values), 1)
+
+
+def scores(rfm, scoring="quantile"):
+    # (R, F, M) score arrays of the customers with at least one order
+    has = rfm.orders > 0
+    last_day, orders, monetary = rfm.last_day[has], rfm.orders[has], np.round(rfm.monetary[has], 2)
+    if scoring == "quantile":
+        return _quantile_scores(last_day), _quantile_scores(orders), _quantile_scores(monetary)
+    if scoring != "fixed":
+        raise ValueError(f"unknown RFM scoring {scoring!r} (one of {', '.join(SCORINGS)})")
+    recency = last_day.max(initial=-1) - last_day
+    return (
+        len(EDGES["recency"]) + 1 - np.searchsorted(EDGES["recency"], recency, side="right"),
+        1 + np.searchsorted(EDGES["frequency"], orders, side="right"),
+        1 + np.searchsorted(EDGES["monetary"], monetary, side="right"),
+    )
+
+
+def segments(r, f, m):
+    # Index into SEGMENT_NAMES of each customer's segment
+    fm = (f + m) / 2
+    conditions = [(r >= r_low) & (r <= r_high) & (fm >= fm_low) & (fm <= fm_high)
+                  for _, (r_low, r_high), (fm_low, fm_high) in SEGMENTS]
+    return np.select(conditions, np.arange(len(SEGMENTS)), default=len(SEGMENTS) - 1)
+
+
+def assign(rfm, scoring="quantile"):
+    # Segment (index into SEGMENT_NAMES) of every customer code, -1 for those without orders
+    assigned = np.full(len(rfm.orders), -1, dtype=np.int8)
+    assigned[rfm.orders > 0] = segments(*scores(rfm, scoring))
+    return assigned
+
+
+def segment_counts(assigned):
+    # Customers per segment (a Series over SEGMENT_NAMES)
+    return pd.Series(np.bincount(assigned[assigned >= 0], minlength=len(SEGMENTS)), index=SEGMENT_NAMES)
@@ -0,0 +1,120 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+# Mergeable sketches: quantiles over logarithmic buckets (the DDSketch mapping) and
+# distinct counts (HyperLogLog, below).
+#
+# A value v is counted in bucket sign(v) * k with gamma ** (k - 1) < |v| <= gamma ** k
+# (k shifted so the smallest bucket is 1); values closer to 0 than MIN_VALUE share
+# bucket 0. Reading a bucket back as 2 * gamma ** k / (gamma + 1) is then within
+# ACCURACY of every value in it, relative to the value, so any quantile read from
+# the bucket counts is within ACCURACY of the exact one.
+#
+# A sketch is nothing but counts per bucket code, so sketches of disjoint sets of
+# values merge by adding counts. The callers keep them as cells of a cube.Cube with
+# the bucket as one more dimension ("count" per cell): Cube.merge adds batches or
+# partitions, and any slice of the cells is read with quantiles() without going
+# back to the rows. Codes stay within a few thousand of 0 and are kept as int16.
+
+ACCURACY = 0.01
+GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+MIN_VALUE = 1e-3
+_LOG_GAMMA = math.log(GAMMA)
+# so that a value of MIN_VALUE falls in bucket 1
+_OFFSET = math.ceil(math.log(MIN_VALUE) / _LOG_GAMMA) - 1
+
+
+def bucket_codes(values):
+    # Bucket code of each (finite) value
+    values = np.asarray(values, dtype="float64")
+    magnitude = np.abs(values)
+    small = magnitude < MIN_VALUE
+    k = np.ceil(np.log(np.where(small, 1.0, magnitude)) / _LOG_GAMMA) - _OFFSET
+    return np.where(small, 0, np.sign(values) * k).astype(np.int16)
+
+
+def bucket_sql(value):
+    # bucket_codes() of a (non-NULL) SQL expression, for engines with LN, CEIL and SIGN;
+    # the constants are written out exactly so the engine computes the same codes
+    return (f"CASE WHEN ABS({value}) < {MIN_VALUE!r} THEN 0 "
+            f"ELSE CAST(SIGN({value}) * (CEIL(LN(ABS({value})) / {_LOG_GAMMA!r}) - ({_OFFSET})) AS INTEGER) END")
+
+
+def bucket_values(codes):
+    # The value each bucket code stands for
+    codes = np.asarray(codes, dtype=np.int64)
+    value = 2 * GAMMA ** (np.abs(codes) + _OFFSET) / (GAMMA + 1)
+    return np.where(codes == 0, 0.0, np.sign(codes) * value)
+
+
+def quantiles(codes, counts, groups, n_groups, qs):
+    # Quantiles qs of n_groups sketches given as cells (bucket code, count, group):
+    # returns (n_groups x len(qs) values, NaN for empty groups; values per group).
+    # The q quantile is the value of rank floor(q * (n - 1)) among the group's n values.
+    codes, counts, groups = (np.asarray(a) for a in (codes, counts, groups))
+    order = np.lexsort((codes, groups))
+    codes, counts, groups = codes[order], counts[order].astype(np.int64), groups[order]
+    cumulative = np.cumsum(counts)
+    total = np.bincount(groups, weights=counts, minlength=n_groups).astype(np.int64)
+    before = np.cumsum(total) - total
+    has = total > 0
+    out = np.full((n_groups, len(qs)), np.nan)
+    for j, q in enumerate(qs):
+        rank = before + np.floor(q * (total - 1)).astype(np.int64)
+        found = np.searchsorted(cumulative, rank[has], side="right")
+        out[has, j] = bucket_values(codes[found])
+    return out, total
+
+
+# --- Distinct counts (HyperLogLog) ---
+#
+# Each value is hashed to 64 bits; the top PRECISION bits pick one of REGISTERS
+# registers and the register keeps the highest rank (position of the first 1 bit of
+# the remaining bits) seen. The harmonic mean of 2 ** -register estimates the number
+# of distinct values with a standard error of HLL_ERROR, whatever their number, and
+# registers of disjoint or overlapping sets merge by taking the maximum. Callers keep
+# them sparse, as (..., register, rank) cells holding the highest rank per register,
+# and fold any slice of cells into dense registers with distinct().
+
+PRECISION = 14
+REGISTERS = 1 << PRECISION
+HLL_ERROR = 1.04 / math.sqrt(REGISTERS)
+_RANK_BITS = 64 - PRECISION
+
+
+def hash_values(values):
+    # 64-bit hashes of values (ids as strings hash the same in every backend)
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+def hll_cells(hashes):
+    # (register, rank) of each hash
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    register = (hashes >> np.uint64(_RANK_BITS)).astype(np.int16)
+    rest = hashes & np.uint64((1 << _RANK_BITS) - 1)
+    # bit length of rest: smear its highest 1 bit downwards and count the ones
+    for shift in (1, 2, 4, 8, 16, 32):
+        rest |= rest >> np.uint64(shift)
+    rank = _RANK_BITS - np.bitwise_count(rest).astype(np.int8) + 1
+    return register, rank
+
+
+def hll_estimate(registers):
+    # Distinct count estimate per row of dense registers (the last axis)
+    registers = np.asarray(registers)
+    m = registers.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.ldexp(1.0, -registers.astype(np.int64)).sum(axis=-1)
+    zeros = (registers == 0).sum(axis=-1)
+    # few distinct values: linear counting over the empty registers
+    small = (raw <= 2.5 * m) & (zeros > 0)
+    return np.where(small, m * np.log(m / np.maximum(zeros, 1)), raw)
+
+
+def distinct(registers, ranks, groups, n_groups):
+    # Distinct count estimates of n_groups sketches given as cells (register, rank, group)
+    dense = np.zeros(n_groups * REGISTERS, dtype=np.int8)
+    np.maximum.at(dense, np.asarray(groups, dtype=np.int64) * REGISTERS + registers, ranks)
+    return hll_estimate(dense.reshape(n_groups, REGISTERS))
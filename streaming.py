@@ -0,0 +1,257 @@
+import math
+import os
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import allocation
+import analytics
+import approximate
+import cohort
+import cube
+import data_loader
+import fact_table
+import geo
+import rfm
+
+# Out-of-core aggregation for order histories that do not fit in memory.
+#
+# The dimension tables (CUSTOMERS, PRODUCTS, SELLERS, GEO_LOCATION) are small and
+# stay resident, with just the columns the panels use. The order tables are
+# streamed from the CSVs in chunks (data_loader.read_chunks) in two passes:
+#
+#   1. every chunk of ORDERS, ORDER_ITEMS, ORDER_PAYMENTS and ORDER_REVIEW_RATINGS
+#      is folded into the aggregates that only need file order (new customers,
+#      delivery accuracy, review and payment-type counts, total revenue) and split
+#      by a hash of order_id into partitions spilled to Parquet (one file per table
+#      and partition, each chunk's rows appended as a row group);
+#   2. each partition then holds all rows of its orders, so it is joined against
+#      the dimensions (fact_table), its payments allocated (allocation) and its
+#      cubes, seller/customer totals and geo zip pairs added to the running ones
+#      (Cube.merge, allocation.add_totals, geo.add_pairs, rfm.add,
+#      cohort.add_activity; the delivery sketches merge as cube cells too, and the
+#      approximate-mode sketches with approximate.merge), exactly as analytics.update
+#      adds a batch of new orders.
+#
+# The chunk size and partition count are derived from MARKET_STREAM_MEMORY_MB, so
+# the rows held at any time stay under that ceiling however long the history is;
+# what grows with it are the resident dimensions, the per-seller/per-customer
+# totals (one float each), the zip pairs (at most sellers' x customers' zips) and
+# the cohort activity (one row per customer, month, category and state bought in)
+# and the delivery and approximate-mode sketches (at most one cell per seller,
+# customer state, month and bucket of each metric; per global filter dimension,
+# purchase day and HyperLogLog register or bucket).
+# The result answers the same panels as analytics.Model (see backends.StreamBackend).
+
+MEMORY_MB = int(os.environ.get("MARKET_STREAM_MEMORY_MB", "512"))
+# where partitions are spilled (a temporary directory is created in it; default: the system's)
+SPILL_DIR = os.environ.get("MARKET_STREAM_SPILL_DIR")
+# in-memory bytes per CSV byte of a parsed, joined and aggregated chunk (rough upper bound)
+EXPANSION = 6
+
+FACT_TABLES = ["ORDERS", "ORDER_ITEMS", "ORDER_PAYMENTS", "ORDER_REVIEW_RATINGS"]
+DIM_COLUMNS = {
+    "CUSTOMERS": ["customer_id", *fact_table.CUSTOMER_COLUMNS],
+    "PRODUCTS": ["product_id", *fact_table.PRODUCT_COLUMNS],
+    "SELLERS": ["seller_id", *fact_table.SELLER_COLUMNS],
+    "GEO_LOCATION": ["geolocation_zip_code_prefix", "geolocation_lat", "geolocation_lng"],
+}
+
+# dims: the resident dimension tables; categories: product categories in order of
+# their first item row (analytics.category_options); pairs: geo.item_pairs of all
+# items; rfm: rfm.Totals per distinct customer_unique_id of CUSTOMERS, in order of
+# first appearance, whose positions are also the customer codes of activity; the
+# rest as in analytics.Model
+Aggregates = namedtuple("Aggregates", [
+    "dims", "row_counts", "total_orders", "total_revenue", "categories",
+    "item_cube", "order_cube", "new_customers", "review_counts", "payment_counts",
+    "delivery_counts", "seller_totals", "customer_totals", "pairs", "geo_index", "rfm", "activity",
+    "delivery", "approximate",
+])
+
+
+def plan(data_dir=".", memory_mb=MEMORY_MB, workers=data_loader.LOAD_WORKERS):
+    # (chunk bytes, partition count) that keep a chunk, with the ones read ahead, and a
+    # partition within memory_mb
+    budget = memory_mb << 20
+    fact_bytes = sum(os.path.getsize(os.path.join(data_dir, f"{name}.csv")) for name in FACT_TABLES)
+    chunk_bytes = max(1 << 20, budget // (EXPANSION * (workers + 1)))
+    return chunk_bytes, max(1, math.ceil(fact_bytes * EXPANSION / budget))
+
+
+def aggregate(data_dir=".", memory_mb=MEMORY_MB, spill_dir=SPILL_DIR, workers=data_loader.LOAD_WORKERS,
+              progress=None):
+    # Aggregates of the CSVs in data_dir. progress is called as in data_loader.load_tables,
+    # per chunk of pass 1 and with name "partitions" per partition of pass 2.
+    chunk_bytes, partitions = plan(data_dir, memory_mb, workers)
+    dims = {name: data_loader.read_table(name, os.path.join(data_dir, f"{name}.csv"), columns=columns)
+            for name, columns in DIM_COLUMNS.items()}
+    customers = dims["CUSTOMERS"]
+    seen_customer = np.zeros(len(customers), dtype=bool)
+    seen_unknown = set()
+    counts = {"new_customers": pd.Series(dtype="int64"), "review_counts": pd.Series(dtype="int64"),
+              "payment_counts": pd.Series(dtype="int64"), "delivery_counts": pd.Series(dtype="int64")}
+    totals = {"revenue": 0.0, "item_rows": 0}
+
+    def fold(name, chunk):
+        # pass 1 aggregates, in file order
+        if name == "ORDERS":
+            first = chunk[["customer_id", "order_purchase_timestamp"]].drop_duplicates(subset=["customer_id"])
+            key = fact_table.dense_keys(customers["customer_id"], first["customer_id"])
+            known = key >= 0
+            new = np.zeros(len(first), dtype=bool)
+            new[known] = ~seen_customer[key[known]]
+            seen_customer[key[known]] = True
+            unknown = first["customer_id"].to_numpy()[~known]
+            new[~known] = [value not in seen_unknown for value in unknown]
+            seen_unknown.update(unknown)
+            counts["new_customers"] = analytics.add_counts(
+                counts["new_customers"], analytics.new_customer_counts(first[new]))
+            counts["delivery_counts"] = analytics.add_counts(
+                counts["delivery_counts"], analytics.delivery_accuracy_counts(chunk))
+        elif name == "ORDER_ITEMS":
+            totals["revenue"] += chunk["price"].sum()
+            # the row number in the file, to order the categories by first appearance
+            chunk["item_row"] = np.arange(totals["item_rows"], totals["item_rows"] + len(chunk))
+            totals["item_rows"] += len(chunk)
+        elif name == "ORDER_PAYMENTS":
+            counts["payment_counts"] = analytics.add_counts(
+                counts["payment_counts"], chunk["payment_type"].value_counts())
+        else:
+            counts["review_counts"] = analytics.add_counts(
+                counts["review_counts"], chunk["review_score"].value_counts())
+        return chunk
+
+    row_counts = {}
+    with tempfile.TemporaryDirectory(prefix="market-stream-", dir=spill_dir) as spill:
+        # pass 1: fold and partition
+        empty = {}
+        for name in FACT_TABLES:
+            row_counts[name] = 0
+            with _Spill(spill, name) as spilled:
+                for chunk in data_loader.read_chunks(
+                        name, os.path.join(data_dir, f"{name}.csv"), workers=workers, progress=progress,
+                        chunk_bytes=chunk_bytes):
+                    chunk = fold(name, chunk)
+                    row_counts[name] += len(chunk)
+                    empty.setdefault(name, chunk.iloc[:0])
+                    partition = pd.util.hash_array(chunk["order_id"].to_numpy(dtype=object)) % partitions
+                    for p, rows in chunk.groupby(partition, sort=False):
+                        spilled.write(p, rows)
+
+        # pass 2: join and aggregate each partition
+        item_cube = order_cube = pairs = rfm_totals = activity = delivery_sketch = approx = None
+        unique_customers = customers["customer_unique_id"].unique()
+        seller_totals = np.full(len(dims["SELLERS"]), np.nan)
+        customer_totals = np.full(len(customers), np.nan)
+        total_orders, first_rows = 0, []
+        start, rows_done = time.perf_counter(), 0
+        for p in range(partitions):
+            frames = {name: _read_partition(spill, name, p, empty[name]) for name in FACT_TABLES}
+            orders, items = frames["ORDERS"], frames["ORDER_ITEMS"]
+            item_fact, order_fact = fact_table.build_fact_tables(
+                orders, items, customers, dims["PRODUCTS"], dims["SELLERS"], frames["ORDER_REVIEW_RATINGS"])
+            allocated = allocation.allocate_payments(item_fact, order_fact, frames["ORDER_PAYMENTS"])
+
+            item_cube = _merge(item_cube, cube.build_item_cube(item_fact))
+            order_cube = _merge(order_cube, cube.build_order_cube(order_fact))
+            seller_totals = allocation.add_totals(
+                seller_totals, allocation.totals_by(allocated, "seller_key", len(dims["SELLERS"])))
+            customer_totals = allocation.add_totals(
+                customer_totals, allocation.totals_by(allocated, "customer_key", len(customers)))
+            pairs = geo.add_pairs(pairs, geo.item_pairs(item_fact))
+            part_rfm = rfm.order_totals(
+                order_fact, frames["ORDER_PAYMENTS"],
+                fact_table.dense_keys(unique_customers, order_fact["customer_unique_id"]), len(unique_customers))
+            rfm_totals = part_rfm if rfm_totals is None else rfm.add(rfm_totals, part_rfm)
+            activity = cohort.add_activity(activity, cohort.activity(
+                fact_table.dense_keys(unique_customers, item_fact["customer_unique_id"]), item_fact))
+            delivery_sketch = _merge(delivery_sketch, analytics.delivery_sketch(item_fact))
+            # the resident dimensions' ids are counted with the first partition
+            part_approx = analytics.approximate_sketches(
+                {"ORDERS": orders, **(dims if p == 0 else {})}, item_fact, order_fact, frames["ORDER_PAYMENTS"],
+                dims["PRODUCTS"], dims["SELLERS"])
+            approx = part_approx if approx is None else approximate.merge(approx, part_approx)
+            total_orders += orders["order_id"].nunique()
+            first_rows.append(_first_rows(items, order_fact, dims))
+
+            rows_done += sum(map(len, frames.values()))
+            if progress is not None:
+                progress("partitions", p + 1, partitions, rows_done, time.perf_counter() - start)
+
+    for name in DIM_COLUMNS:
+        row_counts[name] = len(dims[name])
+    first_rows = pd.concat(first_rows).groupby(level=0, observed=True).min().sort_values()
+
+    return Aggregates(
+        dims=dims,
+        row_counts={name: row_counts[name] for name in data_loader.TABLE_ORDER},
+        total_orders=total_orders,
+        total_revenue=totals["revenue"],
+        categories=first_rows.index.to_numpy(),
+        item_cube=item_cube,
+        order_cube=order_cube,
+        seller_totals=seller_totals,
+        customer_totals=customer_totals,
+        pairs=pairs,
+        geo_index=geo.GeoIndex.build(dims["GEO_LOCATION"]),
+        rfm=rfm_totals,
+        activity=activity,
+        delivery=delivery_sketch,
+        approximate=approx,
+        **counts,
+    )
+
+
+class _Spill:
+    # The spill files of one table: one Parquet file per partition, each chunk's rows
+    # of it appended as a row group, so the files stay one per table and partition
+    # however many chunks the history takes
+    def __init__(self, spill, name):
+        self.spill, self.name = spill, name
+        self.writers = {}
+
+    def write(self, p, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(rows, preserve_index=False)
+        writer = self.writers.get(p)
+        if writer is None:
+            writer = self.writers[p] = pq.ParquetWriter(_spill_path(self.spill, self.name, p), table.schema)
+        # the chunk's categoricals have their own categories; the first chunk's schema holds
+        writer.write_table(table.cast(writer.schema))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def _spill_path(spill, name, p):
+    return os.path.join(spill, f"{name}.{p}.parquet")
+
+
+def _read_partition(spill, name, p, empty):
+    # A partition's rows of one table, in file order
+    path = _spill_path(spill, name, p)
+    return pd.read_parquet(path) if os.path.exists(path) else empty
+
+
+def _merge(total, part):
+    return part if total is None else total.merge(part)
+
+
+def _first_rows(items, order_fact, dims):
+    # First file row of each product category among the items that make it into the item fact
+    keep = ((fact_table.dense_keys(order_fact["order_id"], items["order_id"]) >= 0)
+            & (fact_table.dense_keys(dims["SELLERS"]["seller_id"], items["seller_id"]) >= 0))
+    product_key = fact_table.dense_keys(dims["PRODUCTS"]["product_id"], items["product_id"])
+    keep &= product_key >= 0
+    category = dims["PRODUCTS"]["product_category_name"].take(product_key[keep]).to_numpy()
+    return pd.Series(items["item_row"].to_numpy()[keep]).groupby(category, observed=True).min()
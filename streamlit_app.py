@@ -1,8 +1,19 @@
+import math
+import os
+
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
+
+import approximate
+import backends
+import charts
+import cohort
+import delivery
+import filters
+import profiler
+import ranking
+import rfm
+import sketches
+import timeseries
 
 # Set Page Configuration
 st.set_page_config(page_title="Marketing Analysis", layout="wide")
@@ -20,20 +31,52 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+# Per-session profiler: every panel below runs in a named span, shown in the sidebar
+# "Profiler" expander and appended to MARKET_PROFILE_LOG when that is set
+if "profiler" not in st.session_state:
+    st.session_state.profiler = profiler.Profiler()
+prof = st.session_state.profiler
+prof.start_run()
+
 # Load Data
-@st.cache_data
-def load_data():
-    orders = pd.read_csv("ORDERS.csv")
-    order_items = pd.read_csv("ORDER_ITEMS.csv")
-    customers = pd.read_csv("CUSTOMERS.csv")
-    products = pd.read_csv("PRODUCTS.csv")
-    sellers = pd.read_csv("SELLERS.csv")
-    payments = pd.read_csv("ORDER_PAYMENTS.csv")
-    reviews = pd.read_csv("ORDER_REVIEW_RATINGS.csv")
-    geolocation = pd.read_csv("GEO_LOCATION.csv")
-    return orders, order_items, customers, products, sellers, payments, reviews, geolocation
-
-orders, order_items, customers, products, sellers, payments, reviews, geolocation = load_data()
+# Panels are answered by a query backend (backends.py, chosen with MARKET_BACKEND):
+# the in-memory pandas model built once per data version, or an embedded SQL
+# database that only returns aggregates. Both pick up batches appended with
+# ingest.py incrementally. cache_resource hands every rerun the same backend, so
+# the frames it returns must be treated as read-only.
+@st.cache_resource
+def query_backend():
+    return backends.create()
+
+# A (re)load of the tables shows per-table progress until it is done
+load_status = st.empty()
+
+def show_load_progress(name, done, total, rows, seconds):
+    load_status.progress(done / total, text=f"Loading {name}: {rows:,} rows in {seconds:.1f} s")
+
+with prof.span("Load data") as span:
+    backend = query_backend()
+    data_version = backend.refresh(progress=show_load_progress)
+    rows = backend.row_counts()
+    span.rows = rows["ORDER_ITEMS"]
+load_status.empty()
+
+# Panel results per data version, global filters (filters.Filters, the context) and
+# panel inputs, shared by every session, so a rerun only computes what a changed
+# input or a new data version invalidated
+@st.cache_data(max_entries=512, show_spinner=False)
+def panel_data(version, context, panel, *args):
+    return getattr(query_backend().filtered(context), panel)(*args)
+
+# Figures per (data version, panel, panel inputs, chart inputs), least recently used
+# evicted past MARKET_FIGURE_CACHE entries. cache_resource hands back the Figure
+# itself rather than a copy (building one with plotly.express costs far more than
+# Streamlit serializing it), so cached figures must not be modified.
+FIGURE_CACHE_ENTRIES = int(os.environ.get("MARKET_FIGURE_CACHE", "256"))
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES, show_spinner=False)
+def panel_figure(version, context, panel, panel_args, chart, *chart_args):
+    return getattr(charts, chart)(panel_data(version, context, panel, *panel_args), *chart_args)
 
 # Sidebar Title
 st.sidebar.markdown(
@@ -59,47 +102,48 @@ st.sidebar.markdown(
     unsafe_allow_html=True
 )
 
+# Approximate mode: headline counts and the yearly heatmap read from sketches
+# (approximate.py) instead of exact distinct counts, with the error bound shown;
+# off unless toggled or MARKET_APPROXIMATE=1
+approximate_mode = st.sidebar.toggle(
+    "Approximate mode", value=os.environ.get("MARKET_APPROXIMATE", "0") == "1",
+    help=f"Distinct counts within ±{approximate.ERRORS['distinct']:.1%}, "
+         f"percentiles within ±{approximate.ERRORS['percentile']:.0%}")
+
+# Global filters: every panel is computed for the orders and items that pass them,
+# evaluated on bitmap indexes the backend builds once per data version (filters.py).
+# The per-panel filters below narrow a panel further.
+st.sidebar.header("Global Filters")
+global_filters = filters.NONE
+if backend.supports_filters:
+    filter_options = panel_data(data_version, filters.NONE, "filter_options")
+    start = end = None
+    if filter_options["dates"]:
+        first, last = filter_options["dates"]
+        dates = st.sidebar.date_input("Purchase dates", value=(first, last), min_value=first, max_value=last)
+        # the full range, or a range still being picked, leaves that side open
+        start = dates[0] if len(dates) > 0 and dates[0] != first else None
+        end = dates[1] if len(dates) > 1 and dates[1] != last else None
+    chosen = {field: tuple(st.sidebar.multiselect(label, options=filter_options[field], placeholder="All"))
+              for field, (label, _) in {**filters.ORDER_DIMS, **filters.ITEM_DIMS}.items()}
+    global_filters = filters.Filters(start, end, **{field: values or None for field, values in chosen.items()})
+else:
+    st.sidebar.caption("Global filters need the pandas backend (MARKET_BACKEND=pandas).")
+
 # Sidebar Filters
+# Each filter is drawn by the fragment of the panels that read it (below), so
+# changing it reruns only those panels; these slots keep the filters' places.
 st.sidebar.header("Filters")
-
-top_n = st.sidebar.number_input(
-    "Enter the number of products to display (from 1 to 71)",
-    min_value=1,
-    max_value=71,
-    value=10,  # Default to showing all products
-    step=1,
-    help="Enter a number between 1 and 71 to filter the number of products"
-)
-
-# Move the region select dropdown to the sidebar
-selected_region = st.sidebar.selectbox(
-    "Select Region For Revenue Analysis",
-    options=sellers['seller_state'].unique(),
-    index=0
-)
-
-# Merge DataFrames to include required fields 
-merged_df = (
-    order_items
-    .merge(orders, on="order_id")
-    .merge(products, on="product_id")
-    .merge(customers, on="customer_id")
-    .merge(sellers, on="seller_id")
-)
-
-# Add a "Region" column based on customer state
-merged_df["Region"] = merged_df["customer_state"]
-
-# Calculate revenue for each product-region combination
-merged_df["Revenue"] = merged_df["price"]
-
-# Create a sidebar for product selection
-product_options = merged_df["product_category_name"].dropna().unique()
-selected_product = st.sidebar.selectbox(
-    "Select a Product Category Analysis:",
-    options=product_options,
-    index=0  # Default to the first product
-)
+approximate_slot = st.sidebar.container()
+top_n_slot = st.sidebar.container()
+region_slot = st.sidebar.container()
+product_slot = st.sidebar.container()
+granularity_slot = st.sidebar.container()
+segment_slot = st.sidebar.container()
+cohort_slot = st.sidebar.container()
+delivery_slot = st.sidebar.container()
+map_slot = st.sidebar.container()
+ranking_slot = st.sidebar.container()
 
 # Sidebar Additional Information
 st.sidebar.markdown("---")
@@ -111,7 +155,7 @@ st.sidebar.text("Use the filters above to refine data.")
 with st.container():
     # Add a subheading for the section
     st.markdown("<h2 style='margin-top: -70px;'>Overview</h2>", unsafe_allow_html=True)
-    
+
     # CSS Style for Metrics
     metric_style = """
         <style>
@@ -120,7 +164,7 @@ with st.container():
             justify-content: space-between;
             margin-top: -20px; /* Adjusted margin to ensure no overlap */
             gap: 20px;
-            width: 100%; 
+            width: 100%;
             padding: 0px;
         }
         .metric-box {
@@ -147,47 +191,75 @@ with st.container():
     st.markdown(metric_style, unsafe_allow_html=True)
 
     # Calculate Metrics
-    total_products = products['product_id'].nunique()
-    total_revenue = order_items['price'].sum() #+ order_items['freight_value'].sum()
-    total_sellers = sellers['seller_id'].nunique()
-    total_customers = customers['customer_id'].nunique()
-    total_orders = orders['order_id'].nunique() 
+    with prof.span("Overview", rows=sum(rows[name] for name in ["PRODUCTS", "ORDER_ITEMS", "SELLERS", "CUSTOMERS", "ORDERS"])):
+        kpis = panel_data(data_version, global_filters, "approximate_kpis" if approximate_mode else "overview_kpis")
+    # estimated counts are marked as such
+    about = "≈" if approximate_mode else ""
+    if filters.active(global_filters):
+        st.caption(f"Filtered to {filters.describe(global_filters)}")
 
     # Display Metrics
     metric_html = f"""
     <div class="metric-container">
         <div class="metric-box">
             <div class="metric-title">Total Products</div>
-            <div class="metric-value">{total_products}</div>
+            <div class="metric-value">{about}{kpis['total_products']}</div>
         </div>
         <div class="metric-box">
             <div class="metric-title">Total Revenue</div>
-            <div class="metric-value">${total_revenue:,.2f}</div>
+            <div class="metric-value">${kpis['total_revenue']:,.2f}</div>
         </div>
         <div class="metric-box">
             <div class="metric-title">Total Sellers</div>
-            <div class="metric-value">{total_sellers}</div>
+            <div class="metric-value">{about}{kpis['total_sellers']}</div>
         </div>
         <div class="metric-box">
             <div class="metric-title">Total Customers</div>
-            <div class="metric-value">{total_customers}</div>
+            <div class="metric-value">{about}{kpis['total_customers']}</div>
         </div>
         <div class="metric-box">
         <div class="metric-title">Total Orders</div>
-        <div class="metric-value">{total_orders}</div>
+        <div class="metric-value">{about}{kpis['total_orders']}</div>
     </div>
     </div>
     """
     st.markdown(metric_html, unsafe_allow_html=True)
-
-# Merge order_items with products to get product names
-
-merged_data = order_items.merge(products, on="product_id")
-
-# Calculate revenue by product category
-product_revenue = merged_data.groupby('product_category_name')['price'].sum().reset_index()
-product_revenue = product_revenue.sort_values(by='price', ascending=False)
-
+    if approximate_mode:
+        st.caption(f"Approximate mode: counts are HyperLogLog estimates within ±{approximate.ERRORS['distinct']:.1%} "
+                   "(one standard error) of the exact ones; revenue is exact.")
+
+
+# --- Approximate slice ---
+# Distinct counts and price/payment percentiles of the items of one customer state
+# and/or category, merged from the per-(state, category, month) sketches at query
+# time; shown in approximate mode only and reads its own filters
+@st.fragment
+def approximate_slice(version, context, rows, filter_slot):
+    filter_slot.markdown("Approximate Slice")
+    state = filter_slot.selectbox("Slice customer state",
+                                  options=[None, *panel_data(version, filters.NONE, "ranking_groups", "customer_state")],
+                                  format_func=lambda value: "All" if value is None else value)
+    category = filter_slot.selectbox("Slice category", options=[None, *panel_data(version, filters.NONE, "category_options")],
+                                     format_func=lambda value: "All" if value is None else value)
+    where = ", ".join(value for value in (state, category) if value) or "all items"
+    with prof.run("Approximate Slice"), prof.span("Approximate Slice", rows=rows["ORDER_ITEMS"]):
+        counts = panel_data(version, context, "approximate_counts", state, category)
+        values = panel_data(version, context, "value_percentiles", state, category).set_index("value")
+        st.markdown(f"#### Approximate Slice: {where}")
+        columns = st.columns(len(counts) + 2 * len(approximate.QUANTILE_COLUMNS))
+        for column, (name, count) in zip(columns, counts.items()):
+            column.metric(f"{name.removesuffix('_id').title()}s", f"≈{count:,}")
+        quantiles = [(value, quantile) for value in approximate.VALUES for quantile in approximate.QUANTILE_COLUMNS]
+        for column, (value, quantile) in zip(columns[len(counts):], quantiles):
+            amount = values.loc[value, quantile]
+            column.metric(f"{value.title()} {quantile}", "–" if math.isnan(amount) else f"${amount:,.2f}")
+        st.caption(f"Distinct counts within ±{approximate.ERRORS['distinct']:.1%} (one standard error), "
+                   f"price and allocated payment percentiles within ±{approximate.ERRORS['percentile']:.0%} "
+                   "of the exact values.")
+
+
+if approximate_mode:
+    approximate_slice(data_version, global_filters, rows, approximate_slot)
 
 ##This is Revenue per region
 # Custom CSS for box styling
@@ -205,167 +277,91 @@ st.markdown(
     """,
     unsafe_allow_html=True,
 )
-# Create two columns for side-by-side display
-col1, col2 = st.columns(2)
-
-
-# Display the region select dropdown and the table in col1
-with col1:
+# Reads top_n only
+@st.fragment
+def product_analysis(version, context, rows, filter_slot):
+    top_n = filter_slot.number_input(
+        "Enter the number of products to display (from 1 to 71)",
+        min_value=1,
+        max_value=71,
+        value=10,  # Default to showing all products
+        step=1,
+        help="Enter a number between 1 and 71 to filter the number of products"
+    )
         # Bar Chart: Product vs Revenue
     st.subheader("Product Analysis")
 
-    # Merge order_items with products to get product names
-    merged_data = order_items.merge(products, on="product_id")
-
-    # Calculate revenue by product
-    product_revenue = merged_data.groupby('product_category_name')['price'].sum().reset_index()
-    product_revenue = product_revenue.sort_values(by='price', ascending=False)
+    with prof.run("Product Analysis"), prof.span("Product Analysis", rows=rows["ORDER_ITEMS"]):
+        # Revenue by product category, top N if selected
+        fig = panel_figure(version, context, "category_revenue", (), "category_revenue_bar", top_n)
 
-    # User selection for the number of products to display (input box)
+        # Display the chart
+        st.plotly_chart(fig, key="category_revenue_chart", use_container_width=False)  # Disable container width for better fit
 
-    # Filter for top N products if selected
-    filtered_product_revenue = product_revenue.head(top_n)
 
-    # Set the title dynamically based on user input
-    title = f"Top {top_n} Product Categories by Revenue" if top_n < len(product_revenue) else "All Product Categories by Revenue"
-
-    # Plot bar chart
-    fig = px.bar(
-        filtered_product_revenue,
-        x='product_category_name',
-        y='price',
-        labels={'product_category_name': 'Product Category', 'price': 'Revenue'},
-        title=title,
-        color='price',
-        color_continuous_scale='Viridis'
+# Reads selected_region only
+@st.fragment
+def regional_revenue(version, context, rows, filter_slot):
+    # Move the region select dropdown to the sidebar
+    selected_region = filter_slot.selectbox(
+        "Select Region For Revenue Analysis",
+        options=panel_data(version, filters.NONE, "region_options"),
+        index=0
     )
+    with prof.run("Regional Revenue"), prof.span("Regional Revenue", rows=rows["ORDER_ITEMS"]):
+        # Product categories and revenue in the selected region (seller_state), sorted by category name
+        fig = panel_figure(version, context, "region_category_revenue", (selected_region,), "region_revenue_line", selected_region)
 
-    # Update layout for compact display and remove text labels
-    fig.update_layout(
-        xaxis=dict(
-            showticklabels=False  # Hide x-axis labels
-        ),
-        xaxis_title="Product Category",
-        yaxis_title="Revenue",
-        xaxis_tickangle=-45,
-        height=250,  # Further reduced height
-        width=500,   # Reduced width for compactness
-        margin=dict(t=20, b=20, l=30, r=30),  # Tight margins
-        title=dict(font=dict(size=12)),  # Reduced title font size
+        # Display the line chart
+        st.plotly_chart(fig, key="region_category_revenue_chart", use_container_width=True)
 
-    )
 
-    # Remove text labels on the bars
-    fig.update_traces(texttemplate=None)
+# Create two columns for side-by-side display
+col1, col2 = st.columns(2)
 
-    # Display the chart
-    st.plotly_chart(fig, use_container_width=False)  # Disable container width for better fit
 
+# Display the region select dropdown and the table in col1
+with col1:
+    product_analysis(data_version, global_filters, rows, top_n_slot)
 
-    
 # Display the chart in col2
 with col2:
-    # Always show the line chart
-    # Display the title for the table
-    # Sort region_product_revenue by product category name in alphabetical order
-    # Filter orders by region (seller_state)
-    
-    filtered_sellers = sellers[sellers['seller_state'] == selected_region]
-    filtered_orders = order_items[order_items['seller_id'].isin(filtered_sellers['seller_id'])]
-
-    # Merge to get product categories and revenue in the selected region
-    region_product_revenue = filtered_orders.merge(products, on="product_id")
-    region_product_revenue = region_product_revenue.groupby('product_category_name')['price'].sum().reset_index()
-    region_product_revenue = region_product_revenue.sort_values(by='product_category_name', ascending=True)
-    
-    # Calculate total revenue for the selected region
-    total_revenue_region = filtered_orders['price'].sum()
-
-    # Create a line chart to visualize the product categories and their revenue
-    fig = px.line(
-        region_product_revenue,
-        x='product_category_name',
-        y='price',
-        title=f'Product Categories and Revenue in {selected_region}',
-        labels={'product_category_name': 'Product Category', 'price': 'Revenue'},
-        markers=True
-    )
-    # Add annotation for total revenue along the x-axis
-    fig.add_annotation(
-        text=f"Total Revenue in {selected_region}: ${total_revenue_region:,.2f}",
-        x=0.5,  # Centered along the x-axis
-        y=1.3,  # Below the x-axis
-        xref="paper", yref="paper",  # Position relative to the paper space
-        showarrow=False,
-        font=dict(size=12, color="black"),  # Adjust font size and color
-        align="center",
-        bgcolor="rgba(255, 255, 255, 0.8)",  # Semi-transparent background for readability
-        borderwidth=1,
-        
-    )
-    # Update layout to hide x-axis labels by default and show them on hover
-    fig.update_layout(
-        xaxis=dict(
-            showticklabels=False,  # Hide x-axis labels by default
-        ),
-        hovermode='x unified',  # Show product names when hovering over the line
-        xaxis_tickangle=-45,
-        height=400,
-        margin=dict(t=120, b=120),  # Increase bottom margin for better label visibility
-    )
+    regional_revenue(data_version, global_filters, rows, region_slot)
 
-    # Display the line chart
-    st.plotly_chart(fig, use_container_width=True)
 
-    
 # --- New Customers Acquisition Analysis ---
-# Create a container for the new customers and review scores visualization
-
-with st.container():
-    # --- Process the 'new_customers' data ---
-    new_customers = orders[['customer_id', 'order_purchase_timestamp']].copy()
-    new_customers = new_customers.drop_duplicates(subset=['customer_id'])
-
-    # Extract Year and Month information
-    new_customers['order_month'] = pd.to_datetime(new_customers['order_purchase_timestamp']).dt.month
-    new_customers['order_year'] = pd.to_datetime(new_customers['order_purchase_timestamp']).dt.year
-    new_customers['Month_Year'] = new_customers['order_year'].astype(str) + "-" + new_customers['order_month'].astype(str)
-
-    # Order the dates for better visualization
-    dates = ['2016-9', '2016-10', '2016-12', '2017-1', '2017-2', '2017-3', '2017-4',  '2017-5', 
-             '2017-6', '2017-7', '2017-8','2017-9', '2017-10', '2017-11', '2017-12', '2018-1', 
-             '2018-2', '2018-3', '2018-4', '2018-5', '2018-6', '2018-7', '2018-8']
-
-    new_customers['Month_Year'] = pd.Categorical(new_customers['Month_Year'], categories=dates, ordered=True)
-    new_customers = new_customers.sort_values(by='Month_Year')
-
-    # Count the number of customers per month
-    n_Cust_in_every_month = new_customers.groupby("Month_Year")["customer_id"].count().reset_index()
+# Reads granularity only
+@st.fragment
+def new_customers(version, context, rows, filter_slot):
+    granularity = filter_slot.selectbox(
+        "New Customers per",
+        options=timeseries.GRANULARITIES,
+        index=timeseries.GRANULARITIES.index("month"),
+    )
+    # Count the number of new customers per period, over every period with orders
+    with prof.run("New Customers"), prof.span("New Customers", rows=rows["ORDERS"]):
+        fig1 = panel_figure(version, context, "new_customers_by_period", (granularity,), "new_customers_line", granularity)
 
-    # Create an interactive plot with Plotly
-    fig1 = px.line(n_Cust_in_every_month, x='Month_Year', y='customer_id',
-                   labels={'Month_Year': 'Month', 'customer_id': 'New Customers'},
-                   markers=True)
+    st.markdown(
+        "<h6 style='text-align: center; font-weight: bold; margin-bottom: -20px;margin-top: -80px;'>New Customers</h6>",
+        unsafe_allow_html=True,
+    )
+    st.plotly_chart(fig1, key="new_customers_chart", use_container_width=True)
 
-    # Customize hover information
-    fig1.update_traces(mode='lines+markers', hovertemplate='%{x}: %{y} new customers')
 
-    # Adjust size for ultra-compact display
-    fig1.update_layout(width=200, height=200, margin=dict(l=5, r=5, t=0, b=5))
+# Create a container for the new customers and review scores visualization
 
+with st.container():
     # --- Frequent Review Scores Visualization ---
-    item_counts = reviews['review_score'].value_counts().sort_index()
+    with prof.span("Review Scores", rows=rows["ORDER_REVIEW_RATINGS"]):
+        fig2 = panel_figure(data_version, global_filters, "review_histogram", (), "review_scores_bar")
 
     # Create a side-by-side layout in Streamlit
     col1, col2 = st.columns(2)
 
     # Place the New Customers Acquisition plot in the first column
     with col1:
-        st.markdown(
-            "<h6 style='text-align: center; font-weight: bold; margin-bottom: -20px;margin-top: -80px;'>New Customers</h6>",
-            unsafe_allow_html=True,
-        )
-        st.plotly_chart(fig1, use_container_width=True)
+        new_customers(data_version, global_filters, rows, granularity_slot)
 
     # Place the Frequent Review Scores plot in the second column
     with col2:
@@ -374,34 +370,26 @@ with st.container():
             unsafe_allow_html=True,
         )
 
-        # Bar chart for frequent review scores using Plotly
-        fig2 = px.bar(
-            x=item_counts.index,
-            y=item_counts.values,
-            labels={"x": "Review", "y": "Freq"},
-            text=item_counts.values,
-            color=item_counts.values,
-            color_continuous_scale="Blues",
-        )
-
-        # Customize layout for ultra-compact display
-        fig2.update_traces(texttemplate='%{text}', textposition='outside', marker_line_width=0.5)
-        fig2.update_layout(
-            xaxis_title="Score",
-            yaxis_title="Freq",
-            coloraxis_showscale=False,
-            width=200,  # Further reduced width
-            height=200,  # Further reduced height
-            margin=dict(l=5, r=5, t=0, b=5),
-        )
-
         # Add the Plotly chart to Streamlit
-        st.plotly_chart(fig2, use_container_width=True)
+        st.plotly_chart(fig2, key="review_scores_chart", use_container_width=True)
 
 
 ####
 
-# Create four columns for displaying the pie charts in a single row
+# Customers (per customer_unique_id, so repeat buyers count once) per RFM segment;
+# reads the scoring only
+@st.fragment
+def customer_segmentation(version, context, rows, filter_slot):
+    scoring = filter_slot.selectbox(
+        "Customer Segments scored by",
+        options=rfm.SCORINGS,
+        format_func={"quantile": "Quintiles", "fixed": "Fixed thresholds"}.get,
+    )
+    with prof.run("Customer Segmentation"), prof.span("Customer Segmentation", rows=rows["ORDERS"] + rows["ORDER_PAYMENTS"]):
+        fig_customer_segmentation = panel_figure(version, context, "rfm_segments", (scoring,), "pie",
+                                                 'Segment', 'Customer Segmentation', 0.4)
+        st.plotly_chart(fig_customer_segmentation, key="customer_segments_chart", use_container_width=True)
+
 
 # Create four columns for displaying the pie charts in a single row
 col1, col2, col3, col4 = st.columns(4)
@@ -409,233 +397,89 @@ col1, col2, col3, col4 = st.columns(4)
 # Place the first pie chart (Payment Types) in the first column
 with col1:
     st.markdown('<div class="custom-box">', unsafe_allow_html=True)  # Start box
-    payment_type_counts = payments['payment_type'].value_counts().reset_index()
-    payment_type_counts.columns = ['Payment_Type', 'Count']
-    
-    fig_payment_type = px.pie(payment_type_counts, 
-                              names='Payment_Type', 
-                              values='Count', 
-                              title='Payment Types',
-                              color='Payment_Type', 
-                              color_discrete_sequence=px.colors.sequential.Plasma)
-    
-    fig_payment_type.update_layout(height=300, width=300)
-    st.plotly_chart(fig_payment_type, use_container_width=True)
+    with prof.span("Payment Types", rows=rows["ORDER_PAYMENTS"]):
+        fig_payment_type = panel_figure(data_version, global_filters, "payment_mix", (), "pie", 'Payment_Type', 'Payment Types')
+        st.plotly_chart(fig_payment_type, key="payment_types_chart", use_container_width=True)
 
 # Place the second pie chart (Delivery Accuracy) in the second column
 with col2:
     st.markdown('<div class="custom-box">', unsafe_allow_html=True)  # Start box
-    orders['order_delivered_customer_date'] = pd.to_datetime(orders['order_delivered_customer_date'], errors='coerce')
-    orders['order_estimated_delivery_date'] = pd.to_datetime(orders['order_estimated_delivery_date'], errors='coerce')
-    
-    orders['Delivery Accuracy'] = pd.cut(
-        (orders['order_delivered_customer_date'] - orders['order_estimated_delivery_date']).dt.days,
-        bins=[-float('inf'), -1, 0, float('inf')],
-        labels=['Before', 'On Time', 'After']
-    )
-    
-    delivery_accuracy_counts = orders['Delivery Accuracy'].value_counts().reset_index()
-    delivery_accuracy_counts.columns = ['Delivery Accuracy', 'Count']
-    delivery_accuracy_counts_filtered = delivery_accuracy_counts[delivery_accuracy_counts['Delivery Accuracy'].isin(['Before', 'After'])]
-    
-    fig_delivery_accuracy = px.pie(delivery_accuracy_counts_filtered, 
-                                    names='Delivery Accuracy', 
-                                    values='Count', 
-                                    title='Delivery Accuracy',
-                                    color='Delivery Accuracy', 
-                                    color_discrete_sequence=px.colors.sequential.Plasma)
-    
-    fig_delivery_accuracy.update_layout(height=300, width=300)
-    st.plotly_chart(fig_delivery_accuracy, use_container_width=True)
-
-# Place the third pie chart (Seller Segmentation) in the third column
+    with prof.span("Delivery Accuracy", rows=rows["ORDERS"]):
+        fig_delivery_accuracy = panel_figure(data_version, global_filters, "delivery_accuracy", (), "pie",
+                                             'Delivery Accuracy', 'Delivery Accuracy')
+        st.plotly_chart(fig_delivery_accuracy, key="delivery_accuracy_chart", use_container_width=True)
+
 # Place the third doughnut chart (Seller Segmentation) in the third column
 with col3:
     st.markdown('<div class="custom-box">', unsafe_allow_html=True)  # Start box
-    order_items_payments = pd.merge(order_items, payments, on="order_id", how="inner")
-    Supp_Revenue = order_items_payments.groupby(['seller_id']).agg({'payment_value': 'sum'}).reset_index()
-    Supp_Revenue = Supp_Revenue[Supp_Revenue['payment_value'] >= 0]
-    bins = [0, 100, 400, float('inf')]
-    labels = ['Low', 'High', 'Top']
-    Supp_Revenue['payment_value_GROUP'] = pd.cut(Supp_Revenue['payment_value'], bins=bins, labels=labels, right=False)
-    
-    payment_value_counts = Supp_Revenue['payment_value_GROUP'].value_counts().reset_index()
-    payment_value_counts.columns = ['Payment Value Group', 'Count']
-    
-    fig_seller_segmentation = px.pie(payment_value_counts,
-                                     names='Payment Value Group',
-                                     values='Count',
-                                     title='Seller Segmentation',
-                                     color='Payment Value Group',
-                                     color_discrete_sequence=px.colors.sequential.Plasma)
-    
-    # Add the hole parameter to convert it into a doughnut chart
-    fig_seller_segmentation.update_traces(hole=0.4)
-    fig_seller_segmentation.update_layout(height=300, width=300)
-    st.plotly_chart(fig_seller_segmentation, use_container_width=True)
-
-
-# Place the fourth pie chart (Customer Segmentation) in the fourth column
+    with prof.span("Seller Segmentation", rows=rows["ORDER_ITEMS"] + rows["ORDER_PAYMENTS"]):
+        fig_seller_segmentation = panel_figure(data_version, global_filters, "seller_segments", (), "pie",
+                                               'Payment Value Group', 'Seller Segmentation', 0.4)
+        st.plotly_chart(fig_seller_segmentation, key="seller_segments_chart", use_container_width=True)
+
+
 # Place the fourth doughnut chart (Customer Segmentation) in the fourth column
 with col4:
     st.markdown('<div class="custom-box">', unsafe_allow_html=True)  # Start box
-    Sales_by_product_payments = pd.merge(order_items, payments, on="order_id", how="inner")
-    Sales_by_product_payments = pd.merge(Sales_by_product_payments, orders[['order_id', 'customer_id']], on="order_id", how="inner")
-    Customer_Revenue = Sales_by_product_payments.groupby(['customer_id']).agg({'payment_value': 'sum'}).reset_index()
-    Customer_Revenue = Customer_Revenue[Customer_Revenue['payment_value'] >= 0]
-    Customer_Revenue['Payment_Group'] = pd.cut(Customer_Revenue['payment_value'], bins=bins, labels=labels, right=False)
-    
-    customer_payment_counts = Customer_Revenue['Payment_Group'].value_counts().reset_index()
-    customer_payment_counts.columns = ['Payment Group', 'Count']
-    
-    fig_customer_segmentation = px.pie(customer_payment_counts,
-                                       names='Payment Group',
-                                       values='Count',
-                                       title='Customer Segmentation',
-                                       color='Payment Group',
-                                       color_discrete_sequence=px.colors.sequential.Plasma)
-    
-    # Add the hole parameter to convert it into a doughnut chart
-    fig_customer_segmentation.update_traces(hole=0.4)
-    fig_customer_segmentation.update_layout(height=300, width=300)
-    st.plotly_chart(fig_customer_segmentation, use_container_width=True)
-
-
-###This is top 3 regions that are high in revenue of a particular product
-# Filter data for the selected product
-filtered_df = merged_df[merged_df["product_category_name"] == selected_product]
-
-# Group by Region and calculate total revenue
-region_revenue = (
-    filtered_df.groupby("Region")["Revenue"].sum()
-    .reset_index()
-    .sort_values(by="Revenue", ascending=False)
-)
-
-# Get top 3 regions
-top_regions = region_revenue.head(3)
+    customer_segmentation(data_version, global_filters, rows, segment_slot)
 
-# --- Top 3 Sellers ---
-# Aggregate payment values by seller (from 'order_items_payments')
-top_sellers = order_items_payments.groupby('seller_id')['payment_value'].sum().reset_index()
 
-# Sort sellers by payment value in descending order
-top_sellers_sorted = top_sellers.sort_values(by='payment_value', ascending=False).head(3)
-
-# Merge with the sellers dataframe to get seller's city or state (instead of 'seller_name')
-top_sellers_sorted = top_sellers_sorted.merge(sellers[['seller_id', 'seller_city', 'seller_state']], on='seller_id', how='left')
-
-# --- Top 3 Customers ---
-# Aggregate payment values by customer (from 'Sales_by_product_payments')
-top_customers = Sales_by_product_payments.groupby('customer_id')['payment_value'].sum().reset_index()
-
-# Sort customers by payment value in descending order
-top_customers_sorted = top_customers.sort_values(by='payment_value', ascending=False).head(3)
-
-# Merge with the customers dataframe to get customer names (optional)
-top_customers_sorted = top_customers_sorted.merge(customers[['customer_id', 'customer_city', 'customer_state']], on='customer_id', how='left')
-
-
-# --- Compute Metrics for Selected Product ---
-average_rating = reviews.merge(order_items, on="order_id") \
-                        .merge(products, on="product_id") \
-                        .query("product_category_name == @selected_product")["review_score"].mean()
-
-average_price = merged_df[merged_df["product_category_name"] == selected_product]["price"].mean()
-total_revenue = merged_df[merged_df["product_category_name"] == selected_product]["Revenue"].sum()
+# Reads selected_product only; draws into the first two columns of the row below
+@st.fragment
+def selected_product_panels(version, context, rows, filter_slot, regions_column, metrics_column):
+    # Create a sidebar for product selection
+    selected_product = filter_slot.selectbox(
+        "Select a Product Category Analysis:",
+        options=panel_data(version, filters.NONE, "category_options"),
+        index=0  # Default to the first product
+    )
+    with prof.run("Selected Product"):
+        ###This is top 3 regions that are high in revenue of a particular product
+        with prof.span("Top 3 Regions", rows=rows["ORDER_ITEMS"]):
+            fig = panel_figure(version, context, "top_regions", (selected_product, 3), "top_regions_bar", selected_product)
+
+        # --- Compute Metrics for Selected Product ---
+        with prof.span("Product Metrics", rows=rows["ORDER_ITEMS"]):
+            product_metrics = panel_data(version, context, "product_metrics", selected_product)
+
+        # --- Column 1: Top 3 Regions by Revenue ---
+        with regions_column, prof.span("Top 3 Regions"):
+            st.plotly_chart(fig, key="top_regions_chart", use_container_width=True)
+
+        # --- Column 2: Metric Cards ---
+        with metrics_column:
+            st.markdown("#####  Product Metrics")
+            st.metric(label="Average Rating", value=f"{product_metrics['average_rating']:.2f}")
+            st.metric(label="Average Price", value=f"${product_metrics['average_price']:,.2f}")
+            st.metric(label="Total Revenue", value=f"${product_metrics['total_revenue']:,.2f}")
+
+
+# --- Top 3 Sellers and Customers by allocated payment value ---
+with prof.span("Top 3 Sellers/Customers", rows=rows["ORDER_ITEMS"] + rows["ORDER_PAYMENTS"]):
+    fig_sellers = panel_figure(data_version, global_filters, "top_sellers", (3,), "top_revenue_bar",
+                               "seller_id", "seller_state", "Top 3 Sellers by Revenue")
+    fig_customers = panel_figure(data_version, global_filters, "top_customers", (3,), "top_revenue_bar",
+                                 "customer_id", "customer_state", "Top 3 Customers by Revenue")
 
 # Display results and graphs side by side
 col1, col2, col3 = st.columns([4,2,2])
 
-# --- Column 1: Top 3 Regions by Revenue ---
-with col1:
-    fig = px.bar(
-        top_regions,
-        x="Region",
-        y="Revenue",
-        title=f"Top 3 Regions by Revenue for Product Category: {selected_product}",
-        labels={"Revenue": "Revenue ($)", "Region": "Region"},
-        color="Region",
-        height=350  # Adjusted height
-    )
-    fig.update_layout(
-        margin=dict(l=0, r=0, t=30, b=0)
-    )
-    st.plotly_chart(fig, use_container_width=True)
-    
-# --- Column 2: Metric Cards ---
-with col2:
-    st.markdown("#####  Product Metrics")
-    st.metric(label="Average Rating", value=f"{average_rating:.2f}")
-    st.metric(label="Average Price", value=f"${average_price:,.2f}")
-    st.metric(label="Total Revenue", value=f"${total_revenue:,.2f}")
+selected_product_panels(data_version, global_filters, rows, product_slot, col1, col2)
 
 # --- Column 3: Top 3 Sellers and Customers ---
-with col3:
+with col3, prof.span("Top 3 Sellers/Customers"):
     # Top 3 Sellers by Revenue
-    fig_sellers = px.bar(
-        top_sellers_sorted,
-        x="payment_value",
-        y="seller_id",
-        orientation="h",
-        color="seller_state",
-        text="payment_value",  # Show the revenue inside the bar
-        labels={"payment_value": "Revenue", "seller_state": "State"},
-        title="Top 3 Sellers by Revenue",
-    )
-    fig_sellers.update_traces(texttemplate='%{text:.2s}', textposition='inside')
-    fig_sellers.update_layout(
-        yaxis=dict(title="", showticklabels=False),  # Remove y-axis title to save space
-        xaxis=dict(title="Revenue"),
-        height=180,  # Reduced height
-        margin=dict(l=50, r=50, t=30, b=30),  # Adjusted margins
-        showlegend=False,  # Hide legend if not necessary
-    )
-    st.plotly_chart(fig_sellers, use_container_width=True)
+    st.plotly_chart(fig_sellers, key="top_sellers_chart", use_container_width=True)
 
     # Top 3 Customers by Revenue
-    fig_customers = px.bar(
-        top_customers_sorted,
-        x="payment_value",
-        y="customer_id",
-        orientation="h",
-        color="customer_state",
-        text="payment_value",  # Show the revenue inside the bar
-        labels={"payment_value": "Revenue", "customer_state": "State"},
-        title="Top 3 Customers by Revenue",
-    )
-    fig_customers.update_traces(texttemplate='%{text:.2s}', textposition='inside')
-    fig_customers.update_layout(
-        yaxis=dict(title="", showticklabels=False),  # Remove y-axis title to save space
-        xaxis=dict(title="Revenue"),
-        height=180,  # Reduced height
-        margin=dict(l=50, r=50, t=30, b=30),  # Adjusted margins
-        showlegend=False,  # Hide legend if not necessary
-    )
-    st.plotly_chart(fig_customers, use_container_width=True)
-    
- ### This is heatnap and Top 3 customers and sellers   
-# --- Data Preparation ---
-# Merging Customers and Orders to get state information
-customers_orders = pd.merge(customers, orders, on="customer_id", how="inner")
+    st.plotly_chart(fig_customers, key="top_customers_chart", use_container_width=True)
 
-# Add 'Purchased_Year' column to extract the year of purchase
-customers_orders["Purchased_Year"] = pd.to_datetime(customers_orders["order_purchase_timestamp"]).dt.year
-
-# Calculate the number of unique orders per state
-Ordered_State = customers_orders.groupby(['customer_state']).agg({'order_id': 'nunique'}).reset_index()
-
-# Sort by the number of orders and select the top 10 states
-Ordered_State = Ordered_State.sort_values(by='order_id', ascending=False).head(10)
-
-# Filter data to only include the top 10 states
-filtered_data = customers_orders[customers_orders['customer_state'].isin(Ordered_State['customer_state'])]
-
-# Group data by state and year to calculate yearly orders
-yearly_State_orders = filtered_data.groupby(['customer_state', 'Purchased_Year']).agg({'order_id': 'nunique'}).reset_index()
-
-# Pivot the data to create a table where rows are states and columns are years
-yearly_State_orders = yearly_State_orders.pivot(index='customer_state', columns='Purchased_Year', values='order_id').fillna(0)
+ ### This is heatnap and Top 3 customers and sellers
+# --- Data Preparation ---
+# Orders per year for the top 10 states by order count (rows are states, columns are years)
+with prof.span("Yearly Heatmap", rows=rows["ORDERS"]):
+    yearly_State_orders = panel_data(
+        data_version, global_filters, "approximate_state_year_orders" if approximate_mode else "state_year_orders", 10)
 
 # --- Data Preparation for Order Status Analysis ---
 
@@ -664,7 +508,7 @@ yearly_State_orders = yearly_State_orders.pivot(index='customer_state', columns=
 # Group by order status to get the total percentage for the entire dataset
 #status_summary = order_status_pie_data.groupby('order_status')['percentage'].sum().reset_index()
 
-# Plotting the pie chart
+# Plotting the pie chart (matplotlib is no longer imported; port to plotly before re-enabling)
 #fig, ax = plt.subplots()
 #ax.pie(status_summary['percentage'], labels=status_summary['order_status'], autopct='%1.1f%%', startangle=90, colors=['#66b3ff','#99ff99','#ff6666'])
 #ax.axis('equal')  # Equal aspect ratio ensures the pie is drawn as a circle.
@@ -672,9 +516,11 @@ yearly_State_orders = yearly_State_orders.pivot(index='customer_state', columns=
 # Layout for displaying everything in one row
 col1, col2 = st.columns([3, 4])
 
-with col1:
+with col1, prof.span("Yearly Heatmap"):
     # Displaying the heatmap
-    st.markdown("#### Yearly Orders per Top 10 States")
+    st.markdown("#### Yearly Orders per Top 10 States" + (" (≈)" if approximate_mode else ""))
+    if approximate_mode:
+        st.caption(f"HyperLogLog estimates within ±{approximate.ERRORS['distinct']:.1%} (one standard error).")
     styled_table = yearly_State_orders.style.background_gradient(cmap="coolwarm")
     st.dataframe(styled_table)
 
@@ -682,3 +528,128 @@ with col1:
     # Displaying the order status analysis pie chart
     #st.markdown("#### Order Status Analysis (Percentage by Product Category)")
     #st.pyplot(fig)
+
+
+# --- Rankings ---
+# Top or bottom K of any dimension by revenue, overall or within a category/state,
+# sliced from the rankings the backend sorted once per data version (ranking.py)
+@st.fragment
+def rankings(version, context, rows, filter_slot):
+    filter_slot.markdown("Revenue Ranking")
+    dimension = filter_slot.selectbox("Rank", options=list(ranking.DIMENSIONS),
+                                      format_func=lambda d: ranking.DIMENSIONS[d][0])
+    label, key, _, withins = ranking.DIMENSIONS[dimension]
+    within = filter_slot.selectbox("Within", options=[None, *withins],
+                                   format_func=lambda d: "All" if d is None else ranking.DIMENSIONS[d][0])
+    group = None
+    if within is not None:
+        group = filter_slot.selectbox(ranking.DIMENSIONS[within][0],
+                                      options=panel_data(version, filters.NONE, "ranking_groups", within))
+    k = filter_slot.number_input("How many", min_value=1, value=10, step=1)
+    bottom = filter_slot.radio("Ranking end", options=[False, True], format_func=lambda b: "Bottom" if b else "Top",
+                               horizontal=True)
+    title = f"{'Bottom' if bottom else 'Top'} {k} by Revenue: {label}" + (f" in {group}" if within else "")
+    with prof.run("Rankings"), prof.span("Rankings", rows=rows["ORDER_ITEMS"]):
+        fig = panel_figure(version, context, "ranking", (dimension, k, within, group, bottom), "ranking_bar", key, title)
+        st.plotly_chart(fig, key="ranking_chart", use_container_width=True)
+
+
+with col2:
+    rankings(data_version, global_filters, rows, ranking_slot)
+
+
+# --- Cohorts ---
+# Retention / revenue by first-purchase month and months since, for all items or
+# one category and/or customer state (cohort.py); reads its own filters only
+@st.fragment
+def cohorts(version, context, rows, filter_slot):
+    filter_slot.markdown("Cohorts")
+    measure = filter_slot.radio("Cohort measure", options=cohort.MEASURES, format_func=str.title, horizontal=True)
+    category = filter_slot.selectbox("Cohort category", options=[None, *panel_data(version, filters.NONE, "category_options")],
+                                     format_func=lambda value: "All" if value is None else value)
+    state = filter_slot.selectbox("Cohort customer state",
+                                  options=[None, *panel_data(version, filters.NONE, "ranking_groups", "customer_state")],
+                                  format_func=lambda value: "All" if value is None else value)
+    title = f"Customer {measure.title()} by Cohort" + "".join(f", {value}" for value in (category, state) if value)
+    with prof.run("Cohorts"), prof.span("Cohorts", rows=rows["ORDER_ITEMS"]):
+        fig = panel_figure(version, context, "cohorts", (category, state), "cohort_heatmap", measure, title)
+        st.plotly_chart(fig, key="cohorts_chart", use_container_width=True)
+
+
+cohorts(data_version, global_filters, rows, cohort_slot)
+
+
+# --- Delivery performance ---
+# p50/p95/p99 of shipment latencies and lateness, per purchase month or group and
+# for one seller and/or customer state, read from the sketches the backend keeps per
+# data version (delivery.py); reads its own filters only
+def share(value):
+    return "–" if math.isnan(value) else f"{value:.1%}"
+
+
+@st.fragment
+def delivery_performance(version, context, rows, filter_slot):
+    filter_slot.markdown("Delivery Performance")
+    metric = filter_slot.selectbox("Delivery metric", options=delivery.METRIC_NAMES,
+                                   index=delivery.METRIC_NAMES.index("lateness"),
+                                   format_func=lambda m: delivery.METRICS[m][0])
+    by = filter_slot.selectbox("Delivery by", options=list(delivery.DIMENSIONS),
+                               format_func=lambda d: delivery.DIMENSIONS[d][0])
+    seller_state = filter_slot.selectbox("Delivery seller state",
+                                         options=[None, *panel_data(version, filters.NONE, "ranking_groups", "seller_state")],
+                                         format_func=lambda value: "All" if value is None else value)
+    customer_state = filter_slot.selectbox("Delivery customer state",
+                                           options=[None, *panel_data(version, filters.NONE, "ranking_groups", "customer_state")],
+                                           format_func=lambda value: "All" if value is None else value)
+    label = delivery.METRICS[metric][0]
+    title = f"{label} (days) by {delivery.DIMENSIONS[by][0]}" + "".join(
+        f", {value}" for value in (seller_state, customer_state) if value)
+    with prof.run("Delivery Performance"), prof.span("Delivery Performance", rows=rows["ORDER_ITEMS"]):
+        compliance = panel_data(version, context, "delivery_compliance", seller_state, customer_state)
+        overall = panel_data(version, context, "delivery_percentiles", metric, None, seller_state, customer_state).iloc[0]
+        columns = st.columns(6)
+        columns[0].metric("Delivered shipments", f"{compliance['delivered']:,}")
+        columns[1].metric("Handed to carrier by limit", share(compliance["within_shipping_limit"]))
+        columns[2].metric("Delivered by estimate", share(compliance["delivered_by_estimate"]))
+        for column, quantile in zip(columns[3:], delivery.QUANTILE_COLUMNS):
+            column.metric(f"{label} {quantile}", "–" if math.isnan(overall[quantile]) else f"{overall[quantile]:.1f} d")
+        st.caption(f"Percentiles are read from mergeable sketches and are within ±{sketches.ACCURACY:.0%} "
+                   "of the exact values.")
+        fig = panel_figure(version, context, "delivery_percentiles", (metric, by, seller_state, customer_state),
+                           "delivery_percentiles_chart", title)
+        st.plotly_chart(fig, key="delivery_percentiles_chart", use_container_width=True)
+
+
+delivery_performance(data_version, global_filters, rows, delivery_slot)
+
+
+# --- Geography ---
+# Seller-customer distance bands, and a map aggregated into cells on the server (geo.py)
+@st.fragment
+def locations_map(version, context, rows, filter_slot):
+    side = filter_slot.radio("Map locations of", options=["customer", "seller"], format_func=str.title,
+                             horizontal=True)
+    with prof.run("Locations Map"), prof.span("Locations Map", rows=rows["ORDER_ITEMS"]):
+        fig = panel_figure(version, context, "map_cells", (side,), "cells_map", f"Items and Revenue by {side.title()} Location")
+        st.plotly_chart(fig, key="map_cells_chart", use_container_width=True)
+
+
+with prof.span("Distance Bands", rows=rows["ORDER_ITEMS"]):
+    fig_distance = panel_figure(data_version, global_filters, "distance_bands", (), "distance_bands_bar")
+
+col1, col2 = st.columns(2)
+
+with col1:
+    st.plotly_chart(fig_distance, key="distance_bands_chart", use_container_width=True)
+
+with col2:
+    locations_map(data_version, global_filters, rows, map_slot)
+
+# --- Profiler ---
+# Timings of this rerun and the previous ones (milliseconds per panel)
+prof.finish_run()
+with st.sidebar.expander("Profiler"):
+    st.caption(f"Rerun #{prof.run_count} took {prof.runs[-1]['total_seconds'] * 1000:,.0f} ms")
+    st.dataframe(prof.last_run_frame(), hide_index=True)
+    st.markdown("Last reruns (ms)")
+    st.dataframe(prof.history_frame())
@@ -0,0 +1,238 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# Deterministic generator for the eight marketplace tables described in details.txt.
+# Scale 1 is roughly a tenth of the full export (10k orders); cardinalities and skew
+# follow the real data: most customers buy once, most orders have one item and one
+# payment, and a few sellers/categories take most of the sales.
+
+BASE_ORDERS = 10_000
+BASE_PRODUCTS = 3_200
+BASE_SELLERS = 300
+
+STATES = [
+    "Andhra Pradesh", "Gujarat", "Chhattisgarh", "Tamil Nadu", "Karnataka", "Delhi",
+    "Madhya Pradesh", "Uttar Pradesh", "Maharashtra", "West Bengal", "Haryana",
+    "Jammu & Kashmir", "Kerala", "Rajasthan", "Punjab", "Arunachal Pradesh", "Orissa",
+    "Himachal Pradesh", "Uttaranchal", "Goa",
+]
+CATEGORIES = [
+    "Bed_Bath_Table", "Sports_Leisure", "Furniture_Decor", "Health_Beauty", "Housewares",
+    "Auto", "Computers_Accessories", "Toys", "Watches_Gifts", "Telephony", "Baby",
+    "Perfumery", "Stationery", "Garden_Tools", "Fashion_Bags_Accessories", "Pet_Shop",
+    "Cool_Stuff", "Electronics", "Construction_Tools", "Luggage_Accessories",
+]
+PAYMENT_TYPES = ["credit_card", "UPI", "voucher", "debit_card"]
+ORDER_STATUSES = ["delivered", "shipped", "canceled", "unavailable", "invoiced", "processing"]
+
+START = pd.Timestamp("2016-09-04")
+END = pd.Timestamp("2018-10-17")
+
+
+def _hex_ids(rng, n):
+    # 32-char lowercase hex ids, like the real export
+    raw = rng.integers(0, 2**63 - 1, size=(n, 2), dtype=np.int64)
+    return np.array([f"{a:016x}{b:016x}" for a, b in raw], dtype=object)
+
+
+def _zipf_choice(rng, n_items, size, a=1.2):
+    # Skewed pick of item positions: a handful of items take most of the volume
+    weights = 1.0 / np.arange(1, n_items + 1) ** a
+    return rng.choice(n_items, size=size, p=weights / weights.sum())
+
+
+def _geo(rng, n_zips):
+    zips = np.sort(rng.choice(np.arange(1000, 99999), size=n_zips, replace=False))
+    state_idx = _zipf_choice(rng, len(STATES), n_zips, a=0.9)
+    # one rough centroid per state, points scattered around it
+    centre_lat = rng.uniform(9.0, 32.0, len(STATES))
+    centre_lng = rng.uniform(70.0, 92.0, len(STATES))
+    return pd.DataFrame({
+        "geolocation_zip_code_prefix": zips,
+        "geolocation_lat": np.round(centre_lat[state_idx] + rng.normal(0, 1.2, n_zips), 4),
+        "geolocation_lng": np.round(centre_lng[state_idx] + rng.normal(0, 1.2, n_zips), 4),
+        "geolocation_city": [f"City_{i % 900:03d}" for i in rng.integers(0, 10**6, n_zips)],
+        "geolocation_state": np.array(STATES, dtype=object)[state_idx],
+    })
+
+
+def _products(rng, n):
+    return pd.DataFrame({
+        "product_id": _hex_ids(rng, n),
+        "product_category_name": np.array(CATEGORIES, dtype=object)[_zipf_choice(rng, len(CATEGORIES), n, a=0.7)],
+        "product_name_lenght": rng.integers(5, 76, n),
+        "product_description_lenght": rng.integers(4, 3993, n),
+        "product_photos_qty": rng.integers(1, 12, n),
+        "product_weight_g": rng.integers(50, 30000, n),
+        "product_length_cm": rng.integers(7, 105, n),
+        "product_height_cm": rng.integers(2, 105, n),
+        "product_width_cm": rng.integers(6, 118, n),
+    })
+
+
+def _located(rng, geo, n, prefix):
+    rows = geo.iloc[rng.integers(0, len(geo), n)]
+    return pd.DataFrame({
+        f"{prefix}_zip_code_prefix": rows["geolocation_zip_code_prefix"].to_numpy(),
+        f"{prefix}_city": rows["geolocation_city"].to_numpy(),
+        f"{prefix}_state": rows["geolocation_state"].to_numpy(),
+    })
+
+
+def _sellers(rng, geo, n):
+    df = _located(rng, geo, n, "seller")
+    df.insert(0, "seller_id", _hex_ids(rng, n))
+    return df
+
+
+def _fmt(ts):
+    return ts.dt.strftime("%Y-%m-%d %H:%M:%S").where(ts.notna(), None)
+
+
+def generate(scale=1.0, seed=0, products=None, sellers=None, geolocation=None):
+    """Return the eight tables as a dict keyed by CSV name (ORDERS, ORDER_ITEMS, ...)."""
+    rng = np.random.default_rng(seed)
+    n_orders = max(int(BASE_ORDERS * scale), 50)
+
+    if geolocation is None:
+        geolocation = _geo(rng, max(int(2_000 * min(scale, 10)), 200))
+    if products is None:
+        products = _products(rng, max(int(BASE_PRODUCTS * scale), 100))
+    if sellers is None:
+        sellers = _sellers(rng, geolocation, max(int(BASE_SELLERS * scale), 20))
+
+    # Customers: one customer_id per order, customer_unique_id repeats for ~3% of buyers
+    repeat = rng.random(n_orders) < 0.03
+    n_unique = n_orders - int(repeat.sum())
+    unique_ids = _hex_ids(rng, n_unique)
+    owner = np.empty(n_orders, dtype=np.int64)
+    owner[~repeat] = np.arange(n_unique)
+    owner[repeat] = rng.integers(0, n_unique, int(repeat.sum()))
+    customers = _located(rng, geolocation, n_orders, "customer")
+    customer_ids = _hex_ids(rng, n_orders)
+    customers.insert(0, "customer_id", customer_ids)
+    customers.insert(1, "customer_unique_id", unique_ids[owner])
+
+    # Orders: purchase volume ramps up over time, most orders delivered
+    span = (END - START).total_seconds()
+    t = np.sqrt(rng.random(n_orders))
+    purchase = START + pd.to_timedelta(np.sort(t) * span, unit="s")
+    purchase = pd.Series(purchase).dt.floor("s")
+    status = np.array(ORDER_STATUSES, dtype=object)[
+        rng.choice(len(ORDER_STATUSES), n_orders, p=[0.97, 0.011, 0.006, 0.006, 0.004, 0.003])
+    ]
+    delivered = status == "delivered"
+    approved = purchase + pd.to_timedelta(rng.exponential(10, n_orders), unit="h")
+    carrier = approved + pd.to_timedelta(rng.exponential(2.5, n_orders), unit="D")
+    customer_date = carrier + pd.to_timedelta(rng.gamma(2.5, 3.5, n_orders), unit="D")
+    estimated = (purchase + pd.to_timedelta(rng.integers(10, 40, n_orders), unit="D")).dt.normalize()
+    order_ids = _hex_ids(rng, n_orders)
+    orders = pd.DataFrame({
+        "order_id": order_ids,
+        "customer_id": customer_ids,
+        "order_status": status,
+        "order_purchase_timestamp": _fmt(purchase),
+        "order_approved_at": _fmt(approved.dt.floor("s").where(status != "canceled")),
+        "order_delivered_carrier_date": _fmt(carrier.dt.floor("s").where(delivered | (status == "shipped"))),
+        "order_delivered_customer_date": _fmt(customer_date.dt.floor("s").where(delivered)),
+        "order_estimated_delivery_date": _fmt(estimated),
+    })
+
+    # Order items: 1 item for ~90% of orders, a long tail up to 6
+    n_items = np.minimum(rng.geometric(0.88, n_orders), 6)
+    item_order = np.repeat(np.arange(n_orders), n_items)
+    item_seq = np.concatenate([np.arange(1, k + 1) for k in n_items])
+    item_product = _zipf_choice(rng, len(products), len(item_order), a=0.8)
+    product_seller = rng.integers(0, len(sellers), len(products))
+    item_seller = product_seller[item_product]
+    price = np.round(np.exp(rng.normal(4.3, 1.0, len(item_order))), 2)
+    freight = np.round(rng.gamma(2.0, 10.0, len(item_order)), 2)
+    order_items = pd.DataFrame({
+        "order_id": order_ids[item_order],
+        "order_item_id": item_seq,
+        "product_id": products["product_id"].to_numpy()[item_product],
+        "seller_id": sellers["seller_id"].to_numpy()[item_seller],
+        "shipping_limit_date": _fmt(approved.iloc[item_order].reset_index(drop=True)
+                                    + pd.to_timedelta(rng.integers(2, 8, len(item_order)), unit="D")),
+        "price": price,
+        "freight_value": freight,
+    })
+
+    # Payments: the order total split over 1-3 payment rows
+    order_total = np.bincount(item_order, weights=price + freight, minlength=n_orders)
+    n_pay = np.minimum(rng.geometric(0.95, n_orders), 3)
+    pay_order = np.repeat(np.arange(n_orders), n_pay)
+    pay_seq = np.concatenate([np.arange(1, k + 1) for k in n_pay])
+    share = rng.random(len(pay_order)) + 0.1
+    share /= np.bincount(pay_order, weights=share)[pay_order]
+    pay_type = rng.choice(len(PAYMENT_TYPES), len(pay_order), p=[0.74, 0.19, 0.055, 0.015])
+    pay_type[pay_seq > 1] = 2  # split payments are vouchers
+    installments = np.where(pay_type == 0, rng.integers(1, 11, len(pay_order)), 1)
+    payments = pd.DataFrame({
+        "order_id": order_ids[pay_order],
+        "payment_sequential": pay_seq,
+        "payment_type": np.array(PAYMENT_TYPES, dtype=object)[pay_type],
+        "payment_installments": installments,
+        "payment_value": np.round(order_total[pay_order] * share, 2),
+    })
+
+    # Reviews: roughly one per order, skewed towards 5 stars
+    reviewed = rng.random(n_orders) < 0.99
+    rev_order = np.flatnonzero(reviewed)
+    created = (purchase.iloc[rev_order] + pd.to_timedelta(rng.integers(3, 30, len(rev_order)), unit="D")).dt.normalize()
+    reviews = pd.DataFrame({
+        "review_id": _hex_ids(rng, len(rev_order)),
+        "order_id": order_ids[rev_order],
+        "review_score": rng.choice([1, 2, 3, 4, 5], len(rev_order), p=[0.11, 0.03, 0.08, 0.19, 0.59]),
+        "review_creation_date": _fmt(created.reset_index(drop=True)),
+        "review_answer_timestamp": _fmt((created + pd.to_timedelta(rng.exponential(3, len(rev_order)), unit="D")).dt.floor("s").reset_index(drop=True)),
+    })
+
+    return {
+        "ORDERS": orders,
+        "ORDER_ITEMS": order_items,
+        "CUSTOMERS": customers,
+        "PRODUCTS": products,
+        "SELLERS": sellers,
+        "ORDER_PAYMENTS": payments,
+        "ORDER_REVIEW_RATINGS": reviews,
+        "GEO_LOCATION": geolocation,
+    }
+
+
+def write_csvs(tables, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    for name, df in tables.items():
+        df.to_csv(os.path.join(out_dir, f"{name}.csv"), index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic marketplace CSVs")
+    parser.add_argument("out_dir")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--bundled-dimensions", action="store_true",
+        help="reuse PRODUCTS/SELLERS/GEO_LOCATION.csv from the repo and only generate the order tables",
+    )
+    args = parser.parse_args()
+
+    dims = {}
+    if args.bundled_dimensions:
+        here = os.path.dirname(os.path.abspath(__file__))
+        dims = {
+            "products": pd.read_csv(os.path.join(here, "PRODUCTS.csv")),
+            "sellers": pd.read_csv(os.path.join(here, "SELLERS.csv")),
+            "geolocation": pd.read_csv(os.path.join(here, "GEO_LOCATION.csv")),
+        }
+    tables = generate(args.scale, args.seed, **dims)
+    write_csvs(tables, args.out_dir)
+    for name, df in tables.items():
+        print(f"{name}: {len(df):,} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import pytest
+
+import backends
+import synthetic_data
+
+# Panel parity of the sql (both engines) and stream backends with the pandas backend
+# (backends.check) over a small synthetic data set.
+
+
+@pytest.fixture(scope="module")
+def data_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp("market")
+    synthetic_data.write_csvs(synthetic_data.generate(0.05, seed=0), path)
+    return str(path)
+
+
+@pytest.mark.parametrize("against, engine", [("sql", "duckdb"), ("sql", "sqlite"), ("stream", None)])
+def test_panels_match_pandas_backend(data_dir, monkeypatch, against, engine):
+    if engine == "duckdb":
+        pytest.importorskip("duckdb")
+    monkeypatch.setattr(backends, "SQL_ENGINE", engine)
+    mismatches = backends.check(data_dir, against=against)
+    assert [name for name, _, _ in mismatches] == []
@@ -0,0 +1,44 @@
+import pytest
+
+import backends
+import charts
+import delivery
+import filters
+import report
+import synthetic_data
+
+# Charts of panels that come back with no rows draw the no_data placeholder rather
+# than failing in plotly.express.
+
+
+@pytest.fixture(scope="module")
+def backend(tmp_path_factory):
+    path = tmp_path_factory.mktemp("market")
+    synthetic_data.write_csvs(synthetic_data.generate(0.05, seed=0), path)
+    backend = backends.PandasBackend(str(path))
+    backend.refresh()
+    return backend
+
+
+def _is_placeholder(fig):
+    return not fig.data and [a.text for a in fig.layout.annotations]
+
+
+@pytest.mark.parametrize("by", list(delivery.DIMENSIONS))
+def test_delivery_percentiles_of_empty_slice(backend, by):
+    percentiles = backend.delivery_percentiles("lateness", by, seller_state="nowhere", customer_state="nowhere")
+    assert percentiles.empty
+    assert _is_placeholder(charts.delivery_percentiles_chart(percentiles, "Lateness"))
+
+
+def test_panels_of_filter_selecting_nothing(backend):
+    # the last value of every global filter dimension together: no order passes
+    options = backend.filter_options()
+    view = backend.filtered(filters.Filters(**{field: (options[field][-1],) for field in
+                                               [*filters.ORDER_DIMS, *filters.ITEM_DIMS]}))
+    assert len(view.model.order_fact) == 0
+    for key, _, panel, panel_args, chart, chart_args in report.panels("category", options["category"][-1]):
+        data = getattr(view, panel)(*panel_args)
+        if chart is not None:
+            fig = getattr(charts, chart)(data, *chart_args)
+            assert not charts.is_empty(data) or _is_placeholder(fig), key
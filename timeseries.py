@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+# Integer period codes for timestamps and resampled series built on them.
+#
+# Timestamps are parsed once when the tables are loaded (data_loader); everything
+# after that works on integer codes derived from the datetime64 values by casting
+# to day/month units, never on formatted strings:
+#
+#   day      days since 0000-01-01
+#   week     Monday-based weeks (week code * 7 + 2 is the day code of its Monday)
+#   month    months since year 0 (year * 12 + month - 1)
+#   quarter  month code // 3
+#   year     month code // 12, i.e. the year itself
+#
+# Missing timestamps get -1. A running count kept per day code (say, new customers)
+# can then be rolled up to any granularity and date range with resample(); the axis
+# always runs over every period of the range, so periods without data show as 0
+# rather than being skipped.
+
+GRANULARITIES = ["day", "week", "month", "quarter", "year"]
+
+DAY_OFFSET = 719528  # day code of 1970-01-01
+MONTH_OFFSET = 1970 * 12  # month code of 1970-01
+_MONDAY = (DAY_OFFSET - 3) % 7  # 1970-01-01 was a Thursday
+
+
+def period_codes(timestamps, granularity="month"):
+    values = pd.DatetimeIndex(timestamps).to_numpy()
+    missing = np.isnat(values)
+    if granularity in ("day", "week"):
+        codes = values.astype("datetime64[D]").astype(np.int64) + DAY_OFFSET
+        if granularity == "week":
+            codes = (codes - _MONDAY) // 7
+    elif granularity in ("month", "quarter", "year"):
+        codes = values.astype("datetime64[M]").astype(np.int64) + MONTH_OFFSET
+        codes = codes // {"month": 1, "quarter": 3, "year": 12}[granularity]
+    else:
+        raise ValueError(f"unknown granularity {granularity!r} (one of {', '.join(GRANULARITIES)})")
+    codes[missing] = -1
+    return codes.astype(np.int32)
+
+
+def period_start(codes, granularity="month"):
+    # DatetimeIndex of the first instant of each period (NaT for -1)
+    codes = np.asarray(codes, dtype=np.int64)
+    if granularity == "day":
+        values = (codes - DAY_OFFSET).astype("datetime64[D]")
+    elif granularity == "week":
+        values = (codes * 7 + _MONDAY - DAY_OFFSET).astype("datetime64[D]")
+    elif granularity in ("month", "quarter", "year"):
+        months = codes * {"month": 1, "quarter": 3, "year": 12}[granularity]
+        values = (months - MONTH_OFFSET).astype("datetime64[M]")
+    else:
+        raise ValueError(f"unknown granularity {granularity!r} (one of {', '.join(GRANULARITIES)})")
+    values = values.astype("datetime64[ns]")
+    values[codes < 0] = np.datetime64("NaT")
+    return pd.DatetimeIndex(values)
+
+
+def resample(counts, granularity="month", source="day", start=None, end=None):
+    # counts: additive values indexed by `source` period codes. Returns their sums per
+    # `granularity` period (a coarser one; weeks count in the month of their Monday),
+    # indexed by period start, for every period from start to end. The range defaults
+    # to the first and last period with data; start/end are anything pd.Timestamp takes.
+    source_start = period_start(counts.index, source)
+    keep = ~source_start.isna()
+    if start is not None:
+        keep &= source_start >= pd.Timestamp(start)
+    if end is not None:
+        keep &= source_start <= pd.Timestamp(end)
+    codes = period_codes(source_start[keep], granularity)
+    values = counts.to_numpy()[keep]
+    if not len(codes) and (start is None or end is None):
+        return pd.Series([], index=pd.DatetimeIndex([]), dtype=counts.dtype, name=counts.name)
+    first = period_codes([start], granularity)[0] if start is not None else codes.min()
+    last = period_codes([end], granularity)[0] if end is not None else codes.max()
+    totals = np.bincount(codes - first, weights=values, minlength=max(last - first + 1, 0))
+    if pd.api.types.is_integer_dtype(counts.dtype):
+        totals = totals.astype(counts.dtype)
+    return pd.Series(totals, index=period_start(np.arange(first, last + 1), granularity), name=counts.name)